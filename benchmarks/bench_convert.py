@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+"""
+Compare the wall time of the serial and process-parallel MVF to AIPS
+conversion, timing KATH5toAIPS.CreateKATUV and KAT2AIPS as the pipeline
+calls them.
+"""
+import time
+import katdal
+import OErr, OSystem
+import AIPS
+from katim import AIPSSetup
+from katim import KATH5toAIPS
+from optparse import OptionParser
+
+usage = "%prog [options] mvffile"
+description = "Time the conversion of an MVF file to AIPS UV with different numbers of worker processes"
+parser = OptionParser(usage=usage, description=description)
+parser.add_option("--nworkers", default='1,4', help="Comma separated list of numbers of worker processes to time (default '1,4')")
+parser.add_option("--repeat", type='int', default=1, help="Number of times to run each conversion (default 1)")
+parser.add_option("--flag", action='store_true', default=False, help="Flag data on the fly during conversion")
+parser.add_option("--scratchdir", default=None, help="Directory for AIPS disk and scratch files")
+(options, args) = parser.parse_args()
+
+if len(args) == 0:
+    parser.print_help()
+    raise SystemExit
+
+err = OErr.OErr()
+OErr.PInit(err, 2, '/dev/null')
+ObitSys = AIPSSetup.AIPSSetup(err, scratchdir=options.scratchdir)
+user = OSystem.PGetAIPSuser()
+AIPS.userno = user
+disk = 1
+fitsdisk = 0
+
+katdata = katdal.open(args[0])
+katdata.select(scans='track')
+
+results = []
+seq = 1
+for nworkers in [int(n) for n in options.nworkers.split(',')]:
+    for rep in range(options.repeat):
+        t0 = time.time()
+        uv = KATH5toAIPS.CreateKATUV(katdata, 'BENCH', 'Raw', disk, seq, err)
+        KATH5toAIPS.KAT2AIPS(katdata, uv, disk, fitsdisk, err, calInt=katdata.dump_period,
+                             flag=options.flag, nworkers=nworkers, scratchdir=options.scratchdir)
+        wall = time.time() - t0
+        nvis = uv.Desc.Dict['nvis']
+        results.append((nworkers, rep + 1, wall, nvis))
+        uv.Zap(err)
+        seq += 1
+
+print("\n%8s %4s %10s %12s %12s" % ("nworkers", "rep", "wall (s)", "nvis", "vis/s"))
+for nworkers, rep, wall, nvis in results:
+    print("%8d %4d %10.1f %12d %12.0f" % (nworkers, rep, wall, nvis, nvis / wall))
+serial = [r[2] for r in results if r[0] == 1]
+if serial:
+    for nworkers in sorted(set(r[0] for r in results if r[0] != 1)):
+        wall = min(r[2] for r in results if r[0] == nworkers)
+        print("Speedup with %d workers: %.2fx" % (nworkers, min(serial) / wall))
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+"""
+Compare the FQ, AN and SU table conversion of MakeIFs.UVMakeIF through a
+version 2 copy with the direct rewrite of version 1, on a synthetic
+observation (default 64 antennas and 200 sources).
+"""
+import time
+import OErr, OSystem
+import AIPS
+from katim import AIPSSetup
+from katim import KATH5toAIPS
+from katim import MakeIFs
+from optparse import OptionParser
+
+usage = "%prog [options]"
+description = "Time the FQ, AN and SU table conversion of UVMakeIF through a copy and in place"
+parser = OptionParser(usage=usage, description=description)
+parser.add_option("--nants", type='int', default=64, help="Number of antennas (default 64)")
+parser.add_option("--nsources", type='int', default=200, help="Number of sources (default 200)")
+parser.add_option("--nchan", type='int', default=4096, help="Number of channels (default 4096)")
+parser.add_option("--nif", type='int', default=8, help="Number of IFs to make (default 8)")
+parser.add_option("--repeat", type='int', default=3, help="Number of times to run each conversion (default 3)")
+parser.add_option("--scratchdir", default=None, help="Directory for AIPS disk")
+(options, args) = parser.parse_args()
+
+err = OErr.OErr()
+OErr.PInit(err, 2, '/dev/null')
+ObitSys = AIPSSetup.AIPSSetup(err, scratchdir=options.scratchdir)
+user = OSystem.PGetAIPSuser()
+AIPS.userno = user
+disk = 1
+
+# Synthetic meta data in the GetKATMeta layout
+meta = {"spw":[(options.nchan, 856.0e6, 856.0e6 / options.nchan)],
+        "nstokes":4, "obsdate":"2020-01-01", "observer":"bench", "RX":"L",
+        "ants":[(i + 1, "m%03d" % i, 5109000.0 + i, 2006000.0 + i, -3239000.0 + i, 13.5)
+                for i in range(options.nants)],
+        "targets":[(i + 1, ("SRC%04d" % i).ljust(16), i * 1.8, -30.0, i * 1.8, -30.0)
+                   for i in range(options.nsources)]}
+
+def make_uv(seq):
+    uv = KATH5toAIPS.CreateUVFromMeta(meta, 'BENCH', 'MakeIF', disk, seq, err)
+    KATH5toAIPS.WriteANTable(uv, meta, err)
+    KATH5toAIPS.WriteFQTable(uv, meta, err)
+    KATH5toAIPS.WriteSUTable(uv, meta, err)
+    MakeIFs.DescMakeIF(uv, options.nif, err)
+    return uv
+
+results = {False:[], True:[]}
+seq = 1
+for rep in range(options.repeat):
+    for inPlace in (False, True):
+        uv = make_uv(seq)
+        t0 = time.time()
+        if inPlace:
+            MakeIFs.UpdateFQInPlace(uv, options.nif, err)
+            MakeIFs.UpdateANInPlace(uv, options.nif, err)
+            MakeIFs.UpdateSUInPlace(uv, options.nif, err)
+        else:
+            MakeIFs.UpdateFQ2(uv, options.nif, err)
+            MakeIFs.UpdateAN2(uv, options.nif, err)
+            MakeIFs.UpdateSU2(uv, options.nif, err)
+        results[inPlace].append(time.time() - t0)
+        uv.Zap(err)
+        seq += 1
+
+print("\n%d antennas, %d sources, %d IFs" % (options.nants, options.nsources, options.nif))
+print("%10s %10s %10s" % ("method", "best (s)", "mean (s)"))
+for inPlace in (False, True):
+    times = results[inPlace]
+    print("%10s %10.3f %10.3f" % ("in place" if inPlace else "copy", min(times), sum(times) / len(times)))
+print("Speedup: %.2fx" % (min(results[False]) / min(results[True])))
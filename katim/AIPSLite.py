@@ -9,10 +9,19 @@ This module assists in running AIPS/ParselTongue on machines without
 an AIPS installation.
 """
 
-import os, shutil, string, sys, time
+import os, shutil, string, sys, time, hashlib, json, tempfile
 
 aips_server = 'ftp.aoc.nrao.edu'
 
+# Shared cache of AIPS files, see set_cache. Files are stored read-only
+# under the SHA-256 of their contents in objects/, paths/ maps each file
+# (relative to AIPS_ROOT) to its hash and trees/ holds the lists of files
+# made by FILAIP for each version and architecture.
+cache_dir = None
+# Local directory with the layout of the AIPS rsync server, used
+# instead of rsync when set.
+mirror_dir = None
+
 default_year = time.gmtime().tm_year - 1
 default_version = '31DEC' + str(default_year)[-2:]
 
@@ -79,6 +88,95 @@ def binary_urls():
     exe_path = version() + '/' + os.environ['ARCH'] + '/LOAD'
     return create_path_list(exe_path, binary_files)
 
+def set_cache(cache=None, mirror=None):
+    """Use the shared file cache and/or local server mirror directories"""
+    global cache_dir, mirror_dir
+    cache_dir = cache or None
+    mirror_dir = mirror or None
+
+def _file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _atomic_write(filename, data):
+    """Write data to filename so concurrent readers never see part of it"""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.chmod(tmp, 0o444)
+    os.rename(tmp, filename)
+
+def cache_store(filename):
+    """Store a file in the cache by content, return its hash"""
+    digest = _file_hash(filename)
+    obj = '%s/objects/%s/%s' % (cache_dir, digest[:2], digest)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(obj))
+        os.close(fd)
+        shutil.copyfile(filename, tmp)
+        os.chmod(tmp, 0o555)
+        os.rename(tmp, obj)
+    return digest
+
+def cache_add(path):
+    """Add AIPS_ROOT/path to the cache"""
+    digest = cache_store(os.environ['AIPS_ROOT'] + '/' + path)
+    _atomic_write(cache_dir + '/paths/' + path, digest)
+
+def cache_install(path):
+    """Link AIPS_ROOT/path to its cached copy, False if not cached"""
+    entry = cache_dir + '/paths/' + path
+    if not os.path.exists(entry):
+        return False
+    with open(entry) as f:
+        digest = f.read().strip()
+    obj = '%s/objects/%s/%s' % (cache_dir, digest[:2], digest)
+    if not os.path.exists(obj):
+        return False
+    dest = os.environ['AIPS_ROOT'] + '/' + path
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    os.symlink(obj, dest)
+    return True
+
+def mirror_copy(mirror, path_list):
+    """Copy path_list from a local server mirror, return the paths it lacks"""
+    missing = []
+    for path in path_list:
+        src = mirror + '/' + path
+        if not os.path.exists(src):
+            missing.append(path)
+            continue
+        dest = os.environ['AIPS_ROOT'] + '/' + path
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(src, dest)
+    return missing
+
+def fetch(path_list, force=False):
+    """Get the files in path_list (relative to AIPS_ROOT) from the cache,
+    the local mirror or the AIPS server, in that order"""
+    if cache_dir and not force:
+        path_list = [path for path in path_list if not cache_install(path)]
+    if not path_list:
+        return
+    missing = path_list
+    if mirror_dir:
+        missing = mirror_copy(mirror_dir, path_list)
+    if missing:
+        rsync(aips_server, missing, force=force)
+    if cache_dir:
+        for path in path_list:
+            if os.path.exists(os.environ['AIPS_ROOT'] + '/' + path):
+                cache_add(path)
+
 def rsync(server, path_list, force=False):
     args = ['rsync', '--compress', '--relative', '--no-motd', '--progress']
     if not force:
@@ -147,7 +245,7 @@ def get_aips(basedir=None, version=default_version, force=False):
         if not os.path.exists(os.environ['AIPS_ROOT'] +'/' + url):
             urls = urls + [url]
     if len(urls)>0:
-        rsync(aips_server, urls, force=force)
+        fetch(urls, force=force)
     filaip(force=force)
 
 def filaip(force=False,data_dir=None):
@@ -173,11 +271,46 @@ def filaip(force=False,data_dir=None):
     os.environ['DA01'] = data_dir
     os.environ['NVOL'] = '1'
     os.environ['NEWMEM'] = mem_dir
-    if run_filaip:
+    if run_filaip and not filaip_restore(mem_dir, template_dir, data_dir):
+        before = set(os.listdir(data_dir))
         os.system('echo 8 2 | %s/%s/LOAD/FILAIP.EXE' % (os.environ['AIPS_VERSION'], os.environ['ARCH']))
+        filaip_store(mem_dir, template_dir, data_dir, set(os.listdir(data_dir)) - before)
     for var in ['DA00', 'NET0', 'NVOL']:
         del os.environ[var]
 
+def _filaip_tree():
+    return '%s/trees/%s-%s-FILAIP.json' % (cache_dir, version(), os.environ['ARCH'])
+
+def filaip_store(mem_dir, template_dir, data_dir, data_files):
+    """Cache the MEMORY and TEMPLATE directories and the data_files
+    FILAIP made in data_dir"""
+    if not cache_dir:
+        return
+    tree = {}
+    for key, tdir in [('MEMORY', mem_dir), ('TEMPLATE', template_dir)]:
+        for name in os.listdir(tdir):
+            if os.path.isfile(tdir + '/' + name):
+                tree[key + '/' + name] = cache_store(tdir + '/' + name)
+    for name in data_files:
+        if os.path.isfile(data_dir + '/' + name):
+            tree['DATA/' + name] = cache_store(data_dir + '/' + name)
+    _atomic_write(_filaip_tree(), json.dumps(tree))
+
+def filaip_restore(mem_dir, template_dir, data_dir):
+    """Copy the FILAIP files from the cache, False if not cached.
+    These are written by AIPS so are copied rather than linked."""
+    if not cache_dir or not os.path.exists(_filaip_tree()):
+        return False
+    with open(_filaip_tree()) as f:
+        tree = json.load(f)
+    dirs = {'MEMORY':mem_dir, 'TEMPLATE':template_dir, 'DATA':data_dir}
+    for name, digest in tree.items():
+        key, filename = name.split('/', 1)
+        dest = dirs[key] + '/' + filename
+        shutil.copyfile('%s/objects/%s/%s' % (cache_dir, digest[:2], digest), dest)
+        os.chmod(dest, 0o644)
+    return True
+
 def setup_all(basedir=None, version=default_version, force=False):
     """Get required files and make DA00 and DISK areas"""
     get_aips(basedir=basedir, version=version, force=force)
@@ -206,6 +339,20 @@ def get_task(*args, **kwargs):
             urls += create_path_list(exe_path, [taskname.upper() + '.EXE'])
             urls += create_path_list(help_path, [taskname.upper() + '.HLP'])
     if len(urls)>0:
-        rsync(aips_server, urls, force=force)
+        fetch(urls, force=force)
 
 quick_start = setup_all
+
+# AIPS tasks run by the pipelines, see prefetch
+pipeline_tasks = ['FITTP', 'FITAB', 'UVFLG', 'UVCOP', 'CLCOR', 'SNPLT',
+                  'LWPLA', 'POSSM', 'KNTR', 'UVPLT', 'UVLOD']
+
+def prefetch(basedir=None, version=default_version, tasks=pipeline_tasks, force=False):
+    """Fill the cache with the AIPS files, FILAIP output and tasks used"""
+    if not cache_dir:
+        raise RuntimeError('No AIPS cache directory set')
+    get_aips(basedir=basedir, version=version, force=force)
+    if not os.path.exists(_filaip_tree()):
+        # Run FILAIP again to cache its output
+        filaip(force=True)
+    get_task(*tasks, force=force)
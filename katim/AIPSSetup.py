@@ -32,7 +32,8 @@ def AIPSSetup(err,configfile=None,scratchdir=None,overwrite=True,aipsdisk='aipsd
         aips_dir = './'
         aips_version = '31DEC20'    # Should sort out where to change this if necessary!!
 
-    configdefaults   = {'aips_dir': aips_dir, 'obit_dir': OBIT_EXEC, 'aips_version': aips_version, 'scratch_area': cwd, 'metadata_dir': OBIT_DATA}
+    configdefaults   = {'aips_dir': aips_dir, 'obit_dir': OBIT_EXEC, 'aips_version': aips_version, 'scratch_area': cwd, 'metadata_dir': OBIT_DATA,
+                        'aips_cache': os.environ.get('AIPS_CACHE', ''), 'aips_mirror': os.environ.get('AIPS_MIRROR', '')}
     config = configparser.ConfigParser(configdefaults)
     config.add_section('KATPIPE')
 
@@ -48,6 +49,9 @@ def AIPSSetup(err,configfile=None,scratchdir=None,overwrite=True,aipsdisk='aipsd
 
     ############################# Initialize AIPS ##########################################
 
+    # Shared cache of AIPS files and local mirror of the AIPS server, if any
+    AIPSLite.set_cache(config.get('KATPIPE','aips_cache'), config.get('KATPIPE','aips_mirror'))
+
     # Sort out the AIPS environment variables for the defined configuration.
     AIPSLite.get_aips(basedir=config.get('KATPIPE','aips_dir'),version=config.get('KATPIPE','aips_version'))
 
@@ -5,6 +5,8 @@ Optional input is contrast percentage.
 from astropy.io import fits as pyfits
 import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import os, sys
 from optparse import OptionParser
 import numpy as np
@@ -214,14 +216,15 @@ def writejpeg(data, filename, contrast=0.05, cmap='gray'):
     # Colormap selection (todo- make the colormap a kwarg)
     cmapin = plt.get_cmap(cmap)
     norm = BoundaryNorm(levels, ncolors=cmapin.N, clip=True)
-    im=plt.figure(figsize=(5,5))
-    plt.axes([0,0,1,1])
-    plt.pcolormesh(x,y,data, cmap=cmapin, norm=norm)
+    # Figure not managed by pyplot so jpegs can be written from several threads
+    im=Figure(figsize=(5,5))
+    FigureCanvasAgg(im)
+    ax=im.add_axes([0,0,1,1])
+    ax.pcolormesh(x,y,data, cmap=cmapin, norm=norm)
     #Axis size
-    plt.axis([x.min(), x.max(), y.min(), y.max()])
-    plt.axis('off')
-    plt.savefig(filename+'.jpeg')
-    plt.close(im)
+    ax.axis([x.min(), x.max(), y.min(), y.max()])
+    ax.axis('off')
+    im.savefig(filename+'.jpeg')
 
 
 
@@ -246,41 +249,54 @@ def fits2jpeg(fitsfilename,contrast=99.9,cmap='jet',chans=None,imchans=False,for
         print('Specified fits file does not exist')
         sys.exit(-1)
     outname = os.path.splitext(fitsfilename)[0]
-    #open file in pyfits. ANd get the image plane(s) and the header
-    datahdu = pyfits.open(fitsfilename)
+    #open file in pyfits memory mapped, scaling is applied per plane as read
+    datahdu = pyfits.open(fitsfilename, memmap=True, do_not_scale_image_data=True)
     imageheader = datahdu[0].header
     allimagedata = datahdu[0].data[0]
-    #make a masked array to remove nans
-    allimagedata = np.ma.masked_array(allimagedata, np.isnan(allimagedata))
-    #Cut selected area
+    #Cut selected area, nothing is read until a plane is used
     xpixels = int(0.5*allimagedata.shape[1]*(1-area))
     ypixels = int(0.5*allimagedata.shape[2]*(1-area))
-    allimagedata=allimagedata[:,xpixels:allimagedata.shape[1]-xpixels,ypixels:allimagedata.shape[2]-ypixels]
     #cut out desired area
     chan_range = chans
     if not chan_range: 
-        imagedata=allimagedata
-        chan_range='1,'+str(imagedata.shape[0])
+        chan_range='1,'+str(allimagedata.shape[0])
     chan_range = str(chan_range).split(',')
     # Get the desired subset of the fits file to converty to jpeg
-    if len(chan_range)==1: imagedata = allimagedata[int(chan_range[0])-1:int(chan_range[0])]
-    else: imagedata = allimagedata[int(chan_range[0])-1:int(chan_range[1])-1]    
+    if len(chan_range)==1: planes = range(int(chan_range[0])-1,int(chan_range[0]))
+    else: planes = range(int(chan_range[0])-1,int(chan_range[1])-1)
+    def readplane(num):
+        """Read cropped plane num as a masked array with NaNs masked"""
+        plane = np.array(allimagedata[num,xpixels:allimagedata.shape[1]-xpixels,ypixels:allimagedata.shape[2]-ypixels], dtype=np.float32)
+        bscale, bzero = imageheader.get('BSCALE',1.0), imageheader.get('BZERO',0.0)
+        if bscale!=1.0 or bzero!=0.0: plane = plane*bscale+bzero
+        return np.ma.masked_array(plane, np.isnan(plane))
     # This will work on pipeline images- but needs to be reworked to work on any image you want
-    # Loop over every channel and produce a jpeg for each one if the user asks
-    if len(chan_range)>1:
-    	if imchans==True or imageheader['CTYPE3'] != 'FREQ':
- 	       	[writejpeg(imageplane,outname+'_'+str(num+int(chan_range[0])),float(contrast),cmap) for num,imageplane in enumerate(imagedata)]             
-    if len(chan_range)==1:
-    	if imchans==True or imageheader['CTYPE3'] != 'FREQ':
-    		writejpeg(imagedata[0],outname,float(contrast),cmap)                 
-    # Do a weighted or straight average image only if image cube or forced average 
-    if forceaverage==True or imageheader['CTYPE3'] == 'FREQ':
-        # Set a dummy weight array if not doing weights
-        weightarray = np.ones(imagedata.shape[0])
-        # Recompute weights if the user askes for variance weights
-        if weightaverage==True : weightarray = [get_background_variance(imageplane.flatten()) for imageplane in imagedata]
+    # Planes are read one at a time for individual jpegs and the average
+    writeplanes = imchans==True or imageheader['CTYPE3'] != 'FREQ'
+    average = forceaverage==True or imageheader['CTYPE3'] == 'FREQ'
+    sumdata = None
+    for num,plane in enumerate(planes):
+        imageplane = readplane(plane)
+        # Write a jpeg for each channel if the user asks
+        if writeplanes:
+            if len(chan_range)>1: writejpeg(imageplane,outname+'_'+str(num+int(chan_range[0])),float(contrast),cmap)
+            else: writejpeg(imageplane,outname,float(contrast),cmap)
+        # Accumulate a weighted or straight average image only if image cube or forced average
+        if average:
+            # Set a dummy weight if not doing weights, else variance weights
+            weight = 1.0
+            if weightaverage==True : weight = get_background_variance(imageplane.flatten())
+            if sumdata is None:
+                sumdata = np.zeros(imageplane.shape)
+                valid = np.zeros(imageplane.shape, dtype=bool)
+                sumweight = 0.0
+            # Masked pixels add nothing but the weight is counted, as np.average
+            sumdata += weight*imageplane.filled(0.0)
+            valid |= ~np.ma.getmaskarray(imageplane)
+            sumweight += weight
+    if sumdata is not None:
         #Compute the average
-        avdata = np.average(imagedata,axis=0,weights=weightarray)
+        avdata = np.ma.masked_array(sumdata/sumweight, ~valid)
         #Write out the averaged image
         writejpeg(avdata,outname,contrast,cmap)
     datahdu.close()
@@ -18,6 +18,10 @@ from PipeUtil import getStartStopTime, getSVNVersion, printMess
 from PipeUtil import AllDest, FetchObject, SaveObject, XMLAddDescription, XMLSetAttributes
 import os, os.path, re, math, copy, pprint, string
 import sys
+import time
+import queue
+import threading
+import concurrent.futures
 import numpy as np
 import itertools
 import datetime
@@ -26,6 +30,14 @@ import katpoint
 import katdal
 from ObitTalkUtil import FITSDir
 from .KATImExceptions import KATUnimageableError
+from .KATH5toAIPS import get_time_slices
+from . import KATTableUtil
+from . import KATReport
+from . import KATExport
+
+# Next TEMP.AV sequence number tried by KATSplatandUVFITS, guarded by _splatLock
+_splatSeq = 1
+_splatLock = threading.Lock()
 
 manifest = { 'project' : [],  # list of project output files
              'source'  : {} } # dict of source output files
@@ -251,6 +263,7 @@ def KATInitContParms():
     parms["solAInt"]     = 1.0           # amp+phase self cal solution interval (min)
     parms["nTaper"]      = 0            # Number of additional imaging multiresolution tapers
     parms["Tapers"]      = [0.0]        # List of tapers in pixels
+    parms["maxConcurrent"] = 1          # Max. number of targets imaged at once
     parms["do3D"]        = False         # Make ref. pixel tangent to celest. sphere for each facet
     parms["noNeg"]       = False        # F=Allow negative components in self cal model
     parms["BLFact"]      = 1.01         # Baseline dependent time averaging
@@ -287,6 +300,7 @@ def KATInitContParms():
     parms["doSNPlot"]      =  True       # Plot SN tables etc
     parms["doDiagPlots"]   =  True       # Plot single source diagnostics
     parms["doKntrPlots"]   =  False      # Contour plots
+    parms["nReportWorkers"] = 2          # Report jobs run at once in the background
     parms["doMetadata"]    =  True       # Save source and project metadata
     parms["doHTML"]        =  True       # Output HTML report
     parms["doVOTable"]     =  True       # VOTable
@@ -417,7 +431,8 @@ def KATh5Select(katdata, parms, err, **kwargs):
         err: OErr.OErr()
             Obit error message stack object
         **kwargs:
-            Currently can only pass in targets as a kwarg and delay_katdata if doing polcal 
+            Currently can only pass in targets, dropants, flag, loadhalf, chanav and
+            channel_range as kwargs and delay_katdata if doing polcal
 
     Raises
     ------
@@ -462,6 +477,10 @@ def KATh5Select(katdata, parms, err, **kwargs):
     if kwargs.get('flag'):
         katdata.select(flags='cam,data_lost,ingest_rfi,predicted_rfi', reset='')
 
+    # Parallel hands only
+    if kwargs.get('loadhalf'):
+        katdata.select(pol=['HH','VV'], reset='')
+
     included_targets = []
     included_bpcals = []
     included_gaincals = []
@@ -506,9 +525,10 @@ def KATh5Select(katdata, parms, err, **kwargs):
             parms["EChDrop"]=EChanFracDrop
         first_chan=parms["BChDrop"]
         last_chan=katdata.shape[1]-parms["EChDrop"]
-    chan_after_ifs=(last_chan-first_chan +1)%8
+    chanav=kwargs.get('chanav', 1)
+    chan_after_ifs=(last_chan-first_chan +1)%(8*chanav)
     if chan_after_ifs!=0:
-        #Ensure number of channels divides into number of IFs
+        #Ensure number of (averaged) channels divides into number of IFs
         first_chan=first_chan+(chan_after_ifs//2)
         last_chan=last_chan-(chan_after_ifs-(chan_after_ifs//2))
         msg = "Trimming %s channnels to divide band into 8 even sized IFs"% (chan_after_ifs,)
@@ -786,6 +806,10 @@ def KATGetBadAnts(obsdata,specrange):
     from the Auto-Correlations on the highest elevation scan from selected targets 
     and looking for outliers using the median absolute deviation.
 
+    The scan is chosen from the target elevation at the scan timestamps, then
+    only its auto-correlation products are read, a time chunk at a time,
+    accumulating the weighted average amplitudes.
+
     Inputs: 
     obsdata: metadata dict from KATH5toAIPS 
     specrange: tuple selecting minimum and maximum channels to use
@@ -796,8 +820,9 @@ def KATGetBadAnts(obsdata,specrange):
     
     katdata=obsdata["katdata"]
     targs = obsdata["bpcal"]
-    # Get data from the highest elevation scan from checktargs in katdata
+    # Get the highest elevation scan from checktargs in katdata
     el=0
+    best=None
     #Exit gracefully if we don't have anything to check
     if len(targs)==0:
         return []
@@ -808,19 +833,31 @@ def KATGetBadAnts(obsdata,specrange):
             thisel = target.azel(tm[int(nint/2)])[1]*180./math.pi
             if thisel > el:
                 # Highest elevation so far
-                el  = thisel
-                vis = katdata.vis[:]
-                wt  = katdata.weights()[:]
-                # Apply flags
-                wt  = np.where(katdata.flags()[:],0.0,wt)
+                el   = thisel
+                best = scan
+    if best is None:
+        return []
+
+    # AutoCorr and not cross pol products
+    blIndex = obsdata['blIndex']
+    autos = np.nonzero((blIndex.prod_ants[:,0]==blIndex.prod_ants[:,1]) & (blIndex.prod_pol<2))[0]
+    sumvis = np.zeros(len(autos))
+    sumwt  = np.zeros(len(autos))
+    chans  = slice(specrange[0],specrange[1])
+    for scan, state, target in katdata.scans():
+        if scan != best:
+            continue
+        for ts in get_time_slices(katdata, 0, len(katdata.timestamps)):
+            vis = katdata.vis[ts,chans,autos]
+            wt  = katdata.weights[ts,chans,autos]
+            # Apply flags
+            wt  = np.where(katdata.flags[ts,chans,autos],0.0,wt)
+            sumvis += (np.abs(vis)*wt).sum(axis=(0,1))
+            sumwt  += wt.sum(axis=(0,1))
 
     pol_data = np.zeros((len(obsdata['ants']),2))
     # Get stokes I for the chosen scan on each antenna
-    for corrnum,corrprod in enumerate(obsdata['products']):
-        #AutoCorr and not cross pol
-        if corrprod[0]==corrprod[1] and corrprod[2]<2:
-            avvis = np.average(np.abs(vis[:,specrange[0]:specrange[1],corrnum]),weights=wt[:,specrange[0]:specrange[1],corrnum])
-            pol_data[corrprod[0]-1,corrprod[2]]=avvis
+    pol_data[blIndex.prod_ants[autos,0],blIndex.prod_pol[autos]] = sumvis/np.where(sumwt>0.0,sumwt,1.0)
 
     stokesI = pol_data[:,0] + pol_data[:,1]
     
@@ -831,9 +868,10 @@ def KATGetBadAnts(obsdata,specrange):
     # Reject antennas >10MAD'S from the median
     rejectList=[]
     cutoff=medI - (10.0*MAD)
-    for antnum,thisI in enumerate(stokesI):
+    for antind,thisI in enumerate(stokesI):
         if thisI<cutoff:
-            rejectList.append({"timer":("0/00:00:0.0","5/00:00:0.0"),"Ant":[antnum+1 ,0],"IFs":[1,1],"Chans":[0,0], "Stokes":'1111',"Reason":"Bad Ant"})
+            antnum = obsdata['ants'][antind][0]
+            rejectList.append({"timer":("0/00:00:0.0","5/00:00:0.0"),"Ant":[antnum ,0],"IFs":[1,1],"Chans":[0,0], "Stokes":'1111',"Reason":"Bad Ant"})
             
     return rejectList
 
@@ -1418,10 +1456,13 @@ def KATUVFITab(inUV, filename, outDisk, err, compress=False, \
 def KATSplatandUVFITS(inUV, filename, outDisk, err, logfile=""):
     """
     Splat the highest SN table into inUV and write it out as a uvfits file
+
+    Each call uses its own TEMP.AV sequence numbers so several can run at once.
     """
 
     #Make copy of inUV
-    tempUV = UV.newPAUV("TEMP UV DATA", "TEMP", "AV", 1, 1, False, err)
+    seq = _SplatSeq(1)
+    tempUV = UV.newPAUV("TEMP UV DATA", "TEMP", "AV", 1, seq, False, err)
     if err.isErr:
         OErr.printErrMsg(err, "Error creating UV data")
     # Clone
@@ -1474,10 +1515,24 @@ def KATSplatandUVFITS(inUV, filename, outDisk, err, logfile=""):
     tempUV = UV.newPAUV("TEMP UV DATA", "TEMP", "AV", 1, newseq, True, err)
 
     # Put splatted data to disk in uvfits file
-    KATUVFITS(tempUV,filename, outDisk, err, logfile=logfile)
+    KATExport.ExportUV(tempUV, [("fittp", filename)], err, logfile=logfile)
     tempUV.Zap(err)
     return
 
+def _SplatSeq(disk):
+    """ First of two free TEMP.AV sequence numbers, not used by another call """
+    global _splatSeq
+    user = OSystem.PGetAIPSuser()
+    err = OErr.OErr()
+    with _splatLock:
+        while True:
+            seq = _splatSeq
+            _splatSeq += 2
+            if all(AIPSDir.PTestCNO(disk, user, "TEMP", "AV", "UV", s, err) <= 0 for s in (seq, seq+1)):
+                OErr.PClear(err)
+                return seq
+    # end _SplatSeq
+
 
 def EVLAUVFITSTab(inUV, filename, outDisk, err, \
               exclude=["AIPS HI", "AIPS AN", "AIPS FQ", "AIPS SL", "AIPS PL"], \
@@ -5094,28 +5149,10 @@ def EVLAGetSumCC(image, err, CCver=1,
     ver = image.GetHighVer("AIPS CC")
     if ver<1:
         return 0.0
-    CCTab = image.NewTable(Table.READONLY, "AIPS CC", CCver, err)
-    if err.isErr:
-        return 0.0
-    # Open
-    CCTab.Open(Table.READONLY, err)
-    if err.isErr:
+    cols, keys, rowInfo = KATTableUtil.CachedColumns(image, "AIPS CC", CCver, err)
+    if err.isErr or cols is None:
         return 0.0
-    # Number of rows
-    nrow    = CCTab.Desc.Dict["nrow"]
-    sum     = 0.0
-    # Loop over table
-    for irow in range (1, nrow+1):
-        CCrow = CCTab.ReadRow(irow, err)
-        if err.isErr:
-            return sum
-        sum += CCrow["FLUX"][0]
-    # End loop over table
-    # Close table
-    CCTab.Close(err)
-    if err.isErr:
-        return sum
-    return sum
+    return float(cols["FLUX"][:,0].sum())
     # end EVLAGetSumCC
 
 def EVLAGetTimes(uv, Source, err,
@@ -5141,62 +5178,26 @@ def EVLAGetTimes(uv, Source, err,
     uv.Open(UV.READONLY, err)
     uv.Close(err)
 
-    # Lookup Source ID (SouID)
-    SUtab = uv.NewTable(Table.READONLY, "AIPS SU", 1, err)
-    SUtab.Open(Table.READONLY, err)
-    if err.isErr:
+    # Lookup Source ID (SouID), last source if not found
+    if uv.GetHighVer("AIPS SU")<1:
         return  {"numVis":0, "Exposure":0.0, "RA":0.0, "Dec":0.0}
-    # Number of rows
-    nrow =  SUtab.Desc.Dict["nrow"]
-    for i in range (0,nrow):    # Loop over rows
-        SUrow = SUtab.ReadRow(i+1, err)
-        if err.isErr:
-            return  {"numVis":0, "Exposure":0.0, "RA":0.0, "Dec":0.0}
-        SouID = SUrow["ID. NO."][0]
-        RA    = SUrow["RAEPO"][0]
-        Dec   = SUrow["DECEPO"][0]
-        IFlux = SUrow["IFLUX"]
-        QFlux = SUrow["QFLUX"]
-        UFlux = SUrow["UFLUX"]
-        VFlux = SUrow["VFLUX"]
-        #if debug:
-        #    mess="Source "+Source+" test "+SUrow["SOURCE"][0]+" ID ="+str(SouID)+ \
-        #        " match="+str(SUrow["SOURCE"][0].rstrip()==Source.rstrip())
-        #    printMess(mess, logfile)
-        if SUrow["SOURCE"][0].rstrip()==Source.rstrip():   # This it?
-            break;
-    SUtab.Close(err)
-    if err.isErr:
-        return  {"numVis":0, "Exposure":0.0, "RA":RA, "Dec":Dec, \
-                 "IFlux":IFlux, "QFlux":QFlux, "UFlux":UFlux, "VFlux":VFlux}
+    SUcols, keys, rowInfo = KATTableUtil.CachedColumns(uv, "AIPS SU", 1, err)
+    if err.isErr or SUcols is None:
+        return  {"numVis":0, "Exposure":0.0, "RA":0.0, "Dec":0.0}
+    i = KATTableUtil.SourceIndex(uv, err).get(Source.rstrip(), len(SUcols["SOURCE"])-1)
+    SouID = int(SUcols["ID. NO."][i][0])
+    RA    = float(SUcols["RAEPO"][i][0])
+    Dec   = float(SUcols["DECEPO"][i][0])
+    IFlux = SUcols["IFLUX"][i].tolist()
+    QFlux = SUcols["QFLUX"][i].tolist()
+    UFlux = SUcols["UFLUX"][i].tolist()
+    VFlux = SUcols["VFLUX"][i].tolist()
 
     # get observing stats from AIPS NX table
     cntVis  = 0
     sumTime = 0.0
-    NXTab = uv.NewTable(Table.READONLY, "AIPS NX", 1, err)
-    if err.isErr:
-        return {"numVis":0, "Exposure":0.0, "RA":RA, "Dec":Dec, \
-                 "IFlux":IFlux, "QFlux":QFlux, "UFlux":UFlux, "VFlux":VFlux}
-    # Open
-    NXTab.Open(Table.READONLY, err)
-    if err.isErr:
-        return {"numVis":cntVis, "Exposure":sumTime, "RA":RA, "Dec":Dec, \
-                 "IFlux":IFlux, "QFlux":QFlux, "UFlux":UFlux, "VFlux":VFlux}
-    # Number of rows
-    nrow    = NXTab.Desc.Dict["nrow"]
-    # Loop over table
-    for irow in range (1, nrow+1):
-        NXrow = NXTab.ReadRow(irow, err)
-        if err.isErr:
-            return {"numVis":cntVis, "Exposure":sumTime, "RA":RA, "Dec":Dec, \
-                 "IFlux":IFlux, "QFlux":QFlux, "UFlux":UFlux, "VFlux":VFlux}
-        #  Is this the desired source?
-        if NXrow["SOURCE ID"][0]==SouID:
-            sumTime += NXrow["TIME INTERVAL"][0]
-            cntVis  += NXrow["END VIS"][0] - NXrow["START VIS"][0] + 1
-    # End loop over table
-    # Close table
-    NXTab.Close(err)
+    if uv.GetHighVer("AIPS NX")>=1:
+        cntVis, sumTime = KATTableUtil.NXSummary(uv, err).get(SouID, (0, 0.0))
     if err.isErr:
         return {"numVis":cntVis, "Exposure":sumTime, "RA":RA, "Dec":Dec, \
                  "IFlux":IFlux, "QFlux":QFlux, "UFlux":UFlux, "VFlux":VFlux}
@@ -5223,12 +5224,15 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
                      do3D=True, BLFact=0.999, BLchAvg=False, doOutlier=None, \
                      doMB=False, norder=2, maxFBW=0.05, doComRes=True, \
                      PBCor=True, antSize=12.0, nTaper=0, Tapers=[20.0], \
-                     sefd=500.0,
+                     sefd=500.0, maxConcurrent=1,
                      nThreads=1, noScrat=[], logfile='', check=False, debug=False):
     """
     Image a list of sources with optional selfcal
 
     Uses Imager or MFImage to image a list of sources.
+    Up to maxConcurrent sources are imaged at once, the nThreads threads
+    being shared between the tasks, each of which is given its own AIPS
+    scratch disks where there are enough (see ScratchAreas).
     Data must be at least approximately calibrated
     Returns task error code, 0=OK, else failed
 
@@ -5282,6 +5286,7 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
     * antSize    = antenna size (m) for PBCor
     * nTaper     = number of (additional) multi resolution tapers
     * Tapers     = Sizes of additional tapers in pixels
+    * maxConcurrent = Max. number of sources to image at once
     * nThreads   = Max. number of threads to use
     * noScrat    = list of disks to avoid for scratch files
     * logfile    = logfile for messages
@@ -5312,102 +5317,110 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
         slist = EVLAAllSource(uv,err,logfile=logfile,check=check,debug=debug)
     else:
         slist = sl
-    if doMB:
-        imager = ObitTask.ObitTask("MFImage")
-        try:
-            imager.userno = OSystem.PGetAIPSuser()   # This sometimes gets lost
-        except Exception as exception:
-            pass
-        imager.norder = norder
-        imager.maxFBW = maxFBW
-        imager.prtLv = 2
-    else:
-        imager = ObitTask.ObitTask("Imager")
-        imager.prtLv = 2
-        try:
-            imager.userno = OSystem.PGetAIPSuser()   # This sometimes gets lost
-        except Exception as exception:
-            pass
-    imager.taskLog  = logfile
-    if not check:
-        setname(uv,imager)
-    imager.outDisk     = imager.inDisk
-    #imager.outName     = "_"+band
-    imager.out2Name    = "_"+band
-    imager.out2Disk    = imager.inDisk
-    imager.outSeq      = seq
-    imager.out2Seq     = seq
-    imager.outClass    = sclass
-    imager.BLFact      = BLFact
-    imager.BLchAvg     = BLchAvg
-    imager.flagVer     = flagVer
-    imager.doCalib     = doCalib
-    imager.gainUse     = gainUse
-    imager.doBand      = doBand
-    imager.BPVer       = BPVer
-    imager.doPol       = doPol
-    if "PDVer" in imager.__dict__:
-        imager.PDVer = PDVer
-    imager.Stokes      = Stokes
-    imager.FOV         = FOV
-    imager.Robust      = Robust
-    imager.Niter       = Niter
-    imager.CCVer       = CCVer
-    imager.Gain        = CGain
-    imager.maxPSCLoop  = maxPSCLoop
-    imager.solPInt     = solPInt
-    imager.solPMode    = solPMode
-    imager.solPType    = solPType
-    imager.maxASCLoop  = maxASCLoop
-    imager.solAInt     = solAInt
-    imager.solAMode    = solAMode
-    imager.solAType    = solAType
-    imager.avgPol      = avgPol
-    imager.avgIF       = avgIF
-    imager.refAnt      = refAnt
-    imager.minSNR      = minSNR
-    imager.do3D        = do3D
-    imager.dispURL     = "None"
-    imager.PBCor       = PBCor
-    imager.antSize     = antSize
-    imager.nTaper      = nTaper
-    imager.Tapers      = Tapers
-    imager.xCells      = xCells
-    imager.yCells      = yCells
-    imager.nx          = nx
-    imager.ny          = ny
-    imager.noNeg       = noNeg
-    imager.Reuse       = Reuse
-    imager.minPatch    = minPatch
-    imager.OutlierSize = OutlierSize
-    imager.doGPU       = True
-    if doOutlier or ((doOutlier==None) and refFreq<6.0e9):
-        imager.OutlierDist = FOV*OutlierArea   # Outliers from NVSS/SUMMS for lower frequencies
-        if refFreq>1.0e9:
-            imager.OutlierFlux = 0.002
+    def _make_imager():
+        """ Imaging task with the settings common to all sources """
+        if doMB:
+            imager = ObitTask.ObitTask("MFImage")
+            try:
+                imager.userno = OSystem.PGetAIPSuser()   # This sometimes gets lost
+            except Exception as exception:
+                pass
+            imager.norder = norder
+            imager.maxFBW = maxFBW
+            imager.prtLv = 2
         else:
-            imager.OutlierFlux = 0.002
-    # Auto window or centered box
-    if CleanRad:
-        imager.CLEANBox=[-1,CleanRad,0,0]
-    else:
-        imager.autoWindow  = True
-    if "doComRes" in imager.__dict__:
-        imager.doComRes  = doComRes
-    imager.doComRes = True
-    imager.noScrat     = noScrat
-    imager.nThreads    = nThreads
-    imager.prtLv = 5
-    #imager.MFTaper = 
-    #imager.i
-    imager.debug = True
-    if debug:
+            imager = ObitTask.ObitTask("Imager")
+            imager.prtLv = 2
+            try:
+                imager.userno = OSystem.PGetAIPSuser()   # This sometimes gets lost
+            except Exception as exception:
+                pass
+        imager.taskLog  = logfile
+        if not check:
+            setname(uv,imager)
+        imager.outDisk     = imager.inDisk
+        #imager.outName     = "_"+band
+        imager.out2Name    = "_"+band
+        imager.out2Disk    = imager.inDisk
+        imager.outSeq      = seq
+        imager.out2Seq     = seq
+        imager.outClass    = sclass
+        imager.BLFact      = BLFact
+        imager.BLchAvg     = BLchAvg
+        imager.flagVer     = flagVer
+        imager.doCalib     = doCalib
+        imager.gainUse     = gainUse
+        imager.doBand      = doBand
+        imager.BPVer       = BPVer
+        imager.doPol       = doPol
+        if "PDVer" in imager.__dict__:
+            imager.PDVer = PDVer
+        imager.Stokes      = Stokes
+        imager.FOV         = FOV
+        imager.Robust      = Robust
+        imager.Niter       = Niter
+        imager.CCVer       = CCVer
+        imager.Gain        = CGain
+        imager.maxPSCLoop  = maxPSCLoop
+        imager.solPInt     = solPInt
+        imager.solPMode    = solPMode
+        imager.solPType    = solPType
+        imager.maxASCLoop  = maxASCLoop
+        imager.solAInt     = solAInt
+        imager.solAMode    = solAMode
+        imager.solAType    = solAType
+        imager.avgPol      = avgPol
+        imager.avgIF       = avgIF
+        imager.refAnt      = refAnt
+        imager.minSNR      = minSNR
+        imager.do3D        = do3D
+        imager.dispURL     = "None"
+        imager.PBCor       = PBCor
+        imager.antSize     = antSize
+        imager.nTaper      = nTaper
+        imager.Tapers      = Tapers
+        imager.xCells      = xCells
+        imager.yCells      = yCells
+        imager.nx          = nx
+        imager.ny          = ny
+        imager.noNeg       = noNeg
+        imager.Reuse       = Reuse
+        imager.minPatch    = minPatch
+        imager.OutlierSize = OutlierSize
+        imager.doGPU       = True
+        if doOutlier or ((doOutlier==None) and refFreq<6.0e9):
+            imager.OutlierDist = FOV*OutlierArea   # Outliers from NVSS/SUMMS for lower frequencies
+            if refFreq>1.0e9:
+                imager.OutlierFlux = 0.002
+            else:
+                imager.OutlierFlux = 0.002
+        # Auto window or centered box
+        if CleanRad:
+            imager.CLEANBox=[-1,CleanRad,0,0]
+        else:
+            imager.autoWindow  = True
+        if "doComRes" in imager.__dict__:
+            imager.doComRes  = doComRes
+        imager.doComRes = True
+        imager.noScrat     = noScrat
+        imager.nThreads    = nThreads
         imager.prtLv = 5
-        imager.i
-        imager.debug = debug
-    OK = False   # Some must work
-    # Loop over slist
-    for sou in slist:
+        #imager.MFTaper = 
+        #imager.i
+        imager.debug = True
+        if debug:
+            imager.prtLv = 5
+            imager.i
+            imager.debug = debug
+        return imager
+
+    def _image_source(sou, scratch, err):
+        """ Image one source, returns True if the imaging worked """
+        imager = _make_imager()
+        imager.noScrat  = scratch
+        imager.nThreads = taskThreads
+        ok = False
+        start = time.time()
         sou=sou.replace(' ','_')         # Just in case a stray space in a source name has made it to here
         #suinfo = EVLAGetTimes(uv, sou, err, logfile=logfile, check=check,debug=debug)
         #if doOutlier or ((doOutlier==None) and refFreq<6.0e9):
@@ -5473,7 +5486,7 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
             # Cleanup image mess
             AllDest(err,Atype="MA",Aname=imager.Sources[0][0:12], disk=imager.outDisk, Aseq=imager.outSeq);
         else:
-            OK = True
+            ok = True
         #u = UV.newPAUV("Self-calibrated uv data", out2Name, out2Class, imager.out2Disk, imager.out2Seq, False, err)
 
         # delete Imager file if not debug
@@ -5497,7 +5510,7 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
 
                     #KATUVFITS(u, filename, 0, err, exclude=["AIPS HI", "AIPS SL", "AIPS PL"], include=["AIPS AN", "AIPS FQ"], compress=False, logfile=logfile)
                     filename = sou+'_selfCal.uvtab'
-                    KATUVFITab(u, filename, 0, err)
+                    KATExport.ExportUV(u, [("fitab", filename)], err, logfile=logfile)
                     #KATSplatandUVFITS(u, sou+'_selfCal.uv', 0, err, logfile=logfile)
                     if UV.PIsA(u):
                         u.Zap(err) # cleanup
@@ -5507,14 +5520,41 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
                         #return 1
                     del u
             except Exception as exception:
-                print(exception)
-                mess = "Imager Cleanup Failed source= "+imager.Sources[0].strip()+"_"+band
+                mess = "Imager Cleanup Failed source= "+imager.Sources[0].strip()+"_"+band+": "+repr(exception)
                 printMess(mess, logfile)
                 OErr.PClear(err)     # Clear any message/error
                 #return 1  Allow some failures
             else:
                 pass
-    # end loop over sources
+        mess = "Imaged %s in %.1f s" % (sou, time.time()-start)
+        printMess(mess, logfile)
+        return ok
+        # end _image_source
+
+    # Run up to maxConcurrent imaging tasks, each on its own scratch disks
+    nConcurrent = max(1, min(maxConcurrent, len(slist)))
+    taskThreads = max(1, nThreads // nConcurrent)
+    if nConcurrent == 1:
+        results = [_image_source(sou, noScrat, err) for sou in slist]
+    else:
+        mess = "Imaging %d sources, %d at a time with %d threads each" % \
+            (len(slist), nConcurrent, taskThreads)
+        printMess(mess, logfile)
+        slots = queue.Queue()
+        for scratch in ScratchAreas(nConcurrent, noScrat):
+            slots.put(scratch)
+        def _run(sou):
+            # Each task takes a free scratch area and has its own error stack
+            scratch = slots.get()
+            terr = OErr.OErr()
+            try:
+                return _image_source(sou, scratch, terr)
+            finally:
+                OErr.printErr(terr)
+                slots.put(scratch)
+        with concurrent.futures.ThreadPoolExecutor(nConcurrent) as pool:
+            results = list(pool.map(_run, slist))
+    OK = any(results)   # Some must work
     # Something work?
     if not OK:
         printMess("All images failed", logfile)
@@ -5523,6 +5563,31 @@ def KATImageTargets(uv, err, Sources=None,  FreqID=1, seq=1, sclass="IClean", ba
     return
     # end EVLAImageTargets
 
+def ScratchAreas(nArea, noScrat=[]):
+    """
+    Divide the AIPS disks usable for scratch files between tasks
+
+    Returns a list of nArea noScrat lists, each of which leaves a different
+    set of the disks not in noScrat for scratch files. If there are fewer
+    usable disks than areas the disks are shared round robin.
+
+    * nArea      = Number of scratch areas wanted
+    * noScrat    = list of disks to avoid for scratch files
+    """
+    ################################################################
+    usable = [disk for disk in range(1, AIPSDir.nAIPS+1) if disk not in noScrat]
+    if len(usable)<=1:
+        return [list(noScrat) for area in range(nArea)]
+    areas = []
+    for area in range(nArea):
+        if nArea<=len(usable):
+            use = usable[area::nArea]
+        else:
+            use = [usable[area%len(usable)]]
+        areas.append(list(noScrat) + [disk for disk in usable if disk not in use])
+    return areas
+    # end ScratchAreas
+
 
 def EVLAAllSource(uv, err, \
                logfile='', check=False, debug=False):
@@ -5550,31 +5615,16 @@ def EVLAAllSource(uv, err, \
         return allSou
     mess = "List of sources in database"
     printMess(mess, logfile)
-    SUTab = uv.NewTable(Table.READONLY, "AIPS SU", 1, err)
-    if err.isErr:
+    SUcols, keys, rowInfo = KATTableUtil.CachedColumns(uv, "AIPS SU", 1, err)
+    if err.isErr or SUcols is None:
         return allSou
-    # Open
-    SUTab.Open(Table.READONLY, err)
-    if err.isErr:
-        return allSou
-    # Number of rows
-    nrow =  SUTab.Desc.Dict["nrow"]
     if debug:
-        mess = str(nrow)+" sources in database"
+        mess = str(len(SUcols["SOURCE"]))+" sources in database"
         printMess(mess, logfile)
-    for i in range (0,nrow):    # Loop over rows
-        SUrow = SUTab.ReadRow(i+1, err)
-        if err.isErr:
-            return
-        allSou.append(SUrow["SOURCE"][0].strip())
-        mess = "Source("+str(i+1)+") = "+SUrow["SOURCE"][0]
+    for i, name in enumerate(SUcols["SOURCE"]):
+        allSou.append(name[0].strip())
+        mess = "Source("+str(i+1)+") = "+name[0]
         printMess(mess, logfile)
-    # end loop over rows
-
-    # Close table
-    SUTab.Close(err)
-    if err.isErr:
-        return allSou
     return allSou
     # end EVLAAllSource
 
@@ -6058,54 +6108,14 @@ def EVLAFlagFailSN(uv, SNver, err, \
         snver = SNver;
     mess = "Failed solutions in SN %d flagged in FG %d" % (snver,FGver)
     printMess(mess, logfile)
-    fblank = FArray.PGetBlank() # Magic blanking value
-    # Number of IFs
-    nif   = uv.Desc.Dict["inaxes"][uv.Desc.Dict["jlocif"]]
-    # Number of Stokes
-    npoln = uv.Desc.Dict["inaxes"][uv.Desc.Dict["jlocs"]]
-    SNTab = uv.NewTable(Table.READONLY, "AIPS SN", SNver, err, \
-                        numIF=nif, numPol=npoln)
-    if err.isErr:
+    cols, rowInfo, amps, valid = _SNColumns(uv, snver, err)
+    if err.isErr or cols is None:
         return
-    # Open
-    SNTab.Open(Table.READWRITE, err)
-    if err.isErr:
-        return
-    # Number of rows
-    nrow =  SNTab.Desc.Dict["nrow"]
-    count = 0; total = 0
-    for i in range (0,nrow):    # Loop over rows
-        SNrow = SNTab.ReadRow(i+1, err)
-        if err.isErr:
-            return
-        dirty = False
-        # Loop over IF
-        for iif in range (0, nif):
-            total += 1
-            if (SNrow["WEIGHT 1"][iif]<=0.0) or (SNrow["REAL1"][iif]==fblank):
-                # Flag table?
-                EVLAFlagSNClip(uv, SNrow, iif+1, 1, err, FGver=FGver, reason="Failed soln", \
-                               logfile=logfile, check=check, debug=debug)
-                count += 1
-                dirty = True
-            # Second Poln
-            if npoln>1:
-                total += 1
-            if (npoln>1) and (SNrow["WEIGHT 2"][iif]<=0.0) or (SNrow["REAL2"][iif]==fblank):
-                # Flag table?
-                EVLAFlagSNClip(uv, SNrow, iif+1, 2, err, FGver=FGver, reason="Failed soln", \
-                               logfile=logfile, check=check, debug=debug)
-                count += 1
-                dirty = True
-       # Rewrite if modified
-        if dirty and not check:
-            SNTab.WriteRow(i+1, SNrow, err)
-            if err.isErr:
-                return
-    # end loop over rows
-
-    # Close table
-    SNTab.Close(err)
+    # Failed - either zero weight or blanked
+    failed = ~valid
+    count = int(failed.sum()); total = failed.size
+    _SNFlags(uv, cols, amps, failed, err, FGver=FGver, reason="Failed soln", \
+             logfile=logfile, check=check, debug=debug)
     if err.isErr:
         return
 
@@ -6129,62 +6139,25 @@ def EVLASNAmpStats(uv, SNver, err, logfile='', check=False, debug=False):
     * debug      = Only debug - no effect
     """
     ################################################################
-    fblank = FArray.PGetBlank() # Magic blanking value
     # Number of IFs
     nif   = uv.Desc.Dict["inaxes"][uv.Desc.Dict["jlocif"]]
-    # Number of Stokes
-    npoln = uv.Desc.Dict["inaxes"][uv.Desc.Dict["jlocs"]]
-    npoln = min(2, npoln)   # No more than 2
-    SNtab = uv.NewTable(Table.READONLY, "AIPS SN", SNver, err, \
-                        numIF=nif, numPol=npoln)
-    if err.isErr:
-        return None
-    # Open
-    SNtab.Open(Table.READWRITE, err)
+    cols, rowInfo, amps, valid = _SNColumns(uv, SNver, err)
     if err.isErr:
         return None
-    # Number of SN rows
-    nrow =  SNtab.Desc.Dict["nrow"]
-    # Initialize accumulators, 1 per IF
-    # Each a list of amplitudes
-    amps = []
-    for i in range(0,nif):
-        amps.append([])
-    for i in range (0,nrow):    # Loop over rows
-        SNrow = SNtab.ReadRow(i+1, err)
-        if err.isErr:
-            return None
-        for iif in range(0,nif):
-            if (SNrow["WEIGHT 1"][iif]>0.0) and (SNrow["REAL1"][iif]!=fblank):
-                amp = (SNrow["REAL1"][iif]**2+SNrow["IMAG1"][iif]**2)**0.5
-                amps[iif].append(amp)
-            if (npoln>1) and (SNrow["WEIGHT 2"][iif]>0.0) and (SNrow["REAL2"][iif]!=fblank):
-                amp = (SNrow["REAL2"][iif]**2+SNrow["IMAG2"][iif]**2)**0.5
-                amps[iif].append(amp)
-        # end IF loop
-    # End loop over table
+    if cols is None:
+        return [None]*nif
 
-    # Close table
-    SNtab.Close(err)
-    if err.isErr:
-        return None
-
-   # Sort lists, get median, inner RMS
+   # Sort amplitudes per IF, get median, inner RMS
     out = []   # Initialize output
     for iif in range(0,nif):
-        if len(amps[iif])>3:   # Need a min. amount of data
-            amps[iif].sort()
-            num  = len(amps[iif])
-            medn = amps[iif][num//2]
-            # inner half RMS about median
+        a = np.sort(amps[:,:,iif][valid[:,:,iif]])
+        num = a.size
+        if num>3:   # Need a min. amount of data
+            medn = a[num//2]
+            # inner RMS about median
             b = num//10; e = 9*num//10;
-            sum2 = 0.0; count = 0
-            for i in range(b,e+1):
-                val    = amps[iif][i]-medn
-                sum2  += val*val
-                count += 1
-            RMS = (sum2/count)**0.5
-            out.append((medn,RMS))
+            RMS = float(np.sqrt(np.mean((a[b:e+1]-medn)**2)))
+            out.append((float(medn),RMS))
         else:
             out.append(None)   # Too little
     # end IF loop
@@ -6211,72 +6184,117 @@ def EVLAClipSNAmp(uv, SNver, arange, err, \
     """
     ################################################################
     fblank = FArray.PGetBlank() # Magic blanking value
-    # Number of IFs
-    nif   = uv.Desc.Dict["inaxes"][uv.Desc.Dict["jlocif"]]
-    # Number of Stokes
-    npoln = uv.Desc.Dict["inaxes"][uv.Desc.Dict["jlocs"]]
-    SNTab = uv.NewTable(Table.READONLY, "AIPS SN", SNver, err, \
-                        numIF=nif, numPol=npoln)
-    if err.isErr:
+    cols, rowInfo, amps, valid = _SNColumns(uv, SNver, err)
+    if err.isErr or cols is None:
         return
-    # Open
-    SNTab.Open(Table.READWRITE, err)
+    npoln, nrow, nif = amps.shape
+    # Allowed range per IF, IFs without one are not clipped
+    amin = np.full(nif, -np.inf); amax = np.full(nif, np.inf)
+    use = np.zeros(nif, dtype=bool)
+    for iif in range(0,nif):
+        if arange[iif]!=None:
+            amin[iif], amax[iif] = arange[iif][0], arange[iif][1]
+            use[iif] = True
+    valid &= use
+    bad = valid & ((amps<amin) | (amps>amax))
+    count = int(bad.sum()); total = int(valid.sum())
+    # Flag table?
+    _SNFlags(uv, cols, amps, bad, err, FGver=FGver, \
+             logfile=logfile, check=check, debug=debug)
     if err.isErr:
         return
-    # Number of rows
-    nrow =  SNTab.Desc.Dict["nrow"]
-    count = 0; total = 0
-    for i in range (0,nrow):    # Loop over rows
-        SNrow = SNTab.ReadRow(i+1, err)
+    # Blank clipped solutions, rewrite modified rows
+    for ipol in range(0,npoln):
+        p = str(ipol+1)
+        cols["REAL"+p][bad[ipol]]      = fblank
+        cols["IMAG"+p][bad[ipol]]      = fblank
+        cols["WEIGHT "+p][bad[ipol]]   = 0.0
+    if not check:
+        rows = np.nonzero(bad.any(axis=(0,2)))[0]
+        KATTableUtil.UpdateRows(uv, "AIPS SN", SNver, cols, rowInfo, rows, err, \
+                                numIF=nif, numPol=npoln)
         if err.isErr:
             return
-        dirty = False
-        # Loop over IF
-        for iif in range (0, nif):
-            if arange[iif]!=None:
-                amin = arange[iif][0]
-                amax = arange[iif][1]
-                if (SNrow["WEIGHT 1"][iif]>0.0) and (SNrow["REAL1"][iif]!=fblank):
-                    total += 1
-                    amp = (SNrow["REAL1"][iif]**2+SNrow["IMAG1"][iif]**2)**0.5
-                    if (amp<amin) or (amp>amax):
-                        # Flag table?
-                        EVLAFlagSNClip(uv, SNrow, iif+1, 1, err, FGver=FGver, \
-                                       logfile=logfile, check=check, debug=debug)
-                        SNrow["REAL1"][iif]    = fblank
-                        SNrow["IMAG1"][iif]    = fblank
-                        SNrow["WEIGHT 1"][iif] = 0.0
-                        count += 1
-                        dirty = True
-                # Second Poln
-                if (npoln>1) and (SNrow["WEIGHT 2"][iif]>0.0) and (SNrow["REAL2"][iif]!=fblank):
-                    total += 1
-                    amp = (SNrow["REAL2"][iif]**2+SNrow["IMAG2"][iif]**2)**0.5
-                    if (amp<amin) or (amp>amax):
-                        # Flag table?
-                        EVLAFlagSNClip(uv, SNrow, iif+1, 2, err, FGver=FGver, \
-                                       logfile=logfile, check=check, debug=debug)
-                        SNrow["REAL2"][iif]    = fblank
-                        SNrow["IMAG2"][iif]    = fblank
-                        SNrow["WEIGHT 2"][iif] = 0.0
-                        count += 1
-                        dirty = True
-       # Rewrite if modified
-        if dirty and not check:
-            SNTab.WriteRow(i+1, SNrow, err)
-            if err.isErr:
-                return
-  # end loop over rows
-
-    # Close table
-    SNTab.Close(err)
-    if err.isErr:
-        return
 
     mess = "Flagged %d of total %d Gain entries" % (count, total)
     printMess(mess, logfile)
     # end EVLAClipSNAmp
 
+def _SNColumns(uv, SNver, err):
+    """
+    Read an SN table into columns with solution amplitudes
+
+    Returns (cols, rowInfo, amps, valid), all None if the table is empty,
+    where amps and valid are (npoln, nrow, nIF) arrays of the amplitudes
+    and of the solutions with positive weight that are not blanked.
+    * uv         = UV data object
+    * SNver      = SN table to read
+    * err        = Python Obit Error/message stack
+    """
+    ################################################################
+    fblank = FArray.PGetBlank() # Magic blanking value
+    cols, keys, rowInfo = KATTableUtil.ReadColumns(uv, "AIPS SN", SNver, err)
+    if err.isErr or cols is None:
+        return None, None, None, None
+    npoln = 2 if "REAL2" in cols else 1
+    real  = np.stack([cols["REAL%d" % (p+1)] for p in range(npoln)])
+    imag  = np.stack([cols["IMAG%d" % (p+1)] for p in range(npoln)])
+    wt    = np.stack([cols["WEIGHT %d" % (p+1)] for p in range(npoln)])
+    valid = (wt>0.0) & (real!=fblank)
+    amps  = np.sqrt(real**2 + imag**2)
+    return cols, rowInfo, amps, valid
+    # end _SNColumns
+
+def _SNFlags(uv, cols, amps, sel, err, \
+             FGver=-1, reason="BadAmp", logfile='', check=False, debug=False):
+    """
+    Write flag table entries for selected SN table solutions
+
+    The flags of a solution cover its time plus and minus its interval for
+    its antenna, IF and polarization. Flags abutting or overlapping in time
+    or IF are merged before being appended to the FG table at once.
+    Returns with err set on error
+
+    * uv         = UV data object
+    * cols       = SN table columns from _SNColumns
+    * amps       = (npoln, nrow, nIF) solution amplitudes from _SNColumns
+    * sel        = (npoln, nrow, nIF) bool array of solutions to flag
+    * err        = Python Obit Error/message stack
+    * FGver      = FG table to add flags to, <=0 ->none
+    * reason     = reason string
+    * logfile    = logfile for messages
+    * check      = Only check script
+    * debug      = Only debug
+    """
+    ################################################################
+    if FGver<=0:   # Anthing wanted?
+        return
+    ipol, irow, iif = np.nonzero(sel)
+    time  = cols["TIME"][irow,0]; dt = cols["TIME INTERVAL"][irow,0]
+    ant   = cols["ANTENNA NO."][irow,0]
+    zero  = np.zeros_like(ant)
+    # Stokes flag bits "1011" for first poln, "0111" for second
+    flags = {"ants":np.stack([ant,zero],axis=1),
+             "times":np.stack([time-dt,time+dt],axis=1),
+             "ifs":np.stack([iif+1,iif+1],axis=1),
+             "chans":np.stack([zero,zero],axis=1),
+             "pflags":np.where(ipol==0, 13, 14)}
+    if debug:
+        sid = cols["SOURCE ID"][irow,0]
+        for i in range(len(irow)):
+            mess = "Flag SID %d Ant %d IF %d Poln %d Timerange %s - %s amp %f" % \
+                   (sid[i], ant[i], iif[i]+1, ipol[i]+1, day2dhms(time[i]-dt[i]), \
+                    day2dhms(time[i]+dt[i]), amps[ipol[i],irow[i],iif[i]])
+            printMess(mess, logfile)
+    flags = KATTableUtil.MergeFlags(flags)
+    if not check:
+        KATTableUtil.AppendFlags(uv, flags, err, flagVer=FGver, reason=reason)
+    if err.isErr:
+        return
+    mess = "%d flagged solutions written as %d FG %d entries" % (len(irow), len(flags["ants"]), FGver)
+    printMess(mess, logfile)
+    # end _SNFlags
+
 def EVLAFlagSNClip(uv, SNrow, IFno, poln, err, \
                FGver=-1, reason="BadAmp", logfile='', check=False, debug=False):
     """
@@ -7763,19 +7781,10 @@ def EVLAKntrPlots( err, catNos=[], imClass='?Clean', imName=[], project='tProj',
             EVLAAddOutFile( outfile, name, "Contour plot" )
 
         # Convert 1st page of PS (Stokes I) to JPG
-        tmpPS, tmpPDF, jpg = ['%s.%s' % (os.path.splitext(outfile)[0], file_ext) for file_ext in ['ps', 'pdf', 'jpg']]
+        jpg = os.path.splitext(outfile)[0]+'.jpg'
         printMess('Converting '+outfile+' (1st page) -> '+jpg,logfile)
-        # Extract first page of PS; Convert to PDF; Convert to JPG
-        # (on 64-bit, converting directly from PS to JPG does not work)
-        cmd = 'pstops 1000:0 ' + outfile + ' > ' + tmpPS + ';' + \
-            'ps2pdf ' + tmpPS + ' ' + tmpPDF + ';' + \
-            'convert -density 96 ' + tmpPDF + ' ' + jpg
-        rtn = os.system(cmd)
-        if rtn == 0:
+        if os.path.exists(outfile) and KATReport.PSToJPEG(outfile, jpg, logfile=logfile):
             EVLAAddOutFile( jpg, name, "Contour plot (Stokes I)" )
-            if cleanUp:
-                os.remove(tmpPS)
-                os.remove(tmpPDF)
         else:
             # Print error message and leave the PS file
             mess="Error occurred while converting PS to JPG"
@@ -7902,18 +7911,12 @@ def EVLADiagPlots( uv, err, cleanUp=True, JPEG=True, sources=None, project='',
                     printMess(mess, logfile)
                 else:
                     if JPEG:
-                        # Convert PS -> PDF; Convert PDF -> JPG
-                        # (on 64-bit, converting directoy PS -> JPG fails)
-                        tmpPDF, jpg = ['%s.%s' % (os.path.splitext(outfile)[0], file_ext) for file_ext in ['pdf', 'jpg']]
+                        jpg = os.path.splitext(outfile)[0]+'.jpg'
                         printMess('Converting '+outfile+' -> '+jpg,logfile)
-                        cmd = 'convert ' + outfile + ' ' + tmpPDF + ';' + \
-                            'convert -density 96 ' + tmpPDF + ' ' + jpg
-                        rtn = os.system(cmd)
-                        if rtn == 0 and os.path.exists(jpg):
+                        if KATReport.PSToJPEG(outfile, jpg, logfile=logfile):
                             EVLAAddOutFile( jpg, s, plot['desc'] )
                             if cleanUp:
                                 os.remove(outfile) # Remove the PS file
-                                os.remove(tmpPDF)
                         else:
                             # Print error message and leave the PS file
                             mess="Error occurred while converting PS to JPG"
@@ -8018,41 +8021,27 @@ def KATProjMetadata( uv, AIPS_VERSION, err,
         str(r["archFileID"])
 
     # Get antenna names and positions
-    antab = uv.NewTable(Table.READONLY,"AIPS AN",1,err)
-    antab.Open(Table.READONLY,err)
+    ANcols, keys, rowInfo = KATTableUtil.CachedColumns(uv, "AIPS AN", 1, err)
     OErr.printErrMsg(err) # catch table open errors
-    nrow = antab.Desc.Dict["nrow"]
-    annames = []
-    anpos = []
-    for i in range(1,nrow+1):
-        anrow = antab.ReadRow(i, err)
-        name = anrow["ANNAME"][0].rstrip()
-        annames.append( name )
-        pos = anrow["STABXYZ"]
-        anpos.append( pos )
-    antab.Close(err)
+    annames = [n[0].rstrip() for n in ANcols["ANNAME"]]
+    anpos = ANcols["STABXYZ"].tolist()
     r["anNames"] = annames # list of antennas used
 
     # Get the frequency coverage
     d = uv.Desc.Dict # UV data descriptor dictionary
     refFreq = d["crval"][ d["jlocf"] ] # reference frequency
-    fqtab = uv.NewTable(Table.READONLY,"AIPS FQ",1,err)
-    fqtab.Open(Table.READONLY,err)
+    FQcols, keys, rowInfo = KATTableUtil.CachedColumns(uv, "AIPS FQ", 1, err)
     OErr.printErrMsg(err) # catch table open errors
-    nrow = fqtab.Desc.Dict["nrow"]
     freqCov = []
-    for i in range(1,nrow+1):
-        fqrow = fqtab.ReadRow(i, err)
-        freq = fqrow["IF FREQ"]
-        bw = fqrow["TOTAL BANDWIDTH"]
-        sb = fqrow["SIDEBAND"] # +1 => 'IF FREQ' is upper-side band; -1 => lower-side band
+    for freq, bw, sb in zip(FQcols["IF FREQ"].tolist(), FQcols["TOTAL BANDWIDTH"].tolist(),
+                            FQcols["SIDEBAND"].tolist()):
+        # sb +1 => 'IF FREQ' is upper-side band; -1 => lower-side band
         for i in range( len(freq) ):
             f1 = refFreq + freq[i] # 1st bound of IF
             f2 = f1 + sb[i] * bw[i] # 2nd bound of IF
             fc = [ f1, f2 ]
             fc.sort()
             freqCov.append( fc ) # sort bounds and add to list
-    fqtab.Close(err)
     r["freqCov"] = freqCov
 
     # Calculate the minimum fringe spacing
@@ -1,5 +1,5 @@
 import sys, pydoc
-import OErr, OSystem, UV, AIPS, FITS, OTObit
+import OErr, OSystem, UV, AIPS, FITS
 import ObitTalkUtil
 from AIPS import AIPSDisk
 from FITS import FITSDisk
@@ -15,9 +15,16 @@ import subprocess
 from . import KATH5toAIPS
 import os
 from . import AIPSSetup
+from . import KATResources
+from . import KATProfile
+from . import KATExport
 import shutil
 import numpy as np
 from .KATImExceptions import KATUnimageableError
+from . import KATStages
+
+# Names of the pipeline stages in the order they are run
+PIPELINE_STAGES = ["load", "hann", "flag", "refant", "cal", "autoflag", "recal", "calavg", "export"]
 
 #possible kwargs: scratchdir
 def MKContPipeline(files, outputdir, **kwargs):
@@ -34,6 +41,14 @@ def MKContPipeline(files, outputdir, **kwargs):
         The directory location of the aips disk
     parmFile : string, optional
         Overwrite the default imaging parameters using this parameter file.
+    resume_from : string, optional
+        Rerun the pipeline from this stage (see PIPELINE_STAGES), the state
+        of the earlier stages comes from their completion markers.
+        By default a rerun skips the stages already completed. A stage
+        that is rerun first undoes the calibration and flag tables
+        written by its earlier attempt.
+    only : list, optional
+        Only run these stages
     """
     if len(files) == 1:
         h5file = files[0]
@@ -78,27 +93,33 @@ def MKContPipeline(files, outputdir, **kwargs):
     logFile       = fileRoot + ".log"   # Processing log file
     avgClass      = ("UVAv")[0:6]  # Averaged data AIPS class
     manifestfile  = outputdir + '/manifest.pickle'
+    stageFile     = fileRoot + ".stages.pickle"   # Pipeline stage completion markers
 
     ############################# Initialize OBIT and AIPS ##########################################
     noScrat     = []
     # Logging directly to logFile
     OErr.PInit(err, 2, logFile)
     EVLAAddOutFile(os.path.basename(logFile), 'project', 'Pipeline log file')
-    if kwargs.get('reuse'):
+    # Keep the AIPS disk when reusing data or resuming from earlier stages
+    resume = kwargs.get('resume_from') or kwargs.get('only') or os.path.exists(stageFile)
+    if kwargs.get('reuse') or resume:
         ObitSys = AIPSSetup.AIPSSetup(err,configfile=kwargs.get('configFile'),scratchdir=kwargs.get('scratchdir'),aipsdisk=kwargs.get('aipsdisk'),overwrite=False)
     else:
         ObitSys = AIPSSetup.AIPSSetup(err,configfile=kwargs.get('configFile'),scratchdir=kwargs.get('scratchdir'),aipsdisk=kwargs.get('aipsdisk'))
 
+    # Profile of the pipeline steps, next to the manifest
+    profile = KATProfile.InitProfile(outputdir, logFile=logFile)
+    EVLAAddOutFile('profile.json', 'project', 'Pipeline step profile')
+    EVLAAddOutFile('profile.csv', 'project', 'Pipeline step profile')
+
     # Get the set up AIPS environment.
     AIPS_ROOT    = os.environ['AIPS_ROOT']
     AIPS_VERSION = os.environ['AIPS_VERSION']
 
-    nThreads = 72
     user = OSystem.PGetAIPSuser()
     AIPS.userno = user
     disk = 1
     fitsdisk = 1
-    nam = nameRoot[:10]
     clss = "Raw"
     seq = 1
 
@@ -113,6 +134,8 @@ def MKContPipeline(files, outputdir, **kwargs):
     parms = KATInitContParms()
     parms['PolCal'] = kwargs.get('polcal')
     parms['XYtarg'] = kwargs.get('XYtarg')
+    if kwargs.get('loadhalf') and parms['PolCal']:
+        raise RuntimeError('Polarisation calibration needs the cross hands. Cannot run in PolCal mode with loadhalf.')
     # Get default XYtarg if it is not set
     targs = [targ.name for targ in katdata.catalogue.targets]
     if parms['XYtarg'] is None:
@@ -163,12 +186,15 @@ def MKContPipeline(files, outputdir, **kwargs):
     else:
         sflags = np.zeros(sw.num_chans, dtype=np.bool)
     sflags = sflags[katdata.channels]
-    # Construct a template uvfits file from master template
-    mastertemplate = ObitTalkUtil.FITSDir.FITSdisks[fitsdisk] + 'MKATTemplate.uvtab.gz'
-    outtemplate = nam + '.uvtemp'
+    # Number of channels to average on load
+    chanav = kwargs.get('chanav', 1)
+    # Which stages to run
+    stages = KATStages.InitStages(PIPELINE_STAGES, stageFile, err, resumeFrom=kwargs.get('resume_from'),
+                                  only=kwargs.get('only'), logFile=logFile, check=check)
+    delay_uv = None
     if kwargs.get('reuse'):
         uv = UV.newPAUV("AIPS UV DATA", EVLAAIPSName(project), dataClass, disk, seq, True, err)
-        obsdata = KATH5toAIPS.GetKATMeta(katdata, err)
+        obsdata = KATH5toAIPS.GetKATMeta(katdata, err, loadhalf=kwargs.get('loadhalf', False), chanav=chanav)
         # Extract AIPS parameters of the uv data to the metadata
         obsdata["Aproject"] = uv.Aname
         obsdata["Aclass"] = uv.Aclass
@@ -178,30 +204,43 @@ def MKContPipeline(files, outputdir, **kwargs):
         obsdata["fitsdisk"] = fitsdisk
         # TODO: Check if the input data has been Hanned.
         doneHann = True
-    else:
+    elif KATStages.RunStage(stages, "load"):
         mess = '\nLoading UV data with CBID: %s' % (katdata.obs_params['capture_block_id'],)
         printMess(mess, logFile)
-        KATH5toAIPS.MakeTemplate(mastertemplate, outtemplate, katdata)
-        uv = OTObit.uvlod(outtemplate, 0, EVLAAIPSName(project), clss, disk, seq, err)
-        obsdata = KATH5toAIPS.KAT2AIPS(katdata, uv, disk, fitsdisk, err, calInt=katdata.dump_period, static=sflags, **kwargs)
-        MakeIFs.UVMakeIF(uv,8,err,solInt=katdata.dump_period)
-        os.remove(outtemplate)
-
-    if parms["PolCal"]:
-        mess = '\nLoading delay calibration with CBID: %s' % (delay_katdata.obs_params['capture_block_id'],)
-        printMess(mess, logFile)
-        # Load the delay cal observation
-        KATH5toAIPS.MakeTemplate(mastertemplate, outtemplate, katdata)
-        delay_uv = OTObit.uvlod(outtemplate, 0, EVLAAIPSName(project), delayClass, disk, seq, err)
-        KATH5toAIPS.KAT2AIPS(delay_katdata, delay_uv, disk, fitsdisk, err, calInt=katdata.dump_period, static=sflags, flag=False)
-        MakeIFs.UVMakeIF(delay_uv, 8, err, solInt=katdata.dump_period)     
-        os.remove(outtemplate)
-    
+        uv = KATH5toAIPS.CreateKATUV(katdata, EVLAAIPSName(project), clss, disk, seq, err, loadhalf=kwargs.get('loadhalf', False), chanav=chanav)
+        obsdata = KATProfile.Call(profile, KATH5toAIPS.KAT2AIPS, katdata, uv, disk, fitsdisk, err, calInt=katdata.dump_period, static=sflags, **kwargs)
+        KATProfile.Call(profile, MakeIFs.UVMakeIF, uv,8,err,solInt=katdata.dump_period)
+
+        if parms["PolCal"]:
+            mess = '\nLoading delay calibration with CBID: %s' % (delay_katdata.obs_params['capture_block_id'],)
+            printMess(mess, logFile)
+            # Load the delay cal observation
+            delay_uv = KATH5toAIPS.CreateKATUV(delay_katdata, EVLAAIPSName(project), delayClass, disk, seq, err, chanav=chanav)
+            KATProfile.Call(profile, KATH5toAIPS.KAT2AIPS, delay_katdata, delay_uv, disk, fitsdisk, err, calInt=katdata.dump_period, static=sflags, flag=False, chanav=chanav, uvw_cache=kwargs.get('uvw_cache'))
+            KATProfile.Call(profile, MakeIFs.UVMakeIF, delay_uv, 8, err, solInt=katdata.dump_period)
+        KATStages.StageDone(stages, "load", state={"uv":KATStages.AIPSOutput(uv), "delay_uv":KATStages.AIPSOutput(delay_uv)},
+                            outputs=[KATStages.AIPSOutput(uv), KATStages.AIPSOutput(delay_uv)])
+    else:
+        # Loaded by an earlier run, the data are opened by the hann stage
+        loaded = KATStages.RequiredState(stages, "uv", "load")
+        uv = None
+        obsdata = KATH5toAIPS.GetKATMeta(katdata, err, loadhalf=kwargs.get('loadhalf', False), chanav=chanav)
+        obsdata["Aproject"] = loaded["name"]
+        obsdata["Aclass"] = loaded["class"]
+        obsdata["Aseq"] = loaded["seq"]
+        obsdata["Adisk"] = loaded["disk"]
+        obsdata["calInt"] = katdata.dump_period
+        obsdata["fitsdisk"] = fitsdisk
+
     # Print the uv data header to screen.
-    uv.Header(err)
+    if uv is not None:
+        uv.Header(err)
     ############################# Set Project Processing parameters ###################################
     # Parameters derived from obsdata and katdata
     KATGetObsParms(obsdata, katdata, parms, logFile)
+    # Channels dropped were selected before any averaging on load
+    parms["BChDrop"]=parms["BChDrop"]//chanav
+    parms["EChDrop"]=parms["EChDrop"]//chanav
 
     ###### Initialise target parameters #####
     KATInitTargParms(katdata, parms, err)
@@ -209,6 +248,9 @@ def MKContPipeline(files, outputdir, **kwargs):
     # Load the outputs pickle jar
     EVLAFetchOutFiles()
 
+    # Thread budgets from the cores, memory and data size
+    resources = KATResources.ResourceBudget(obsdata, configfile=kwargs.get('configFile'), logFile=logFile)
+    nThreads = resources["nThreads"]
     OSystem.PAllowThreads(nThreads)   # Allow threads in Obit/oython
     retCode = 0
     doBand = -1
@@ -265,365 +307,409 @@ def MKContPipeline(files, outputdir, **kwargs):
 
     # Hanning - only if not reusing
     doneHann = False
-    if not kwargs.get('reuse'):
-        if parms["doHann"]:
-            uv = KATHann(uv, EVLAAIPSName(project), dataClass, disk, seq, err, \
-                      doDescm=parms["doDescm"], flagVer=-1, logfile=logFile, zapin=True, check=check, debug=debug)
-            doneHann = True
+    if KATStages.RunStage(stages, "hann"):
+        if uv is None:
+            uv = KATStages.OpenAIPSOutput(KATStages.StageState(stages, "uv"), err, name="Loaded UV data")
+            delay_uv = KATStages.OpenAIPSOutput(KATStages.StageState(stages, "delay_uv"), err,
+                                                required=parms["PolCal"], name="Delay calibration data")
+        if not kwargs.get('reuse'):
+            if parms["doHann"]:
+                uv = KATProfile.Call(profile, KATHann, uv, EVLAAIPSName(project), dataClass, disk, seq, err, \
+                          doDescm=parms["doDescm"], flagVer=-1, logfile=logFile, zapin=True, check=check, debug=debug)
+                doneHann = True
+                if uv==None and not check:
+                    raise RuntimeError("Cannot Hann data ")
     
-    if parms["PolCal"] and parms["doHann"]:
-        mess = "Hanning delay calibration scan"
-        printMess(mess, logFile)
-        delay_uv = KATHann(delay_uv, EVLAAIPSName(project), delayClass, disk, seq + 1, err, \
-                        doDescm=parms["doDescm"], flagVer=-1, logfile=logFile, zapin=True, check=check, debug=debug)
+        if parms["PolCal"] and parms["doHann"]:
+            mess = "Hanning delay calibration scan"
+            printMess(mess, logFile)
+            delay_uv = KATProfile.Call(profile, KATHann, delay_uv, EVLAAIPSName(project), delayClass, disk, seq + 1, err, \
+                            doDescm=parms["doDescm"], flagVer=-1, logfile=logFile, zapin=True, check=check, debug=debug)
+        KATStages.StageDone(stages, "hann", state={"uv":KATStages.AIPSOutput(uv), "delay_uv":KATStages.AIPSOutput(delay_uv),
+                                                   "doneHann":doneHann},
+                            outputs=[KATStages.AIPSOutput(uv), KATStages.AIPSOutput(delay_uv)])
+    else:
+        uv = KATStages.OpenAIPSOutput(KATStages.StageState(stages, "uv"), err, name="UV data")
+        delay_uv = KATStages.OpenAIPSOutput(KATStages.StageState(stages, "delay_uv"), err,
+                                            required=parms["PolCal"], name="Delay calibration data")
+        doneHann = KATStages.StageState(stages, "doneHann", False)
 
     if doneHann:
         # Halve channels after hanning.
         parms["selChan"]=int(parms["selChan"]/2)
         parms["BChDrop"]=int(parms["BChDrop"]/2)
         parms["EChDrop"]=int(parms["EChDrop"]/2)
-        if uv==None and not check:
-            raise RuntimeError("Cannot Hann data ")
 
-    # Clear any old calibration/editing 
-    if parms["doClearTab"] or kwargs.get('reuse'):
-        mess =  "Clear previous calibration"
-        printMess(mess, logFile)
-        EVLAClearCal(uv, err, doGain=parms["doClearGain"], doFlag=parms["doClearFlag"], doBP=parms["doClearBP"], check=check)
-        OErr.printErrMsg(err, "Error resetting calibration")
+    if KATStages.RunStage(stages, "flag", inputs=["hann"]):
+        # Clear any old calibration/editing 
+        if parms["doClearTab"] or kwargs.get('reuse'):
+            mess =  "Clear previous calibration"
+            printMess(mess, logFile)
+            EVLAClearCal(uv, err, doGain=parms["doClearGain"], doFlag=parms["doClearFlag"], doBP=parms["doClearBP"], check=check)
+            OErr.printErrMsg(err, "Error resetting calibration")
 
-    # Copy FG 1 to FG 2
-    if parms["doCopyFG"]:
-        mess =  "Copy FG 1 to FG 2"
-        printMess(mess, logFile)
-        retCode = KATCopyFG(uv, err, logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-            raise RuntimeError("Error Copying FG table")
+        # Copy FG 1 to FG 2
+        if parms["doCopyFG"]:
+            mess =  "Copy FG 1 to FG 2"
+            printMess(mess, logFile)
+            retCode = KATCopyFG(uv, err, logfile=logFile, check=check, debug=debug)
+            if retCode!=0:
+                raise RuntimeError("Error Copying FG table")
   
-    # Flag antennas shadowed by others?
-    if parms["doShad"]:
-        retCode = EVLAShadow (uv, err, shadBl=parms["shadBl"], \
-                              logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-            raise RuntimeError("Error Shadow flagging data")
-    
-    # Median window time editing, for RFI impulsive in time
-    if parms["doMednTD1"]:
-        mess =  "Median window time editing, for RFI impulsive in time:"
-        printMess(mess, logFile)
-        retCode = EVLAMedianFlag (uv, clist, err, noScrat=noScrat, nThreads=nThreads, \
-                                  avgTime=parms["mednAvgTime"], avgFreq=parms["mednAvgFreq"],  chAvg= parms["mednChAvg"], \
-                                  timeWind=parms["mednTimeWind"],flagVer=2, flagTab=2,flagSig=parms["mednSigma"], \
-                                  logfile=logFile, check=check, debug=False)
-        if retCode!=0:
-            raise RuntimeError("Error in MednFlag")
-    
-    # Median window frequency editing, for RFI impulsive in frequency
-    if parms["doFD1"]:
-        mess =  "Median window frequency editing, for RFI impulsive in frequency:"
-        printMess(mess, logFile)
-        retCode = EVLAAutoFlag (uv, clist, err, flagVer=2, flagTab=2, doCalib=-1, doBand=-1,   \
-                                timeAvg=parms["FD1TimeAvg"], \
-                                doFD=True, FDmaxAmp=1.0e20, FDmaxV=1.0e20, FDwidMW=parms["FD1widMW"],  \
-                                FDmaxRMS=[1.0e20,0.1], FDmaxRes=parms["FD1maxRes"],  \
-                                FDmaxResBL= parms["FD1maxRes"],  FDbaseSel=parms["FD1baseSel"],\
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-           raise  RuntimeError("Error in AutoFlag")
-    
-    # Parallactic angle correction?
-    if parms["doPACor"]:
-        retCode = EVLAPACor(uv, err, \
-                                logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-            raise RuntimeError("Error in Parallactic angle correction")
-    
-    # Need to find a reference antenna?  See if we have saved it?
-    if (parms["refAnt"]<=0):
-        refAnt = FetchObject(fileRoot+".refAnt.pickle")
-        if refAnt:
-            parms["refAnt"] = refAnt
-
-    # Use bandpass calibrator and center half of each spectrum
-    if parms["refAnt"]<=0:
-        mess = "Find best reference antenna: run Calib on BP Cal(s) "
-        printMess(mess, logFile)
-        parms["refAnt"] = EVLAGetRefAnt(uv, parms["BPCals"], err, flagVer=0, \
-                                        solInt=parms["bpsolint1"], nThreads=nThreads, \
-                                        logfile=logFile, check=check, debug=debug)
-        if err.isErr:
-                raise  RuntimeError("Error finding reference antenna")
-        if parms["refAnts"][0]<=0:
-            parms["refAnts"][0] = parms["refAnt"]
-        mess = "Picked reference antenna "+str(parms["refAnt"])
-        printMess(mess, logFile)
-        # Save it
-        ParmsPicklefile = fileRoot+".Parms.pickle"   # Where results saved
-        SaveObject(parms, ParmsPicklefile, True)
-        refAntPicklefile = fileRoot+".refAnt.pickle"   # Where results saved
-        SaveObject(parms["refAnt"], refAntPicklefile, True)
-
-
-    # Plot Raw, edited data?
-    if parms["doRawSpecPlot"] and parms["plotSource"]:
-        mess =  "Raw Spectral plot for: "+' '.join(parms["BPCal"])
-        printMess(mess, logFile)
-        plotFile = fileRoot+"_RawSpec.ps"
-        retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, parms["refAnt"], err, \
-                               Stokes=["RR","LL"], doband=-1,          \
-                               check=check, debug=debug, logfile=logFile )
-        if retCode!=0:
-            raise  RuntimeError("Error in Plotting spectrum")
-        EVLAAddOutFile(plotFile, 'project', 'Pipeline log file' )
+        # Flag antennas shadowed by others?
+        if parms["doShad"]:
+            retCode = EVLAShadow (uv, err, shadBl=parms["shadBl"], \
+                                  logfile=logFile, check=check, debug=debug)
+            if retCode!=0:
+                raise RuntimeError("Error Shadow flagging data")
     
-    if parms["PolCal"]:
-        mess = "XYphase bandpass calibration"
-        printMess(mess, logFile)
-        retCode = KATXPhase(delay_uv, uv, err, logfile=logFile, check=check, debug=debug,
-                            doCalib=-1, flagVer=0, doBand=-1, refAnt=parms['refAnt'])
-        doBand = 1
-        BPVer += 1
-        if retCode!=0:
-            raise RuntimeError("Error in Xphase calibration")
-
-    # delay calibration
-    if parms["doDelayCal"] and parms["DCals"] and not check:
-        plotFile = fileRoot+"_DelayCal.ps"
-        retCode = EVLADelayCal(uv, parms["DCals"], err,  \
-                               BChan=parms["delayBChan"], EChan=parms["delayEChan"], \
-                               doCalib=-1, flagVer=0, doBand=doBand, BPVer=BPVer, \
-                               solInt=parms["delaySolInt"], smoTime=parms["delaySmoo"],  \
-                               refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], 
-                               doZeroPhs=parms["delayZeroPhs"], \
-                               doAvgIF=parms["delayAvgIF"], doAvgPol=parms["delayAvgPol"], \
-                               doPlot=parms["doSNPlot"], plotFile=plotFile, \
-                               nThreads=nThreads, noScrat=noScrat, \
-                               logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-            raise RuntimeError("Error in delay calibration")
-
-        # Plot corrected data?
-        if parms["doSpecPlot"] and parms["plotSource"]:
-            plotFile = fileRoot+"_DelaySpec.ps"
-            retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, \
-                                   plotFile, parms["refAnt"], err, \
-                                   Stokes=["RR","LL"], doband=doBand,          \
-                                   check=check, debug=debug, logfile=logFile )
+        # Median window time editing, for RFI impulsive in time
+        if parms["doMednTD1"]:
+            mess =  "Median window time editing, for RFI impulsive in time:"
+            printMess(mess, logFile)
+            retCode = KATProfile.Call(profile, EVLAMedianFlag, uv, clist, err, noScrat=noScrat, nThreads=resources["AutoFlag"], \
+                                      avgTime=parms["mednAvgTime"], avgFreq=parms["mednAvgFreq"],  chAvg= parms["mednChAvg"], \
+                                      timeWind=parms["mednTimeWind"],flagVer=2, flagTab=2,flagSig=parms["mednSigma"], \
+                                      logfile=logFile, check=check, debug=False)
             if retCode!=0:
-                raise  RuntimeError("Error in Plotting spectrum")
-
-    # Bandpass calibration
-    if parms["doBPCal"] and parms["BPCals"]:
-        retCode = KATBPCal(uv, parms["BPCals"], err, doBand=doBand, BPVer=BPVer, newBPVer=0,
-                            noScrat=noScrat, solInt1=parms["bpsolint1"], \
-                            solInt2=parms["bpsolint2"], solMode=parms["bpsolMode"], \
-                            BChan1=parms["bpBChan1"], EChan1=parms["bpEChan1"], \
-                            BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
-                            doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
-                            UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
-                            nThreads=nThreads, logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-            raise RuntimeError("Error in Bandpass calibration")
-
-        # Plot corrected data?
-        if parms["doSpecPlot"] and  parms["plotSource"]:
-            plotFile = fileRoot+"_BPSpec.ps"
-            retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, \
-                                   parms["refAnt"], err, Stokes=["RR","LL"], doband=1,          \
-                                   check=check, debug=debug, logfile=logFile )
+                raise RuntimeError("Error in MednFlag")
+    
+        # Median window frequency editing, for RFI impulsive in frequency
+        if parms["doFD1"]:
+            mess =  "Median window frequency editing, for RFI impulsive in frequency:"
+            printMess(mess, logFile)
+            retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, clist, err, flagVer=2, flagTab=2, doCalib=-1, doBand=-1,   \
+                                    timeAvg=parms["FD1TimeAvg"], \
+                                    doFD=True, FDmaxAmp=1.0e20, FDmaxV=1.0e20, FDwidMW=parms["FD1widMW"],  \
+                                    FDmaxRMS=[1.0e20,0.1], FDmaxRes=parms["FD1maxRes"],  \
+                                    FDmaxResBL= parms["FD1maxRes"],  FDbaseSel=parms["FD1baseSel"],\
+                                    nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
-                raise  RuntimeError("Error in Plotting spectrum")
+               raise  RuntimeError("Error in AutoFlag")
     
-
-    # Amp & phase Calibrate
-    if parms["doAmpPhaseCal"]:
-        plotFile = fileRoot+"_APCal.ps"
-        retCode = KATCalAP (uv, [], parms["ACals"], err, PCals=parms["PCals"], 
-                             doCalib=2, doBand=1, BPVer=0, flagVer=0, \
-                             BChan=parms["ampBChan"], EChan=parms["ampEChan"], \
-                             solInt=parms["solInt"], solSmo=parms["solSmo"], ampScalar=parms["ampScalar"], \
-                             doAmpEdit=parms["doAmpEdit"], ampSigma=parms["ampSigma"], \
-                             ampEditFG=parms["ampEditFG"], avgPol=parms["PolCal"], \
-                             doPlot=parms["doSNPlot"], plotFile=plotFile,  refAnt=parms["refAnt"], \
-                             nThreads=nThreads, noScrat=noScrat, logfile=logFile, check=check, debug=debug)
-
-        if retCode!=0:
-            raise RuntimeError("Error calibrating")
-
-    # More editing
-    if parms["doAutoFlag"]:
-        mess =  "Post calibration editing:"
-        printMess(mess, logFile)
-        # if going to redo then only calibrators
-        if parms["doRecal"]:
-            # Only calibrators
-            clist = []
-            for DCal in parms["DCals"]:
-                if DCal["Source"] not in clist:
-                    clist.append(DCal["Source"])
-            for PCal in parms["PCals"]:
-                if PCal["Source"] not in clist:
-                    clist.append(PCal["Source"])
-            for ACal in parms["ACals"]:
-                if ACal["Source"] not in clist:
-                    clist.append(ACal["Source"])
-        else:
-            clist = []
-
-        retCode = EVLAAutoFlag (uv, clist, err, flagVer=0, flagTab =2, \
-                                doCalib=2, gainUse=0, doBand=1, BPVer=BPVer,  \
-                                IClip=parms["IClip"], minAmp=parms["minAmp"], timeAvg=parms["timeAvg"], \
-                                doFD=parms["doFirstAFFD"], FDmaxAmp=parms["FDmaxAmp"], FDmaxV=parms["FDmaxV"], \
-                                FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
-                                FDmaxRes=parms["FDmaxRes"],  FDmaxResBL=parms["FDmaxResBL"], \
-                                FDbaseSel=parms["FDbaseSel"], \
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-           raise  RuntimeError("Error in AutoFlag")
-
-    # Redo the calibration using new flagging?
-    if parms["doBPCal2"]==None:
-        parms["doBPCal2"] = parms["doBPCal"]
-    if parms["doDelayCal2"]==None:
-        parms["doDelayCal2"] = parms["doDelayCal2"]
-    if parms["doAmpPhaseCal2"]==None:
-        parms["doAmpPhaseCal2"] = parms["doAmpPhaseCal"]
-    if parms["doAutoFlag2"]==None:
-        parms["doAutoFlagCal2"] = parms["doAutoFlag"]
-    if parms["doRecal"]:
-        mess =  "Redo calibration:"
-        printMess(mess, logFile)
-        EVLAClearCal(uv, err, doGain=True, doFlag=False, doBP=True, check=check, logfile=logFile)
-        OErr.printErrMsg(err, "Error resetting calibration")
-        BPVer = 0
         # Parallactic angle correction?
         if parms["doPACor"]:
             retCode = EVLAPACor(uv, err, \
-                                logfile=logFile, check=check, debug=debug)
+                                    logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in Parallactic angle correction")
-
-
-        # Run MKXPhase on delaycal data and attach BP table to UV data
+        KATStages.StageDone(stages, "flag", outputs=[KATStages.TableOutput(uv, "AIPS FG")])
+
+    if KATStages.RunStage(stages, "refant", inputs=["flag"]):
+        # Need to find a reference antenna?  See if we have saved it?
+        if (parms["refAnt"]<=0):
+            refAnt = FetchObject(fileRoot+".refAnt.pickle")
+            if refAnt:
+                parms["refAnt"] = refAnt
+
+        # Use bandpass calibrator and center half of each spectrum
+        if parms["refAnt"]<=0:
+            mess = "Find best reference antenna: run Calib on BP Cal(s) "
+            printMess(mess, logFile)
+            parms["refAnt"] = EVLAGetRefAnt(uv, parms["BPCals"], err, flagVer=0, \
+                                            solInt=parms["bpsolint1"], nThreads=resources["Calib"], \
+                                            logfile=logFile, check=check, debug=debug)
+            if err.isErr:
+                    raise  RuntimeError("Error finding reference antenna")
+            if parms["refAnts"][0]<=0:
+                parms["refAnts"][0] = parms["refAnt"]
+            mess = "Picked reference antenna "+str(parms["refAnt"])
+            printMess(mess, logFile)
+            # Save it
+            ParmsPicklefile = fileRoot+".Parms.pickle"   # Where results saved
+            SaveObject(parms, ParmsPicklefile, True)
+            refAntPicklefile = fileRoot+".refAnt.pickle"   # Where results saved
+            SaveObject(parms["refAnt"], refAntPicklefile, True)
+        KATStages.StageDone(stages, "refant", state={"refAnt":parms["refAnt"], "refAnts":parms["refAnts"]})
+    else:
+        parms["refAnt"] = KATStages.StageState(stages, "refAnt", parms["refAnt"])
+        parms["refAnts"] = KATStages.StageState(stages, "refAnts", parms["refAnts"])
+
+    if KATStages.RunStage(stages, "cal", inputs=["flag", "refant"]):
+        # Undo the tables of an earlier attempt
+        KATStages.ResetTables(stages, "cal", uv, err)
+        # Plot Raw, edited data?
+        if parms["doRawSpecPlot"] and parms["plotSource"]:
+            mess =  "Raw Spectral plot for: "+' '.join(parms["BPCal"])
+            printMess(mess, logFile)
+            plotFile = fileRoot+"_RawSpec.ps"
+            retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, parms["refAnt"], err, \
+                                   Stokes=["RR","LL"], doband=-1,          \
+                                   check=check, debug=debug, logfile=logFile )
+            if retCode!=0:
+                raise  RuntimeError("Error in Plotting spectrum")
+            EVLAAddOutFile(plotFile, 'project', 'Pipeline log file' )
+    
         if parms["PolCal"]:
             mess = "XYphase bandpass calibration"
             printMess(mess, logFile)
             retCode = KATXPhase(delay_uv, uv, err, logfile=logFile, check=check, debug=debug,
-                            doCalib=-1, flagVer=0, doBand=-1, refAnt=parms['refAnt'])
+                                doCalib=-1, flagVer=0, doBand=-1, refAnt=parms['refAnt'])
+            doBand = 1
             BPVer += 1
-        if retCode!=0:
-            raise RuntimeError("Error in Xphase calibration")
-
+            if retCode!=0:
+                raise RuntimeError("Error in Xphase calibration")
 
-        # Delay recalibration
-        if parms["doDelayCal2"] and parms["DCals"] and not check:
-            plotFile = fileRoot+"_DelayCal2.ps"
-            retCode = EVLADelayCal(uv, parms["DCals"], err, \
+        # delay calibration
+        if parms["doDelayCal"] and parms["DCals"] and not check:
+            plotFile = fileRoot+"_DelayCal.ps"
+            retCode = KATProfile.Call(profile, EVLADelayCal, uv, parms["DCals"], err,  \
                                    BChan=parms["delayBChan"], EChan=parms["delayEChan"], \
                                    doCalib=-1, flagVer=0, doBand=doBand, BPVer=BPVer, \
                                    solInt=parms["delaySolInt"], smoTime=parms["delaySmoo"],  \
-                                   refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], \
+                                   refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], 
                                    doZeroPhs=parms["delayZeroPhs"], \
                                    doAvgIF=parms["delayAvgIF"], doAvgPol=parms["delayAvgPol"], \
                                    doPlot=parms["doSNPlot"], plotFile=plotFile, \
-                                   nThreads=nThreads, noScrat=noScrat, \
+                                   nThreads=resources["Calib"], noScrat=noScrat, \
                                    logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in delay calibration")
 
             # Plot corrected data?
             if parms["doSpecPlot"] and parms["plotSource"]:
-                plotFile = fileRoot+"_DelaySpec2.ps"
-                retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, parms["refAnt"], err, \
-                                       Stokes=["RR","LL"], doband=doband,          \
+                plotFile = fileRoot+"_DelaySpec.ps"
+                retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, \
+                                       plotFile, parms["refAnt"], err, \
+                                       Stokes=["RR","LL"], doband=doBand,          \
                                        check=check, debug=debug, logfile=logFile )
                 if retCode!=0:
                     raise  RuntimeError("Error in Plotting spectrum")
 
         # Bandpass calibration
-        if parms["doBPCal2"] and parms["BPCals"]:
-            retCode = KATBPCal(uv, parms["BPCals"], err, doBand=doBand, BPVer=BPVer, newBPVer=0, \
-                            noScrat=noScrat, solInt1=parms["bpsolint1"], \
-                            solInt2=parms["bpsolint2"], solMode=parms["bpsolMode"], \
-                            BChan1=parms["bpBChan1"], EChan1=parms["bpEChan1"], \
-                            BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
-                            doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
-                            UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
-                            nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+        if parms["doBPCal"] and parms["BPCals"]:
+            retCode = KATProfile.Call(profile, KATBPCal, uv, parms["BPCals"], err, doBand=doBand, BPVer=BPVer, newBPVer=0,
+                                noScrat=noScrat, solInt1=parms["bpsolint1"], \
+                                solInt2=parms["bpsolint2"], solMode=parms["bpsolMode"], \
+                                BChan1=parms["bpBChan1"], EChan1=parms["bpEChan1"], \
+                                BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
+                                doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
+                                UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
+                                nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in Bandpass calibration")
-        
-            # Plot corrected data?
-            if parms["doSpecPlot"] and parms["plotSource"]:
-                plotFile = fileRoot+"_BPSpec2.ps"
-                retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, parms["refAnt"], err, \
-                                   Stokes=["RR","LL"], doband=1,          \
-                                   check=check, debug=debug, logfile=logFile )
-            if retCode!=0:
-                raise  RuntimeError("Error in Plotting spectrum")
 
+            # Plot corrected data?
+            if parms["doSpecPlot"] and  parms["plotSource"]:
+                plotFile = fileRoot+"_BPSpec.ps"
+                retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, \
+                                       parms["refAnt"], err, Stokes=["RR","LL"], doband=1,          \
+                                       check=check, debug=debug, logfile=logFile )
+                if retCode!=0:
+                    raise  RuntimeError("Error in Plotting spectrum")
+    
 
-        # Amp & phase Recalibrate
-        if parms["doAmpPhaseCal2"]:
-            plotFile = fileRoot+"_APCal2.ps"
-            retCode = KATCalAP (uv, [], parms["ACals"], err, PCals=parms["PCals"], \
+        # Amp & phase Calibrate
+        if parms["doAmpPhaseCal"]:
+            plotFile = fileRoot+"_APCal.ps"
+            retCode = KATProfile.Call(profile, KATCalAP, uv, [], parms["ACals"], err, PCals=parms["PCals"], 
                                  doCalib=2, doBand=1, BPVer=0, flagVer=0, \
                                  BChan=parms["ampBChan"], EChan=parms["ampEChan"], \
                                  solInt=parms["solInt"], solSmo=parms["solSmo"], ampScalar=parms["ampScalar"], \
-                                 doAmpEdit=True, ampSigma=parms["ampSigma"], \
+                                 doAmpEdit=parms["doAmpEdit"], ampSigma=parms["ampSigma"], \
                                  ampEditFG=parms["ampEditFG"], avgPol=parms["PolCal"], \
-                                 doPlot=parms["doSNPlot"], plotFile=plotFile, refAnt=parms["refAnt"], \
-                                 noScrat=noScrat, nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                 doPlot=parms["doSNPlot"], plotFile=plotFile,  refAnt=parms["refAnt"], \
+                                 nThreads=resources["Calib"], noScrat=noScrat, logfile=logFile, check=check, debug=debug)
+
             if retCode!=0:
                 raise RuntimeError("Error calibrating")
+        KATStages.StageDone(stages, "cal", state={"doBand":doBand, "BPVer":BPVer},
+                            outputs=[KATStages.TableOutput(uv, "AIPS CL")])
+    else:
+        doBand = KATStages.StageState(stages, "doBand", doBand)
+        BPVer = KATStages.StageState(stages, "BPVer", BPVer)
 
+    if KATStages.RunStage(stages, "autoflag", inputs=["cal"]):
+        # Undo the flags of an earlier attempt
+        KATStages.ResetTables(stages, "autoflag", uv, err)
         # More editing
-        if parms["doAutoFlag2"]:
-            mess =  "Post recalibration editing:"
+        if parms["doAutoFlag"]:
+            mess =  "Post calibration editing:"
             printMess(mess, logFile)
-            retCode = EVLAAutoFlag (uv, [], err, flagVer=0, flagTab=2, \
-                                    doCalib=2, gainUse=0, doBand=1, BPVer=0,  \
+            # if going to redo then only calibrators
+            if parms["doRecal"]:
+                # Only calibrators
+                clist = []
+                for DCal in parms["DCals"]:
+                    if DCal["Source"] not in clist:
+                        clist.append(DCal["Source"])
+                for PCal in parms["PCals"]:
+                    if PCal["Source"] not in clist:
+                        clist.append(PCal["Source"])
+                for ACal in parms["ACals"]:
+                    if ACal["Source"] not in clist:
+                        clist.append(ACal["Source"])
+            else:
+                clist = []
+
+            retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, clist, err, flagVer=0, flagTab =2, \
+                                    doCalib=2, gainUse=0, doBand=1, BPVer=BPVer,  \
                                     IClip=parms["IClip"], minAmp=parms["minAmp"], timeAvg=parms["timeAvg"], \
-                                    doFD=parms["doSecAFFD"], FDmaxAmp=parms["FDmaxAmp"], FDmaxV=parms["FDmaxV"], \
+                                    doFD=parms["doFirstAFFD"], FDmaxAmp=parms["FDmaxAmp"], FDmaxV=parms["FDmaxV"], \
                                     FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
-                                    FDmaxRes=parms["FDmaxRes"],  FDmaxResBL= parms["FDmaxResBL"], \
+                                    FDmaxRes=parms["FDmaxRes"],  FDmaxResBL=parms["FDmaxResBL"], \
                                     FDbaseSel=parms["FDbaseSel"], \
-                                    nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                    nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
+            if retCode!=0:
+               raise  RuntimeError("Error in AutoFlag")
+        KATStages.StageDone(stages, "autoflag", outputs=[KATStages.TableOutput(uv, "AIPS FG")])
+
+    # Redo the calibration using new flagging?
+    if parms["doBPCal2"]==None:
+        parms["doBPCal2"] = parms["doBPCal"]
+    if parms["doDelayCal2"]==None:
+        parms["doDelayCal2"] = parms["doDelayCal2"]
+    if parms["doAmpPhaseCal2"]==None:
+        parms["doAmpPhaseCal2"] = parms["doAmpPhaseCal"]
+    if parms["doAutoFlag2"]==None:
+        parms["doAutoFlagCal2"] = parms["doAutoFlag"]
+    if KATStages.RunStage(stages, "recal", inputs=["refant", "autoflag"]):
+        # Undo the tables of an earlier attempt
+        KATStages.ResetTables(stages, "recal", uv, err)
+        if parms["doRecal"]:
+            mess =  "Redo calibration:"
+            printMess(mess, logFile)
+            EVLAClearCal(uv, err, doGain=True, doFlag=False, doBP=True, check=check, logfile=logFile)
+            OErr.printErrMsg(err, "Error resetting calibration")
+            BPVer = 0
+            # Parallactic angle correction?
+            if parms["doPACor"]:
+                retCode = EVLAPACor(uv, err, \
+                                    logfile=logFile, check=check, debug=debug)
+                if retCode!=0:
+                    raise RuntimeError("Error in Parallactic angle correction")
+
+
+            # Run MKXPhase on delaycal data and attach BP table to UV data
+            if parms["PolCal"]:
+                mess = "XYphase bandpass calibration"
+                printMess(mess, logFile)
+                retCode = KATXPhase(delay_uv, uv, err, logfile=logFile, check=check, debug=debug,
+                                doCalib=-1, flagVer=0, doBand=-1, refAnt=parms['refAnt'])
+                BPVer += 1
             if retCode!=0:
-                raise  RuntimeError("Error in AutoFlag")
+                raise RuntimeError("Error in Xphase calibration")
+
+
+            # Delay recalibration
+            if parms["doDelayCal2"] and parms["DCals"] and not check:
+                plotFile = fileRoot+"_DelayCal2.ps"
+                retCode = KATProfile.Call(profile, EVLADelayCal, uv, parms["DCals"], err, \
+                                       BChan=parms["delayBChan"], EChan=parms["delayEChan"], \
+                                       doCalib=-1, flagVer=0, doBand=doBand, BPVer=BPVer, \
+                                       solInt=parms["delaySolInt"], smoTime=parms["delaySmoo"],  \
+                                       refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], \
+                                       doZeroPhs=parms["delayZeroPhs"], \
+                                       doAvgIF=parms["delayAvgIF"], doAvgPol=parms["delayAvgPol"], \
+                                       doPlot=parms["doSNPlot"], plotFile=plotFile, \
+                                       nThreads=resources["Calib"], noScrat=noScrat, \
+                                       logfile=logFile, check=check, debug=debug)
+                if retCode!=0:
+                    raise RuntimeError("Error in delay calibration")
+
+                # Plot corrected data?
+                if parms["doSpecPlot"] and parms["plotSource"]:
+                    plotFile = fileRoot+"_DelaySpec2.ps"
+                    retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, parms["refAnt"], err, \
+                                           Stokes=["RR","LL"], doband=doband,          \
+                                           check=check, debug=debug, logfile=logFile )
+                    if retCode!=0:
+                        raise  RuntimeError("Error in Plotting spectrum")
+
+            # Bandpass calibration
+            if parms["doBPCal2"] and parms["BPCals"]:
+                retCode = KATProfile.Call(profile, KATBPCal, uv, parms["BPCals"], err, doBand=doBand, BPVer=BPVer, newBPVer=0, \
+                                noScrat=noScrat, solInt1=parms["bpsolint1"], \
+                                solInt2=parms["bpsolint2"], solMode=parms["bpsolMode"], \
+                                BChan1=parms["bpBChan1"], EChan1=parms["bpEChan1"], \
+                                BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
+                                doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
+                                UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
+                                nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
+                if retCode!=0:
+                    raise RuntimeError("Error in Bandpass calibration")
+        
+                # Plot corrected data?
+                if parms["doSpecPlot"] and parms["plotSource"]:
+                    plotFile = fileRoot+"_BPSpec2.ps"
+                    retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, plotFile, parms["refAnt"], err, \
+                                       Stokes=["RR","LL"], doband=1,          \
+                                       check=check, debug=debug, logfile=logFile )
+                if retCode!=0:
+                    raise  RuntimeError("Error in Plotting spectrum")
+
+
+            # Amp & phase Recalibrate
+            if parms["doAmpPhaseCal2"]:
+                plotFile = fileRoot+"_APCal2.ps"
+                retCode = KATProfile.Call(profile, KATCalAP, uv, [], parms["ACals"], err, PCals=parms["PCals"], \
+                                     doCalib=2, doBand=1, BPVer=0, flagVer=0, \
+                                     BChan=parms["ampBChan"], EChan=parms["ampEChan"], \
+                                     solInt=parms["solInt"], solSmo=parms["solSmo"], ampScalar=parms["ampScalar"], \
+                                     doAmpEdit=True, ampSigma=parms["ampSigma"], \
+                                     ampEditFG=parms["ampEditFG"], avgPol=parms["PolCal"], \
+                                     doPlot=parms["doSNPlot"], plotFile=plotFile, refAnt=parms["refAnt"], \
+                                     noScrat=noScrat, nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
+                if retCode!=0:
+                    raise RuntimeError("Error calibrating")
+
+            # More editing
+            if parms["doAutoFlag2"]:
+                mess =  "Post recalibration editing:"
+                printMess(mess, logFile)
+                retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, [], err, flagVer=0, flagTab=2, \
+                                        doCalib=2, gainUse=0, doBand=1, BPVer=0,  \
+                                        IClip=parms["IClip"], minAmp=parms["minAmp"], timeAvg=parms["timeAvg"], \
+                                        doFD=parms["doSecAFFD"], FDmaxAmp=parms["FDmaxAmp"], FDmaxV=parms["FDmaxV"], \
+                                        FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
+                                        FDmaxRes=parms["FDmaxRes"],  FDmaxResBL= parms["FDmaxResBL"], \
+                                        FDbaseSel=parms["FDbaseSel"], \
+                                        nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
+                if retCode!=0:
+                    raise  RuntimeError("Error in AutoFlag")
+        KATStages.StageDone(stages, "recal", state={"BPVer":BPVer}, outputs=[KATStages.TableOutput(uv, "AIPS CL")])
+    else:
+        BPVer = KATStages.StageState(stages, "BPVer", BPVer)
     # end recal
-    # Calibrate and average data
-    # Overwrite avgStokes from command line
-    if kwargs.get('halfstokes'):
-        parms["avgStokes"] = 'HALF'
-    if parms["doCalAvg"] == 'Splat':
-        retCode = KATCalAvg (uv, avgClass, parms["seq"], parms["CalAvgTime"], err, \
-                              flagVer=2, doCalib=2, gainUse=0, doBand=1, BPVer=0, doPol=False, \
-                              avgFreq=parms["avgFreq"], chAvg=parms["chAvg"], Stokes=parms["avgStokes"], \
-                              BChan=1, EChan=parms["selChan"] - 1, doAuto=parms["doAuto"], \
-                              BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
-                              nThreads=nThreads, logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-           raise  RuntimeError("Error in CalAvg")
-    elif parms["doCalAvg"] == 'BL':
-        retCode = KATBLCalAvg (uv, avgClass, parms["seq"], err, \
-                              flagVer=2, doCalib=2, gainUse=0, doBand=1, BPVer=0, doPol=False, \
-                              avgFreq=parms["avgFreq"], chAvg=parms["chAvg"], FOV=parms['FOV'], \
-                              maxInt=min(parms["solPInt"],parms["solAInt"]), Stokes=parms["avgStokes"], \
-                              BChan=1, EChan=parms["selChan"] - 1, timeAvg=parms["CalAvgTime"], \
-                              BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
-                              logfile=logFile, check=check, debug=debug)
-        if retCode!=0:
-           raise  RuntimeError("Error in BLCalAvg")
 
-    if parms["doSaveTab"]:
-        filename = project+".CalTab.uvtab"
-        _ = EVLAUVFITSTab (uv, filename, 0, err, logfile=logFile)
+    if KATStages.RunStage(stages, "calavg", inputs=["recal"]):
+        # Calibrate and average data
+        # Overwrite avgStokes from command line
+        if kwargs.get('halfstokes'):
+            parms["avgStokes"] = 'HALF'
+        if parms["doCalAvg"] == 'Splat':
+            retCode = KATProfile.Call(profile, KATCalAvg, uv, avgClass, parms["seq"], parms["CalAvgTime"], err, \
+                                  flagVer=2, doCalib=2, gainUse=0, doBand=1, BPVer=0, doPol=False, \
+                                  avgFreq=parms["avgFreq"], chAvg=parms["chAvg"], Stokes=parms["avgStokes"], \
+                                  BChan=1, EChan=parms["selChan"] - 1, doAuto=parms["doAuto"], \
+                                  BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
+                                  nThreads=resources["Splat"], logfile=logFile, check=check, debug=debug)
+            if retCode!=0:
+               raise  RuntimeError("Error in CalAvg")
+        elif parms["doCalAvg"] == 'BL':
+            retCode = KATProfile.Call(profile, KATBLCalAvg, uv, avgClass, parms["seq"], err, \
+                                  flagVer=2, doCalib=2, gainUse=0, doBand=1, BPVer=0, doPol=False, \
+                                  avgFreq=parms["avgFreq"], chAvg=parms["chAvg"], FOV=parms['FOV'], \
+                                  maxInt=min(parms["solPInt"],parms["solAInt"]), Stokes=parms["avgStokes"], \
+                                  BChan=1, EChan=parms["selChan"] - 1, timeAvg=parms["CalAvgTime"], \
+                                  BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
+                                  logfile=logFile, check=check, debug=debug)
+            if retCode!=0:
+               raise  RuntimeError("Error in BLCalAvg")
+
+        if parms["doSaveTab"]:
+            filename = project+".CalTab.uvtab"
+            _ = EVLAUVFITSTab (uv, filename, 0, err, logfile=logFile)
+
+        #Zap unaveraged data if requested
+        if kwargs.get('zapraw'):
+            uv.Zap(err)
+        avg_uv = None
+        if not check:
+            avg_uv = UV.newPAUV("AIPS UV DATA", EVLAAIPSName(project), avgClass[0:6], \
+                                disk, parms["seq"], True, err)
+        KATStages.StageDone(stages, "calavg", outputs=[KATStages.AIPSOutput(avg_uv)])
 
-    #Zap unaveraged data if requested
-    if kwargs.get('zapraw'):
-        uv.Zap(err)
-    
     # Get calibrated/averaged data
     if not check:
         uv = UV.newPAUV("AIPS UV DATA", EVLAAIPSName(project), avgClass[0:6], \
@@ -631,21 +717,22 @@ def MKContPipeline(files, outputdir, **kwargs):
         if err.isErr:
             OErr.printErrMsg(err, "Error creating cal/avg AIPS data")
 
-    plotFile = fileRoot+"_Spec.ps"
-    retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, \
-                               plotFile, parms["refAnt"], err, \
-                               Stokes=["I"], doband=-1, docalib=-1,      \
-                               check=check, debug=debug, logfile=logFile )
-    if retCode!=0:
-        raise  RuntimeError("Error in Plotting spectrum")
-
-    # KATUVFITS(uv, 'preimage.uvfits', 0, err, exclude=["AIPS HI", "AIPS SL", "AIPS PL"], 
-    # include=["AIPS AN", "AIPS FQ"], compress=parms["Compress"], logfile=logFile)
-    KATUVFITab(uv, project+'.uvtab', 0, err)
-    #Gzip the data?
-    if kwargs.get('gzip'):
-        os.system('pigz -p %d %s'%(nThreads, project+'.uvtab'))
-        os.system('rm -f %s'%(project+'.uvtab'))
+    if KATStages.RunStage(stages, "export", inputs=["calavg"]):
+        plotFile = fileRoot+"_Spec.ps"
+        retCode = EVLASpectrum(uv, parms["BPCal"], parms["plotTime"], maxgap, \
+                                   plotFile, parms["refAnt"], err, \
+                                   Stokes=["I"], doband=-1, docalib=-1,      \
+                                   check=check, debug=debug, logfile=logFile )
+        if retCode!=0:
+            raise  RuntimeError("Error in Plotting spectrum")
+
+        # KATUVFITS(uv, 'preimage.uvfits', 0, err, exclude=["AIPS HI", "AIPS SL", "AIPS PL"], 
+        # include=["AIPS AN", "AIPS FQ"], compress=parms["Compress"], logfile=logFile)
+        # Compress the data?
+        compress = 'zstd' if kwargs.get('zstd') else 'gzip' if kwargs.get('gzip') else None
+        uvtabFile, = KATExport.ExportUV(uv, [("fitab", project+'.uvtab')], err, compress=compress,
+                                        nThreads=nThreads, logfile=logFile)
+        KATStages.StageDone(stages, "export", outputs=[KATStages.FileOutput(uvtabFile)])
 
 class DataProductError(Exception):
     """ Exception for data product (output file) errors. """
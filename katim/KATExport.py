@@ -0,0 +1,297 @@
+""" Export of AIPS data products to FITS files
+
+All the requested FITS products are written concurrently by the AIPS
+tasks FITTP/FITAB (or Obit for "imtab" images). UV data are read by the
+tasks directly unless several products are wanted from data holding
+tables that are to be left out, when they are first copied once with the
+selected tables to a temporary AIPS file. Images, which are small, are
+always copied. Compressed products are written to a staging directory in
+memory (/dev/shm) and streamed from there through an in-process
+multithreaded gzip or, if the zstandard package is installed, zstd
+compressor into the output file.
+
+Limitation: the uncompressed FITS file is always staged as a file, since
+FITS writers may seek back in their output so cannot write to a pipe. If
+no staging directory has room it is staged in the output directory, so a
+compressed export then needs the disk space of the uncompressed file.
+"""
+#-----------------------------------------------------------------------
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#-----------------------------------------------------------------------
+import os, re, struct, shutil, tempfile, threading, time, zlib
+import collections, concurrent.futures, itertools
+import UV, Image, OErr, OSystem, AIPSDir, History, TableList
+from PipeUtil import setname, printMess
+from . import AIPSLiteTask as AIPSTask
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Directories tried in order for uncompressed staging copies
+STAGING_DIRS = ['/dev/shm']
+# Size in bytes of the blocks compressed by each thread
+COMPRESS_BLOCK = 4 * 1024 * 1024
+# File name suffix of each compression method
+COMPRESS_SUFFIX = {'gzip':'.gz', 'zstd':'.zst'}
+
+# Unique AIPS sequence numbers and logical names for concurrent exports
+_lock = threading.Lock()
+_counter = itertools.count(1)
+
+def CompressFile(src, dest, method='gzip', nThreads=1, level=6):
+    """
+    Compress file src to dest, streaming through nThreads threads
+
+    gzip output is a single gzip member of independently deflated
+    blocks (as made by pigz), readable by any gzip reader.
+    * src      = input file name
+    * dest     = output file name
+    * method   = 'gzip' or 'zstd'
+    * nThreads = number of compression threads
+    * level    = compression level
+    """
+    ################################################################
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        if method == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("zstd compression needs the zstandard package")
+            cctx = zstandard.ZstdCompressor(level=level, threads=nThreads)
+            with cctx.stream_writer(fout, closefd=False) as writer:
+                shutil.copyfileobj(fin, writer, COMPRESS_BLOCK)
+        elif method == 'gzip':
+            _gzip_stream(fin, fout, nThreads, level)
+        else:
+            raise ValueError("Unknown compression method "+str(method))
+    # end CompressFile
+
+def _deflate(block, level):
+    """ Raw deflate block ending on a byte boundary so blocks can be joined """
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(block) + comp.flush(zlib.Z_SYNC_FLUSH)
+
+def _gzip_stream(fin, fout, nThreads, level):
+    """ Write fin to fout as gzip, deflating blocks in a thread pool """
+    # Header: deflate, no flags, mtime, no extra flags, unknown OS
+    fout.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+    crc = 0
+    size = 0
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max(1, nThreads)) as pool:
+        while True:
+            block = fin.read(COMPRESS_BLOCK)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            pending.append(pool.submit(_deflate, block, level))
+            # Bound the blocks held in memory
+            while len(pending) > 2 * nThreads:
+                fout.write(pending.popleft().result())
+        while pending:
+            fout.write(pending.popleft().result())
+    # Final empty block and trailer
+    fout.write(zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+    fout.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+    # end _gzip_stream
+
+def StagingDir(size, fallback, logfile=""):
+    """
+    Directory for uncompressed copies of size bytes
+
+    The first of STAGING_DIRS with room, else fallback.
+    * size     = bytes needed
+    * fallback = directory used if no staging directory has room
+    * logfile  = logfile for messages
+    """
+    ################################################################
+    for sdir in STAGING_DIRS:
+        if os.path.isdir(sdir) and shutil.disk_usage(sdir).free > 1.1 * size:
+            return sdir
+    mess = "WARN No room for %.1f GB in %s, staging uncompressed copy on disk in %s" % \
+        (size / 1024.**3, ", ".join(STAGING_DIRS), fallback)
+    printMess(mess, logfile)
+    return fallback
+    # end StagingDir
+
+def ExportUV(inUV, products, err, compress=None, nThreads=1, \
+             exclude=["AIPS HI", "AIPS SL", "AIPS PL"], \
+             include=["AIPS AN", "AIPS FQ", "AIPS SU"], logfile=""):
+    """
+    Write UV data to several FITS files
+
+    The tasks read inUV directly if only one product is wanted or inUV has
+    no tables to leave out, then all its tables are written. Otherwise inUV
+    is copied once with the selected tables and the products written from
+    the copy.
+    * inUV       = UV data to write
+    * products   = list of (task, filename) with task "fittp" (UVFITS)
+                   or "fitab" (FITAB), whitespace in filename replaced with underscore
+    * err        = Python Obit Error/message stack
+    * compress   = None, 'gzip' or 'zstd', appends .gz or .zst to the filenames
+    * nThreads   = Max. number of compression threads
+    * exclude    = List of table types NOT to copy
+    * include    = List of table types to copy (FQ, AN always done )
+    * logfile    = logfile for messages
+    Returns list of the files written
+    """
+    ################################################################
+    if not UV.PIsA(inUV):
+        raise TypeError("inUV MUST be a Python Obit UV")
+    d = inUV.Desc.Dict
+    size = d["nvis"] * d["lrec"] * 4
+    if len(products) == 1 or not _filterTables(inUV, exclude, include, err):
+        return _export(inUV, products, size, compress, nThreads, logfile)
+    seq = _tempSeq(inUV.Disk, "UV")
+    mess = "Copy UV data for export to "+", ".join(fn for task, fn in products)
+    printMess(mess, logfile)
+    tempUV = UV.newPAUV("AIPS UV DATA", "EXPORT", "TEMP", inUV.Disk, seq, False, err)
+    UV.PCopy(inUV, tempUV, err)
+    UV.PCopyTables(inUV, tempUV, exclude, include, err)
+    if err.isErr:
+        OErr.printErrMsg(err, "Error copying UV data for export")
+    try:
+        return _export(tempUV, products, size, compress, nThreads, logfile)
+    finally:
+        tempUV.Zap(err)
+    # end ExportUV
+
+def ExportImage(inImage, products, err, compress=None, nThreads=1, \
+                exclude=["AIPS HI","AIPS PL","AIPS SL"], include=["AIPS CC"], logfile=""):
+    """
+    Write an image to several FITS files from one copy
+
+    * inImage    = Image data to copy
+    * products   = list of (task, filename) with task "fittp" (AIPS FITTP)
+                   or "imtab" (Obit, as EVLAImFITS)
+    * err        = Python Obit Error/message stack
+    * compress   = None, 'gzip' or 'zstd', appends .gz or .zst to the filenames
+    * nThreads   = Max. number of compression threads
+    * exclude    = List of table types NOT to copy
+    * include    = List of table types to copy
+    * logfile    = logfile for messages
+    Returns list of the files written
+    """
+    ################################################################
+    if not Image.PIsA(inImage):
+        raise TypeError("inImage MUST be a Python Obit Image")
+    d = inImage.Desc.Dict
+    size = 4
+    for n in d["inaxes"][:d["naxis"]]:
+        size *= max(1, n)
+    seq = _tempSeq(inImage.Disk, "MA")
+    tempImage = Image.newPAImage("AIPS Image DATA", "EXPORT", "TEMP", inImage.Disk, seq, False, err)
+    Image.PCopy(inImage, tempImage, err)
+    Image.PCopyTables(inImage, tempImage, exclude, include, err)
+    if err.isErr:
+        OErr.printErrMsg(err, "Error copying Image data for export")
+    try:
+        return _export(tempImage, products, size, compress, nThreads, logfile)
+    finally:
+        tempImage.Zap(err)
+    # end ExportImage
+
+def _filterTables(inData, exclude, include, err):
+    """ Does inData hold tables that a copy with exclude/include would drop? """
+    tables = set(name for ver, name in TableList.PGetList(inData.TableList, err))
+    OErr.printErrMsg(err, "Error reading table list")
+    # History is always copied, AN and FQ always kept
+    tables -= set(["AIPS HI", "AIPS AN", "AIPS FQ"])
+    for name in tables:
+        if name in exclude or (include and name not in include):
+            return True
+    return False
+    # end _filterTables
+
+def _tempSeq(disk, Atype):
+    """ Free sequence number of EXPORT.TEMP, not used by another export """
+    user = OSystem.PGetAIPSuser()
+    err = OErr.OErr()
+    with _lock:
+        while True:
+            seq = next(_counter)
+            if AIPSDir.PTestCNO(disk, user, "EXPORT", "TEMP", Atype, seq, err) <= 0:
+                OErr.PClear(err)
+                return seq
+    # end _tempSeq
+
+def _export(data, products, size, compress, nThreads, logfile):
+    """ Write the products of AIPS data concurrently, compressing them """
+    outdir = os.path.dirname(os.path.abspath(products[0][1]))
+    stage = None
+    if compress:
+        stage = tempfile.mkdtemp(prefix="katexport", dir=StagingDir(size * len(products), outdir, logfile))
+    threads = max(1, nThreads // len(products))
+    def _product(product):
+        task, filename = product
+        fn = re.sub(r'\s', '_', filename)
+        out = fn
+        if compress:
+            out = os.path.join(stage, os.path.basename(fn))
+            fn += COMPRESS_SUFFIX[compress]
+        for f in (out, fn):
+            if os.path.exists(f):
+                os.remove(f)
+        start = time.time()
+        if task == "imtab":
+            _imtab(data, out)
+        else:
+            _fits_task(data, task, out)
+        if compress:
+            CompressFile(out, fn, method=compress, nThreads=threads)
+            os.remove(out)
+        mess = "Wrote %s in %.1f s" % (fn, time.time() - start)
+        printMess(mess, logfile)
+        return fn
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(products)) as pool:
+            return list(pool.map(_product, products))
+    finally:
+        if stage:
+            shutil.rmtree(stage, ignore_errors=True)
+    # end _export
+
+def _fits_task(data, taskname, filename):
+    """ Run AIPS FITTP/FITAB on data writing filename """
+    # Each product has its own logical name for its directory
+    with _lock:
+        area = "KATEX%d" % next(_counter)
+    pth, fnn = os.path.split(os.path.abspath(filename))
+    os.environ[area] = pth
+    fittp = AIPSTask.AIPSTask(taskname)
+    try:
+        fittp.userno = OSystem.PGetAIPSuser()   # This sometimes gets lost
+    except Exception as exception:
+        pass
+    setname(data, fittp)
+    fittp.dataout = area+':'+fnn
+    try:
+        fittp.g
+    finally:
+        del os.environ[area]
+    # end _fits_task
+
+def _imtab(data, filename):
+    """ Write image data to filename with Obit, as EVLAImFITS """
+    err = OErr.OErr()
+    outImage = Image.newPFImage("FITS Image DATA", filename, 0, False, err)
+    Image.PCopy(data, outImage, err)
+    inHistory  = History.History("inhistory",  data.List, err)
+    outHistory = History.History("outhistory", outImage.List, err)
+    History.PCopy(inHistory, outHistory, err)
+    outHistory.Open(History.READWRITE, err)
+    outHistory.TimeStamp(" Start Obit imtab",err)
+    outHistory.WriteRec(-1,"imtab   / FITS file "+os.path.basename(filename),err)
+    outHistory.Close(err)
+    Image.PCopyTables(data, outImage, ["AIPS HI","AIPS PL","AIPS SL"], ["AIPS CC"], err)
+    OErr.printErrMsg(err, "Error writing FITS image "+filename)
+    del outImage
+    # end _imtab
@@ -42,19 +42,44 @@ except Exception as exception:
 else:
     pass
 from collections import namedtuple
-import time,math,os
+import time,os
 import UV, UVVis, OErr, UVDesc, Table, History
 from OTObit import day2dhms
 import numpy
 import itertools
+import hashlib
 from astropy.io import fits as pyfits
 import multiprocessing
+import queue
+import threading
 import concurrent.futures
 import dask
 import dask.array as da
 import numba
 from katsdpsigproc.rfi.twodflag import SumThresholdFlagger
 from textwrap import TextWrapper
+from . import MakeIFs
+from . import KATTableUtil
+
+# Maximum number of dumps to pack into a single UV write
+WRITE_BATCH = 151
+# Upper limit (in MB) on the size of the UV write buffer
+WRITE_MAXMEM = 2048.
+# Number of sets of dump storage in flight when pipelining the conversion
+# (one each being read, flagged and written)
+PIPELINE_BUFFERS = 3
+# Maximum number of chunks waiting between pipeline stages
+PIPELINE_QUEUE = 1
+# Number of times to try reading each chunk before giving up
+NUM_RETRIES = 3
+# Number of dumps to read at at time when the chunking of the data is unknown
+CHUNK_SIZE = 2
+# Delay in seconds before the first retry of a read, doubled for each retry after
+RETRY_DELAY = 1.0
+# Number of chunks to read concurrently
+LOAD_THREADS = 8
+# Number of dumps either side of a chunk to include when flagging it
+FLAG_OVERLAP = 20
 
 """ TextWrapper for wrapping AIPS history text to 70 chars """
 _history_wrapper = TextWrapper(width=70, initial_indent='',
@@ -87,6 +112,35 @@ def KAT2AIPS (katdata, outUV, disk, fitsdisk, err, \
         List of targetnames to extract from the file
     stop_w : bool
         Fring stop data? (Values only for KAT-7)
+    write_batch : int, optional
+        Maximum number of dumps to write to AIPS per I/O call
+    write_maxmem : float, optional
+        Upper limit in MB on the size of the UV write buffer
+    pipeline : bool, optional
+        Overlap reading, flagging and writing of the data (default True)
+    load_threads : int, optional
+        Number of chunks of data to read concurrently
+    flag_threads : int, optional
+        Number of flagger worker threads (default number of cores)
+    flag_overlap : int, optional
+        Dumps either side of each chunk included when flagging it
+    nworkers : int, optional
+        Number of processes converting groups of scans in parallel
+        (default 1: convert in this process)
+    scratchdir : str, optional
+        Directory for the scratch files of a parallel conversion
+    uvw_cache : str, optional
+        Directory to cache the UVW coordinates of each target in between runs
+    loadhalf : bool, optional
+        Only convert the HH and VV products (outUV must have 2 Stokes,
+        see CreateKATUV)
+    chanav : int, optional
+        Number of channels to average on conversion (outUV must be a
+        data set with the averaged number of channels, see CreateKATUV)
+    flagtab : bool, optional
+        Write the flags to FG table 1 as compressed time/channel regions
+        instead of negating the weights of flagged data, so they can be
+        undone (default False)
     """
     ################################################################
     OErr.PLog(err, OErr.Info, "Converting MVF data to AIPS UV format.")
@@ -94,10 +148,12 @@ def KAT2AIPS (katdata, outUV, disk, fitsdisk, err, \
     print("Converting MVF data to AIPS UV format.\n")
 
     # Extract metadata
-    meta = GetKATMeta(katdata, err)
+    meta = GetKATMeta(katdata, err, loadhalf=kwargs.get('loadhalf',False), chanav=kwargs.get('chanav',1))
 
     # TODO: Fix this all up so that the below isn't the case!
-    if meta["products"].size != meta["nants"] * meta["nants"] * 4:
+    if meta["products"].size != meta["nants"] * meta["nants"] * meta["nstokes"] or (meta["products"] < 0).any():
+        if kwargs.get('loadhalf',False):
+            raise ValueError("HH and VV correlation products are needed for all baselines.")
         raise ValueError("Only full stokes and all correlation products are supported.")
 
     # Extract AIPS parameters of the uv data to the metadata
@@ -117,7 +173,16 @@ def KAT2AIPS (katdata, outUV, disk, fitsdisk, err, \
     WriteSUTable (outUV, meta, err)
 
     # Convert data
-    ConvertKATData(outUV, katdata, meta, err, static=static, blmask=kwargs.get('blmask',1.e10), stop_w=kwargs.get('stop_w',False), timeav=kwargs.get('timeav',1), flag=kwargs.get('flag',False), doweight=kwargs.get('doweight',True), doflags=kwargs.get('doflags',True))
+    convert_parms = dict(static=static, blmask=kwargs.get('blmask',1.e10), stop_w=kwargs.get('stop_w',False), timeav=kwargs.get('timeav',1), chanav=kwargs.get('chanav',1), flag=kwargs.get('flag',False), doweight=kwargs.get('doweight',True), doflags=kwargs.get('doflags',True),
+                         write_batch=kwargs.get('write_batch',WRITE_BATCH), write_maxmem=kwargs.get('write_maxmem',WRITE_MAXMEM),
+                         pipeline=kwargs.get('pipeline',True), load_threads=kwargs.get('load_threads',LOAD_THREADS),
+                         flag_threads=kwargs.get('flag_threads',None), flag_overlap=kwargs.get('flag_overlap',FLAG_OVERLAP),
+                         uvw_cache=kwargs.get('uvw_cache',None), flagtab=kwargs.get('flagtab',False))
+    nworkers = kwargs.get('nworkers',1)
+    if nworkers > 1:
+        ConvertKATDataParallel(outUV, katdata, meta, err, nworkers=nworkers, scratch=kwargs.get('scratchdir',None), **convert_parms)
+    else:
+        ConvertKATData(outUV, katdata, meta, err, **convert_parms)
 
     # Index data
     OErr.PLog(err, OErr.Info, "Indexing data")
@@ -157,7 +222,7 @@ def KAT2AIPS (katdata, outUV, disk, fitsdisk, err, \
     return meta
    # end KAT2AIPS
 
-def GetKATMeta(katdata, err):
+def GetKATMeta(katdata, err, loadhalf=False, chanav=1):
     """
     Get KAT metadata and return as a dictionary.
 
@@ -165,6 +230,9 @@ def GetKATMeta(katdata, err):
     ----------
      * katdata  = input KAT dataset
      * err      = Python Obit Error/message stack to init
+     * loadhalf = Only use the HH and VV products (nstokes=2)?
+     * chanav   = Number of channels averaged on conversion, the spectral
+                  window describes the averaged channels
 
      Returns : dictionary
      "spw"     Spectral window array as tuple (nchan, freq0, chinc)
@@ -183,13 +251,16 @@ def GetKATMeta(katdata, err):
      "nstokes"  Number of stokes parameters
      "products" Tuple per data product (ant1, ant2, offset)
                 where offset is the index on the Stokes axis (XX=0...)
+     "blIndex"  BaselineIndex of the baselines and correlation products
     """
     ################################################################
     # Checks
     out = {}
     # Spectral windows
     sw = []
-    out["spw"] = [(len(katdata.channels), katdata.channel_freqs[0], katdata.channel_freqs[1]-katdata.channel_freqs[0])]
+    numchan = len(katdata.channels) // chanav
+    channel_freqs = katdata.channel_freqs[:numchan*chanav].reshape(numchan, chanav).mean(axis=1)
+    out["spw"] = [(numchan, channel_freqs[0], (katdata.channel_freqs[1]-katdata.channel_freqs[0])*chanav)]
     # targets
     tl = []
     tb = []
@@ -248,27 +319,16 @@ def GetKATMeta(katdata, err):
     out["antLookup"] = alook
     out["maxant"] = max([alook[i] for i in alook])
     # Data products
-    nstokes = 4
+    if loadhalf:
+        nstokes = 2
+    else:
+        nstokes = 4
     #Set up array linking corr products to indices
-    dl = numpy.empty((out["nants"], out["nants"], nstokes), dtype=numpy.int)
-    bl = []
-    for idx, d in enumerate(katdata.corr_products):
-        a1 = antnums.index(alook[d[0][:4]])
-        a2 = antnums.index(alook[d[1][:4]])
-        if d[0][4:]=='h' and d[1][4:]=='h':
-            dp = 0
-        elif d[0][4:]=='v' and d[1][4:]=='v':
-            dp = 1
-        elif d[0][4:]=='h' and d[1][4:]=='v':
-            dp = 2
-        else:
-            dp = 3
-        dl[a1, a2, dp] = idx
-        #Fill the matrix with the inverse baselines
-        dl[a2, a1, dp] = idx
-    out["baselines"] = numpy.array([(b[0],b[1]) for b in itertools.combinations_with_replacement(antnums,2)])
-    out["blineind"] = numpy.array([(b[0],b[1]) for b in itertools.combinations_with_replacement(list(range(out["nants"])),2)])
-    out["products"] = dl
+    bl_index = GetBaselineIndex(out["newants"], katdata.corr_products, antnums, nstokes)
+    out["blIndex"]  = bl_index
+    out["baselines"] = bl_index.baselines
+    out["blineind"] = bl_index.blineind
+    out["products"] = bl_index.products
     out["nstokes"]  = nstokes
     # integration time
     out["tinteg"] = katdata.dump_period
@@ -278,18 +338,143 @@ def GetKATMeta(katdata, err):
     # Observer's name
     out["observer"] = katdata.observer
     # Number of channels
-    numchan = len(katdata.channels)
     out["numchan"] = numchan
     # Correlator mode (assuming 1 spectral window KAT-7)
     out["corrmode"] = katdata.spectral_windows[0].product
     # Central frequency (in Hz)
-    out["centerfreq"] = katdata.channel_freqs[numchan //2]
+    out["centerfreq"] = channel_freqs[numchan //2]
     # Expose all KAT-METADATA to calling script
     out["katdata"] = katdata
     out["RX"] = katdata.spectral_windows[katdata.spw].band
     return out
     # end GetKATMeta
 
+""" Baselines and correlation products of a dataset, see GetBaselineIndex """
+BaselineIndex = namedtuple('BaselineIndex', ['baselines', 'blineind', 'aips_bl',
+                                             'products', 'prod_ants', 'prod_pol',
+                                             'prod_length'])
+
+# Stokes axis offset of each pair of feeds (XX=0, YY=1, XY=2, YX=3)
+_POL_OFFSET = {('h', 'h'): 0, ('v', 'v'): 1, ('h', 'v'): 2, ('v', 'h'): 3}
+
+def GetBaselineIndex(ants, corr_products, antnums, nstokes=4):
+    """
+    Build the lookup tables between antennas, baselines and correlation
+    products in one pass over the products.
+
+     * ants          = list of katpoint Antennas, in AIPS antenna order
+     * corr_products = katdal correlation products, array of (inp1, inp2)
+     * antnums       = AIPS antenna number of each of ants
+     * nstokes       = number of Stokes products to index (2 = HH,VV only)
+
+     Returns : BaselineIndex
+     "baselines"   (nbase, 2) AIPS antenna numbers of each baseline,
+                   autocorrelations included
+     "blineind"    (nbase, 2) indices into ants of each baseline
+     "aips_bl"     AIPS baseline random parameter of each baseline
+     "products"    (nants, nants, nstokes) index into corr_products of each
+                   antenna pair and Stokes, -1 if missing
+     "prod_ants"   (nprod, 2) indices into ants of each product
+     "prod_pol"    Stokes axis offset of each product
+     "prod_length" Baseline length in m of each product
+    """
+    ################################################################
+    nants = len(ants)
+    antind = dict((ant.name, i) for i, ant in enumerate(ants))
+    prod_ants = numpy.array([(antind[inp1[:-1]], antind[inp2[:-1]]) for inp1, inp2 in corr_products], dtype=int).reshape(-1, 2)
+    prod_pol = numpy.array([_POL_OFFSET[(inp1[-1:], inp2[-1:])] for inp1, inp2 in corr_products], dtype=int)
+    # Baseline lengths from the antenna positions
+    ecef = numpy.array([ant.position_ecef for ant in ants])
+    prod_length = numpy.linalg.norm(ecef[prod_ants[:, 1]] - ecef[prod_ants[:, 0]], axis=1)
+    # Product matrix, cross hands aren't used in half stokes
+    dl = numpy.full((nants, nants, nstokes), -1, dtype=int)
+    use = numpy.nonzero(prod_pol < nstokes)[0]
+    a1, a2, dp = prod_ants[use, 0], prod_ants[use, 1], prod_pol[use]
+    #Fill the matrix with the inverse baselines first so the products win
+    dl[a2, a1, dp] = use
+    dl[a1, a2, dp] = use
+    # Baselines
+    blineind = numpy.array(list(itertools.combinations_with_replacement(range(nants), 2)), dtype=int).reshape(-1, 2)
+    baselines = numpy.asarray(antnums)[blineind]
+    return BaselineIndex(baselines=baselines, blineind=blineind,
+                         aips_bl=get_aips_baselines(baselines), products=dl,
+                         prod_ants=prod_ants, prod_pol=prod_pol,
+                         prod_length=prod_length)
+
+def CreateKATUV(katdata, Aname, Aclass, disk, seq, err, loadhalf=False, chanav=1):
+    """
+    Create an empty AIPS UV data set with the geometry of katdata
+
+    Builds the descriptor from GetKATMeta directly through Obit, so no
+    UVFITS template has to be rewritten and loaded with uvlod.
+    The AN, FQ and SU tables are written by KAT2AIPS.
+    Returns the new Obit UV object.
+
+    * katdata  = input KAT dataset
+    * Aname    = AIPS name of the new data set
+    * Aclass   = AIPS class of the new data set
+    * disk     = AIPS disk number
+    * seq      = AIPS sequence number
+    * err      = Python Obit Error/message stack to init
+    * loadhalf = If True the data set has HH and VV only
+    * chanav   = Number of channels that will be averaged on conversion
+    """
+    ################################################################
+    meta = GetKATMeta(katdata, err, loadhalf=loadhalf, chanav=chanav)
+    return CreateUVFromMeta(meta, Aname, Aclass, disk, seq, err)
+    # end CreateKATUV
+
+def CreateUVFromMeta(meta, Aname, Aclass, disk, seq, err):
+    """
+    Create an empty AIPS UV data set described by a GetKATMeta dict
+
+    Returns the new Obit UV object.
+
+    * meta     = dict with data meta data
+    * Aname    = AIPS name of the new data set
+    * Aclass   = AIPS class of the new data set
+    * disk     = AIPS disk number
+    * seq      = AIPS sequence number
+    * err      = Python Obit Error/message stack to init
+    """
+    ################################################################
+    outUV = UV.newPAUV("AIPS UV DATA", Aname, Aclass, disk, seq, False, err)
+    if err.isErr:
+        OErr.printErrMsg(err, "Error creating AIPS UV data")
+    chinc   =  meta["spw"][0][2]   # Frequency increment
+    reffreq =  meta["spw"][0][1]   # reference frequency
+    nchan   =  meta["spw"][0][0]   # number of channels
+    nstok   = meta["nstokes"]      # Number of Stokes products
+    desc = outUV.Desc.Dict
+    desc['nvis']       = 0
+    desc['nrparm']     = 6
+    desc['ptype']      = ['UU-L-SIN', 'VV-L-SIN', 'WW-L-SIN', 'BASELINE', 'TIME1', 'SOURCE']
+    desc['naxis']      = 6
+    desc['inaxes']     = [3, nstok, nchan, 1, 1, 1, 0]
+    desc['ctype']      = ['COMPLEX', 'STOKES', 'FREQ', 'IF', 'RA', 'DEC']
+    desc['cdelt']      = [1.0, -1.0, chinc, 1.0, 0.0, 0.0, 0.0]
+    desc['crval']      = [1.0, -5.0, reffreq, 1.0, 0.0, 0.0, 0.0]
+    desc['crpix']      = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+    desc['crota']      = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    desc['object']     = 'MULTI'
+    desc['teles']      = 'MeerKAT'
+    desc['instrument'] = 'MeerKAT'
+    desc['observer']   = meta["observer"]
+    desc['obsdat']     = meta["obsdate"]
+    desc['JDObs']      = UVDesc.PDate2JD(meta["obsdate"])
+    desc['epoch']      = 2000.0
+    desc['equinox']    = 2000.0
+    desc['isort']      = 'TB'
+    outUV.Desc.Dict = desc
+    UV.PGetIODesc(outUV).Dict = desc
+    # Creating the file on open fixes the geometry
+    outUV.Open(UV.WRITEONLY, err)
+    outUV.Close(err)
+    if err.isErr:
+        OErr.printErrMsg(err, "Error creating AIPS UV data")
+    return outUV
+    # end CreateUVFromMeta
+
 def UpdateDescriptor (outUV, meta, err):
     """
     Update information in data descriptor
@@ -330,7 +515,7 @@ def WriteANTable(outUV, meta, err):
      * err      = Python Obit Error/message stack to init
     """
     ################################################################
-    antab = outUV.NewTable(Table.READWRITE, "AIPS AN",1,err)
+    antab = outUV.NewTable(Table.READWRITE, "AIPS AN",1,err,numPCal=2)
     if err.isErr:
         OErr.printErrMsg(err, "Error with AN table")
     antab.Open(Table.READWRITE, err)
@@ -344,10 +529,12 @@ def WriteANTable(outUV, meta, err):
     antab.keys['DEGPDY']  = UVDesc.ERate(JD)*360.0
     Table.PDirty(antab)
     # Force update
-    row = antab.ReadRow(1,err)
-    if err.isErr:
-        OErr.printErrMsg(err, "Error reading AN table")
-    OErr.printErr(err)
+    # Create row
+    row = {'ANNAME': ['        '], 'STABXYZ': [0.0, 0.0, 0.0], 'ORBPARM': [], 'NOSTA': [0], \
+           'MNTSTA': [0], 'STAXOF': [0.0], 'DIAMETER': [0.0], 'BEAMFWHM': [0.0], \
+           'POLTYA': ['X   '], 'POLAA': [90.0], 'POLCALA': [0.0, 0.0], \
+           'POLTYB': ['Y   '], 'POLAB': [0.0], 'POLCALB': [0.0, 0.0], \
+           'NumFields': 15, 'Table name': 'AIPS AN', '_status': [0]}
     irow = 0
     for ant in meta["ants"]:
         irow += 1
@@ -417,57 +604,64 @@ def WriteFQTable(outUV, meta, err):
         OErr.printErrMsg(err, "Error closing FQ table")
     # end WriteFQTable
 
-def WriteFGTable(outUV, katdata, meta, err):
+def WriteFGTable(outUV, flags, err, flagVer=1, reason='Online flag'):
     """
-    Get the flags from the h5 file and convert to FG table format.
-    UNUSED- This implimentation is too slow!
-    outUV    = Obit UV object
-    meta     =  dict with data meta data
-    err      = Python Obit Error/message stack to init
+    Write compressed flags to an FG table in a single table open.
+    Rows are appended to any already in the table, in time order.
+
+     * outUV    = Obit UV object
+     * flags    = dict of flag regions from compress_flags
+     * err      = Python Obit Error/message stack to init
+     * flagVer  = FG table version
+     * reason   = Reason string for the flags
+    Returns the number of rows written
     """
-    ###############################################################
+    ################################################################
+    return KATTableUtil.AppendFlags(outUV, flags, err, flagVer=flagVer, reason=reason)
+    # end WriteFGTable
 
-    # work out Start time in unix sec
-    tm = katdata.timestamps[1:2]
-    tx = time.gmtime(tm[0])
-    time0   = tm[0] - tx[3]*3600.0 - tx[4]*60.0 - tx[5]
-    int_time = katdata.dump_period
+def compress_flags(fg, tm, interval, p, bi, aips_bl):
+    """
+    Run-length encode a flag cube into rectangles in time and channel.
 
-    #Loop through scans in h5 file
-    row = 0
-    for scan, state, target in katdata.scans():
-        name=target.name.replace(' ','_')
-        if state != 'track':
-            continue
-        tm = katdata.timestamps[:]
-        nint=len(tm)
-        el=target.azel(tm[int(nint/2)])[1]*180./math.pi
-        if el<15.0:
-            continue
-        row+=1
-        flags = katdata.flags()[:]
-        numflag = 0
-        for t, chan_corr in enumerate(flags):
-            for c, chan in enumerate(chan_corr):
-                cpflagged=[]
-                for p, cp in enumerate(chan):
-                #for cpaverage in meta['pairLookup']:
-                    flag=cp #numpy.any(chan[meta['pairLookup'][cpaverage]])
-                    product=meta['products'][p]
-                    if product[0] == product[1]:
-                        continue
-                    if flag and (not product[0:2] in cpflagged):
-                        cpflagged.append(product[0:2])
-                        numflag+=1
-                        starttime=float((tm[t]-time0 - (int_time/2))/86400.0)
-                        endtime=float((tm[t]-time0 + (int_time/2))/86400.0)
-                        UV.PFlag(outUV,err,timeRange=[starttime,endtime], flagVer=1, \
-                                     Ants=[product[0],product[1]], \
-                                     Chans=[c+1,c+1], IFs=[1,1], Stokes='1111', Reason='Online flag')
-        numvis=t*c*(p/meta["nstokes"])
-        msg = "Scan %4d %16s   Online flags: %7s of %8s vis"%(row,name,numflag,numvis)
-        OErr.PLog(err, OErr.Info, msg);
-        OErr.printErr(err)
+    The flags of each baseline are ORed over the polarisation products,
+    runs of flagged channels are found in each dump and identical runs
+    in consecutive dumps are merged into one region.
+
+    * fg       = (time, channel, product) flags
+    * tm       = AIPS times (days) of the dumps
+    * interval = Integration time (days)
+    * p        = (ant, ant, pol) product index matrix
+    * bi       = (nbase, 2) antenna indices of each baseline
+    * aips_bl  = AIPS baseline number of each baseline
+    Returns dict of (nregion, 2) arrays: "ants" (AIPS antenna numbers),
+    "times" (start, end in days) and "chans" (1-rel first, last channel)
+    """
+    blfg = fg[:, :, p[bi[:, 0], bi[:, 1]]].any(axis=-1)
+    if not blfg.any():
+        return {"ants":numpy.empty((0, 2), dtype=numpy.int32),
+                "times":numpy.empty((0, 2), dtype=numpy.float64),
+                "chans":numpy.empty((0, 2), dtype=numpy.int32)}
+    # (baseline, time, channel) so runs come out in that order
+    blfg = blfg.transpose(2, 0, 1).astype(numpy.int8)
+    nchan = blfg.shape[2]
+    # +1 where a run of flagged channels starts, -1 one past where it ends
+    edges = numpy.zeros(blfg.shape[:2] + (nchan + 1,), dtype=numpy.int8)
+    edges[..., :nchan] += blfg
+    edges[..., 1:] -= blfg
+    bl, it, c0 = numpy.nonzero(edges == 1)
+    c1 = numpy.nonzero(edges == -1)[2]
+    # Merge the same channel run of a baseline in consecutive dumps
+    order = numpy.lexsort((it, c1, c0, bl))
+    bl, it, c0, c1 = bl[order], it[order], c0[order], c1[order]
+    new = numpy.ones(bl.shape[0], dtype=bool)
+    new[1:] = (bl[1:] != bl[:-1]) | (c0[1:] != c0[:-1]) | (c1[1:] != c1[:-1]) | (it[1:] != it[:-1] + 1)
+    first = numpy.nonzero(new)[0]
+    last = numpy.append(first[1:], bl.shape[0]) - 1
+    abl = aips_bl[bl[first]]
+    return {"ants":numpy.stack([abl // 256, abl % 256], axis=1).astype(numpy.int32),
+            "times":numpy.stack([tm[it[first]] - 0.5 * interval, tm[it[last]] + 0.5 * interval], axis=1),
+            "chans":numpy.stack([c0[first] + 1, c1[first]], axis=1).astype(numpy.int32)}
 
 def WriteSUTable(outUV, meta, err):
     """
@@ -488,10 +682,13 @@ def WriteSUTable(outUV, meta, err):
     sutab.keys['RefDate'] = meta["obsdate"]
     sutab.keys['Freq']    = meta["spw"][0][1]
     Table.PDirty(sutab)  # Force update
-    row = sutab.ReadRow(1,err)
-    if err.isErr:
-        OErr.printErrMsg(err, "Error reading SU table")
-    OErr.printErr(err)
+    # Create row
+    row = {'ID. NO.': [0], 'SOURCE': ['                '], 'QUAL': [0], 'CALCODE': ['    '], \
+           'IFLUX': [0.0], 'QFLUX': [0.0], 'UFLUX': [0.0], 'VFLUX': [0.0], \
+           'FREQOFF': [0.0], 'BANDWIDTH': [0.0], 'RAEPO': [0.0], 'DECEPO': [0.0], \
+           'EPOCH': [2000.0], 'RAAPP': [0.0], 'DECAPP': [0.0], 'RAOBS': [0.0], 'DECOBS': [0.0], \
+           'LSRVEL': [0.0], 'RESTFREQ': [0.0], 'PMRA': [0.0], 'PMDEC': [0.0], \
+           'NumFields': 22, 'Table name': 'AIPS SU', '_status': [0]}
     irow = 0
     for tar in meta["targets"]:
         irow += 1
@@ -533,14 +730,39 @@ def StopFringes(visData,freqData,cable_delay):
     return outVisData
 
 
-def ConvertKATData(outUV, katdata, meta, err, static=None, blmask=1.e10, stop_w=False, timeav=1, flag=False, doweight=True, doflags=True):
+def ConvertKATData(outUV, katdata, meta, err, static=None, blmask=1.e10, stop_w=False, timeav=1, chanav=1, flag=False, doweight=True, doflags=True,
+                   write_batch=WRITE_BATCH, write_maxmem=WRITE_MAXMEM, pipeline=True,
+                   load_threads=LOAD_THREADS, flag_threads=None, flag_overlap=FLAG_OVERLAP,
+                   scans=None, time0=None, uvw_cache=None, flagtab=False):
     """
     Read KAT HDF data and write Obit UV
 
+    Visibilities are packed into the UV buffer a block of dumps at a time
+    and written with a single I/O call per block.
+    With pipeline=True reading, flagging/averaging and writing run as three
+    overlapping stages connected by bounded queues, so the next chunk is read
+    while the current one is flagged and the previous one is written.
+    Obit I/O is always done in the calling thread.
+
      * outUV    = Obit UV object
      * katdata  = input KAT dataset
      * meta     = dict with data meta data
      * err      = Python Obit Error/message stack to init
+     * timeav   = Number of dumps to average
+     * chanav   = Number of channels to average, meta must describe the
+                  averaged channels
+     * write_batch  = Maximum number of dumps per UV write
+     * write_maxmem = Upper limit (MB) on the size of the UV write buffer
+     * pipeline = Overlap read, flag and write stages? else run serially
+     * load_threads = Number of chunks of data to read concurrently
+     * flag_threads = Number of flagger worker threads (default number of cores)
+     * flag_overlap = Dumps either side of each chunk included when flagging it
+     * scans    = Scan indices to convert, None = all
+     * time0    = Unix time of the start of the reference day, None = that of
+                  the first dump of katdata
+     * uvw_cache = Directory to cache the UVW coordinates of each target in
+                   between runs, None = don't cache
+     * flagtab  = Write flags to FG table 1 rather than negating the weights
     """
     ################################################################
     reffreq =  meta["spw"][0][1]    # reference frequency
@@ -556,19 +778,25 @@ def ConvertKATData(outUV, katdata, meta, err, static=None, blmask=1.e10, stop_w=
     nprod   = nbase * nstok
     antslookup = meta["antLookup"]
     # work out Start time in unix sec
-    tm = katdata.timestamps[0]
-    tx = time.gmtime(tm)
-    time0   = tm - tx[3]*3600.0 - tx[4]*60.0 - tx[5]
+    if time0 is None:
+        time0 = get_time0(katdata)
 
-    # Set data to read one timestamp per IO
-    outUV.List.set("nVisPIO", nbase)
+    max_scan = 151
+    # Work out how many dumps to write per IO
     d = outUV.Desc.Dict
-    d.update(numVisBuff=nbase)
+    lrec = d['nrparm'] + nchan * nstok * 3  # Size of a visibility record in floats
+    nwrite = get_write_batch(nbase, lrec, min(write_batch, max_scan), write_maxmem)
+    outUV.List.set("nVisPIO", nwrite * nbase)
+    d.update(numVisBuff=nwrite * nbase)
     outUV.Desc.Dict = d
     # Open data
     zz = outUV.Open(UV.READWRITE, err)
     if err.isErr:
         OErr.printErrMsg(err, "Error opening output UV")
+    msg = "Writing %d dumps (%d visibilities) per UV write" % (nwrite, nwrite * nbase)
+    OErr.PLog(err, OErr.Info, msg)
+    OErr.printErr(err)
+    print(msg)
     # visibility record offsets
     idb = {}
     idb['ilocu']   = d['ilocu']
@@ -579,22 +807,27 @@ def ConvertKATData(outUV, katdata, meta, err, static=None, blmask=1.e10, stop_w=
     idb['ilocsu']  = d['ilocsu']
     idb['nrparm']  = d['nrparm']
 
-    visshape = nchan * nstok * 3
-    count = 0.0
     # Get IO buffers as numpy arrays
     buff =  numpy.frombuffer(outUV.VisBuf, dtype=numpy.float32)
-    #Set up a flagger if needs be
+    # Random parameters as a strided view into the IO buffer, ordered
+    # (time, baseline, parameter)
+    rparm = buff[:nwrite * nbase * lrec].reshape(nwrite, nbase, lrec)[..., :d['nrparm']]
+    # Baselines are the same in every block so are only set once
+    rparm[..., idb['ilocb']] = meta["blIndex"].aips_bl[numpy.newaxis, :]
+    #Set up a flagger and its workers if needs be
+    flagger = None
+    flag_pool = None
     if flag:
+        if flag_threads is None:
+            flag_threads = multiprocessing.cpu_count()
+        flag_pool = concurrent.futures.ThreadPoolExecutor(max(1, flag_threads))
         flagger = SumThresholdFlagger(outlier_nsigma=4.5, freq_chunks=7,
                                       spike_width_freq=1.5e6/katdata.channel_width,
                                       spike_width_time=100./katdata.dump_period,
                                       time_extend=3, freq_extend=3, average_freq=1)
     #Set up the baseline mask
-    blmask = get_baseline_mask(newants, katdata.corr_products, blmask)
+    blmask = meta["blIndex"].prod_length < blmask
 
-    # Template vis
-    vis = outUV.ReadVis(err, firstVis=1)
-    first = True
     visno = 1
     numflags = 0
     numvis = 0
@@ -610,103 +843,531 @@ def ConvertKATData(outUV, katdata, meta, err, static=None, blmask=1.e10, stop_w=
     baseline_vectors = numpy.array([array_centre.baseline_toward(antenna)
                                 for antenna in newants])
 
-    max_scan = 151
-    QUACK = 1
-    # Generate arrays for storage
-    scan_vs = numpy.empty((max_scan, nchan, nprod), dtype=katdata.vis.dtype)
-    scan_fg = numpy.empty((max_scan, nchan, nprod), dtype=katdata.flags.dtype)
-    scan_wt = numpy.empty((max_scan, nchan, nprod), dtype=katdata.weights.dtype)
+    # Parameters shared by the conversion stages
+    parms = {"max_scan":max_scan, "quack":1, "time0":time0, "lamb":lamb,
+             "timeav":timeav, "chanav":chanav, "doweight":doweight, "doflags":doflags,
+             "static":static, "blmask":blmask, "flagger":flagger,
+             "flag_pool":flag_pool, "flag_overlap":flag_overlap if flag else 0,
+             "flag_time":0.0,
+             "channel_freqs":katdata.channel_freqs, "array_centre":array_centre,
+             "baseline_vectors":baseline_vectors, "idb":idb, "b":b, "bi":bi,
+             "p":p, "nbase":nbase, "nwrite":nwrite, "read_stats":[], "err":err,
+             "scans":scans, "uvw_table":None, "rparm":rparm, "suid":None,
+             "flagtab":flagtab, "interval":katdata.dump_period * timeav / 86400.0,
+             "aips_bl":meta["blIndex"].aips_bl}
+
+    # Compute UVW once per target, unless the dumps are averaged
+    if timeav == 1:
+        parms["uvw_table"] = get_uvw_table(katdata, meta, array_centre, baseline_vectors, bi,
+                                           err, scans=scans, cache_dir=uvw_cache)
+
+    # Generate arrays for storage, one set for each chunk in flight
+    if pipeline:
+        nbuf = PIPELINE_BUFFERS
+        msg = "Overlapping read, flag and write of data using %d buffers" % nbuf
+        OErr.PLog(err, OErr.Info, msg)
+        OErr.printErr(err)
+        print(msg)
+    else:
+        nbuf = 1
+    free = queue.Queue()
+    # Storage is for the unaveraged channels
+    nstore = max_scan + 2 * parms["flag_overlap"]
+    nchan_in = katdata.shape[1]
+    for i in range(nbuf):
+        free.put({"vs":numpy.empty((nstore, nchan_in, nprod), dtype=katdata.vis.dtype),
+                  "fg":numpy.empty((nstore, nchan_in, nprod), dtype=katdata.flags.dtype),
+                  "wt":numpy.empty((nstore, nchan_in, nprod), dtype=katdata.weights.dtype)})
+    # Pool to fetch chunks of data from the store
+    parms["load_pool"] = concurrent.futures.ThreadPoolExecutor(max(1, load_threads))
+    stop = threading.Event()
+    chunks = read_chunks(katdata, meta, parms, free, stop, err)
+    if pipeline:
+        chunks = run_pipeline(chunks, lambda chunk: process_chunk(chunk, parms), stop)
+    else:
+        chunks = (process_chunk(chunk, parms) for chunk in chunks)
+
+    write_time = 0.0
+    start_time = time.time()
+    lastVisBuff = nwrite * nbase
+    fgregions = []
+    try:
+        for chunk in chunks:
+            numflags += chunk["numflags"]
+            numvis += chunk["numvis"]
+            if flagtab:
+                fgregions.append(chunk["fgregions"])
+            t0 = time.time()
+            visno, lastVisBuff = write_chunk(outUV, chunk, parms, buff, visno, lastVisBuff, err)
+            write_time += time.time() - t0
+            # Hand the storage back to the reader
+            free.put(chunk["bufs"])
+    finally:
+        chunks.close()
+        parms["load_pool"].shutdown()
+        if flag_pool is not None:
+            flag_pool.shutdown()
+    # end loop over scan
+    if numvis>0:
+        msg= "Applied %s online flags to %s visibilities (%.3f%%)"%(numflags,numvis,(float(numflags)/float(numvis)*100.))
+        OErr.PLog(err, OErr.Info, msg)
+        OErr.printErr(err)
+    # Throughput
+    total_time = time.time() - start_time
+    nvis = visno - 1
+    if nvis > 0:
+        msg = "Wrote %d visibilities in %.1f s (%.0f vis/s), %.1f s in UV writes (%.0f vis/s)" % \
+              (nvis, total_time, nvis / max(total_time, 1.e-6), write_time, nvis / max(write_time, 1.e-6))
+        OErr.PLog(err, OErr.Info, msg)
+        OErr.printErr(err)
+        print(msg)
+    log_read_stats(parms["read_stats"], total_time, err)
+    outUV.Close(err)
+    if err.isErr:
+        OErr.printErrMsg(err, "Error closing data")
+    # Flags to FG table
+    if flagtab and fgregions:
+        t0 = time.time()
+        nflag = WriteFGTable(outUV, {key:numpy.concatenate([fgr[key] for fgr in fgregions])
+                                     for key in ("ants", "times", "chans")}, err)
+        msg = "Wrote %d flag regions to FG table 1 in %.1f s" % (nflag, time.time() - t0)
+        OErr.PLog(err, OErr.Info, msg)
+        OErr.printErr(err)
+        print(msg)
+    # end ConvertKATData
+
+def read_chunks(katdata, meta, parms, free, stop, err):
+    """
+    Generator over the chunks of data to convert.
+
+    Loops over the scans in katdata, splits each into chunks of at most
+    max_scan dumps and loads each chunk into a set of storage arrays
+    taken from the free queue. When flagging, flag_overlap dumps either side
+    of each chunk (within the scan) are loaded too, to be trimmed off once
+    the chunk has been flagged.
+
+    * katdata = input KAT dataset
+    * meta    = dict with data meta data
+    * parms   = dict of conversion parameters
+    * free    = queue.Queue of storage dicts with "vs", "fg" and "wt" arrays
+    * stop    = threading.Event signalling the conversion has been aborted
+    * err     = Python Obit Error/message stack
+    Yields dicts with the target, source id, timestamps, data and storage
+    """
+    max_scan = parms["max_scan"]
+    quack = parms["quack"]
+    timeav = parms["timeav"]
+    overlap = parms["flag_overlap"]
     for scan, state, target in katdata.scans():
+        # Only the requested scans
+        if parms["scans"] is not None and scan not in parms["scans"]:
+            continue
         # Don't read at all if all will be "Quacked"
-        if katdata.shape[0] < ((QUACK + 1) * timeav):
+        if katdata.shape[0] < ((quack + 1) * timeav):
             continue
         # Chunk data into max_scan dumps
         if katdata.shape[0] > max_scan:
-            scan_slices = [slice(i, i + max_scan, 1) for i in range(QUACK * timeav, katdata.shape[0], max_scan)]
+            scan_slices = [slice(i, i + max_scan, 1) for i in range(quack * timeav, katdata.shape[0], max_scan)]
             scan_slices[-1] = slice(scan_slices[-1].start, katdata.shape[0], 1)
         else:
-            scan_slices = [slice(QUACK * timeav, katdata.shape[0])]
+            scan_slices = [slice(quack * timeav, katdata.shape[0])]
 
         # Number of integrations
-        num_ints = katdata.timestamps.shape[0] - QUACK * timeav
+        num_ints = katdata.timestamps.shape[0] - quack * timeav
         msg = "Scan:%4d Int: %4d %16s Start %s"%(scan, num_ints, target.name,
-                                                 day2dhms((katdata.timestamps[0] - time0) / 86400.0)[0:12])
+                                                 day2dhms((katdata.timestamps[0] - parms["time0"]) / 86400.0)[0:12])
         OErr.PLog(err, OErr.Info, msg);
         OErr.printErr(err)
         print(msg)
-        for sl in scan_slices:
-            tm = katdata.timestamps[sl]
+        # Get target suid
+        # Only on targets in the input list
+        try:
+            suid = meta["targLookup"][target.name[0:16]]
+        except:
+            continue
+        for isl, sl in enumerate(scan_slices):
+            # Extend the chunk by the flagging overlap
+            start = max(quack * timeav, sl.start - overlap)
+            stop_dump = min(katdata.shape[0], sl.stop + overlap)
+            tm = katdata.timestamps[start:stop_dump]
             nint = tm.shape[0]
-            load(katdata, numpy.s_[sl.start:sl.stop, :, :], scan_vs[:nint], scan_wt[:nint], scan_fg[:nint], err)
-            # Make sure we've reset the weights
-            wt = scan_wt[:nint]
-            if doweight==False:
-                wt[:] = 1.
-            vs = scan_vs[:nint]
-            fg = scan_fg[:nint]
-            if doflags==False:
-                fg[:] = False
-            if static is not None:
-                fg[:, :, blmask] |= static[numpy.newaxis, :, numpy.newaxis]
-            if flag:
-                fg |= flag_data(vs, fg, flagger)
-            if timeav>1:
-                vs, wt, fg, tm, _ = averager.average_visibilities(vs, wt, fg, tm, katdata.channel_freqs, timeav=int(timeav), chanav=1)
-                # Update number of integrations for averaged data.
-                nint = tm.shape[0]
-            # Get target suid
-            # Only on targets in the input list
-            try:
-                suid = meta["targLookup"][target.name[0:16]]
-            except:
-                continue
-
-            numflags += numpy.sum(fg)
-            numvis += fg.size
-
-            # uvw calculation
-            uvw_coordinates = get_uvw_coordinates(array_centre, baseline_vectors, tm, target, bi)
-
-            # Convert to aipsish
-            uvw_coordinates /= lamb
-
-            # Convert to AIPS time
-            tm = (tm - time0) / 86400.0
-
-            #Get random parameters for this scan
-            rp = get_random_parameters(idb, b, uvw_coordinates, tm, suid)
-            # Loop over integrations
-            for iint in range(0, nint):
-                # Fill the buffer for this integration
-                buff = fill_buffer(vs[iint], fg[iint], wt[iint], rp[iint], p, bi, buff)
-                # Write to disk
-                outUV.Write(err, firstVis=visno)
-                visno += nbase
-                firstVis = None
-            # end loop over integrations
-            if err.isErr:
-                OErr.printErrMsg(err, "Error writing data")
-    # end loop over scan
-    if numvis>0:
-        msg= "Applied %s online flags to %s visibilities (%.3f%%)"%(numflags,numvis,(float(numflags)/float(numvis)*100.))
-        OErr.PLog(err, OErr.Info, msg)
-        OErr.printErr(err)
-    outUV.Close(err)
+            bufs = _queue_get(free, stop)
+            load(katdata, numpy.s_[start:stop_dump, :, :], bufs["vs"][:nint], bufs["wt"][:nint], bufs["fg"][:nint], err,
+                 pool=parms["load_pool"], stats=parms["read_stats"])
+            yield {"scan":scan, "last":isl == len(scan_slices) - 1,
+                   "target":target, "suid":suid, "tm":tm, "bufs":bufs,
+                   "trim":slice(sl.start - start, nint - (stop_dump - sl.stop)),
+                   "vs":bufs["vs"][:nint], "wt":bufs["wt"][:nint], "fg":bufs["fg"][:nint]}
+    # end read_chunks
+
+def process_chunk(chunk, parms):
+    """
+    Apply weights, flags and averaging to a loaded chunk and compute the
+    AIPS random parameters of its visibilities.
+
+    * chunk = dict from read_chunks, updated in place
+    * parms = dict of conversion parameters
+    Returns chunk with AIPS times, "uvw" in wavelengths, "numflags" and
+    "numvis" added, and with flagtab the compressed flags in "fgregions"
+    """
+    vs, wt, fg, tm = chunk["vs"], chunk["wt"], chunk["fg"], chunk["tm"]
+    # Make sure we've reset the weights
+    if parms["doweight"]==False:
+        wt[:] = 1.
+    if parms["doflags"]==False:
+        fg[:] = False
+    if parms["static"] is not None:
+        fg[:, :, parms["blmask"]] |= parms["static"][numpy.newaxis, :, numpy.newaxis]
+    if parms["flagger"] is not None:
+        t0 = time.time()
+        fg |= flag_data(vs, fg, parms["flagger"], parms["flag_pool"])
+        parms["flag_time"] += time.time() - t0
+        if chunk["last"]:
+            msg = "Scan:%4d flagged in %.1f s" % (chunk["scan"], parms["flag_time"])
+            OErr.PLog(parms["err"], OErr.Info, msg)
+            OErr.printErr(parms["err"])
+            print(msg)
+            parms["flag_time"] = 0.0
+    # Drop the flagging overlap
+    trim = chunk["trim"]
+    vs, wt, fg, tm = vs[trim], wt[trim], fg[trim], tm[trim]
+    if parms["timeav"]>1 or parms["chanav"]>1:
+        vs, wt, fg, tm, _ = averager.average_visibilities(vs, wt, fg, tm, parms["channel_freqs"], timeav=int(parms["timeav"]), chanav=int(parms["chanav"]))
+
+    # uvw calculation
+    if parms["uvw_table"] is not None:
+        uvw_times, uvw_all = parms["uvw_table"]
+        uvw_coordinates = uvw_all[numpy.searchsorted(uvw_times, tm)]
+    else:
+        uvw_coordinates = get_uvw_coordinates(parms["array_centre"], parms["baseline_vectors"], tm, chunk["target"], parms["bi"])
+
+    # Convert to aipsish
+    uvw_coordinates /= parms["lamb"]
+
+    # Convert to AIPS time
+    tm = (tm - parms["time0"]) / 86400.0
+
+    numflags = numpy.sum(fg)
+    # Flags go to the FG table, not into the weights
+    if parms["flagtab"]:
+        chunk["fgregions"] = compress_flags(fg, tm, parms["interval"], parms["p"], parms["bi"], parms["aips_bl"])
+        fg[:] = False
+
+    chunk.update(vs=vs, wt=wt, fg=fg, tm=tm, uvw=uvw_coordinates,
+                 numflags=numflags, numvis=fg.size)
+    return chunk
+    # end process_chunk
+
+def write_chunk(outUV, chunk, parms, buff, visno, lastVisBuff, err):
+    """
+    Write a processed chunk to outUV in blocks of nwrite dumps.
+
+    * outUV       = open Obit UV object
+    * chunk       = dict from process_chunk
+    * parms       = dict of conversion parameters
+    * buff        = numpy view of the outUV visibility buffer
+    * visno       = first visibility number to write
+    * lastVisBuff = number of visibilities in the buffer at the last write
+    Returns the next visibility number and the buffer size last written
+    """
+    nwrite = parms["nwrite"]
+    rparm = parms["rparm"]
+    vs, fg, wt, uvw, tm = chunk["vs"], chunk["fg"], chunk["wt"], chunk["uvw"], chunk["tm"]
+    nint = tm.shape[0]
+    # Source only needs setting when it changes
+    if chunk["suid"] != parms["suid"]:
+        rparm[..., parms["idb"]['ilocsu']] = chunk["suid"]
+        parms["suid"] = chunk["suid"]
+    # Loop over blocks of integrations
+    for iint in range(0, nint, nwrite):
+        jint = min(nint, iint + nwrite)
+        # Fill the buffer for this block of integrations
+        write_random_parameters(rparm[:jint - iint], parms["idb"], uvw[iint:jint], tm[iint:jint])
+        buff = fill_buffer(vs[iint:jint], fg[iint:jint], wt[iint:jint], rparm.shape[2], parms["p"], parms["bi"], buff)
+        # Tell Obit how many visibilities are in the buffer
+        numVisBuff = (jint - iint) * parms["nbase"]
+        if numVisBuff != lastVisBuff:
+            set_num_vis_buff(outUV, numVisBuff)
+            lastVisBuff = numVisBuff
+        # Write to disk
+        outUV.Write(err, firstVis=visno)
+        visno += numVisBuff
+    # end loop over integrations
     if err.isErr:
-        OErr.printErrMsg(err, "Error closing data")
-    # end ConvertKATData
+        OErr.printErrMsg(err, "Error writing data")
+    return visno, lastVisBuff
+    # end write_chunk
+
+class _PipelineStopped(Exception):
+    """ Raised in a pipeline stage when the conversion has been aborted """
+    pass
+
+class _PipelineFailure(object):
+    """ Carries an exception raised in a pipeline stage to the next stage """
+    def __init__(self, exc):
+        self.exc = exc
+
+# Marks the end of the items passed between pipeline stages
+_PIPELINE_END = object()
+
+def _queue_get(q, stop):
+    """ Get an item from q, giving up if stop is set """
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                raise _PipelineStopped()
+
+def _queue_put(q, item, stop):
+    """ Put an item on q, giving up if stop is set """
+    while True:
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            if stop.is_set():
+                raise _PipelineStopped()
+
+def _iter_queue(q, stop):
+    """ Iterate over the items put on q by a pipeline stage """
+    while True:
+        item = _queue_get(q, stop)
+        if item is _PIPELINE_END:
+            return
+        if isinstance(item, _PipelineFailure):
+            raise item.exc
+        yield item
+
+def _pipeline_stage(items, func, out_queue, stop):
+    """
+    Thread body for a pipeline stage: apply func (if given) to each of
+    items and pass the results on to out_queue.
+    Errors are passed on to be raised in the next stage.
+    """
+    result = _PIPELINE_END
+    try:
+        for item in items:
+            if func is not None:
+                item = func(item)
+            _queue_put(out_queue, item, stop)
+    except _PipelineStopped:
+        return
+    except Exception as exc:
+        result = _PipelineFailure(exc)
+    try:
+        _queue_put(out_queue, result, stop)
+    except _PipelineStopped:
+        pass
+
+def run_pipeline(chunks, process, stop):
+    """
+    Run the read and process stages of the conversion in background threads.
+
+    * chunks  = iterator over loaded chunks (read stage)
+    * process = function applied to each loaded chunk (flag/average stage)
+    * stop    = threading.Event used to shut the stages down
+    Yields processed chunks in order, to be written by the calling thread.
+    """
+    loaded = queue.Queue(maxsize=PIPELINE_QUEUE)
+    processed = queue.Queue(maxsize=PIPELINE_QUEUE)
+    stages = [threading.Thread(target=_pipeline_stage, name="KAT2AIPS-read",
+                               args=(chunks, None, loaded, stop)),
+              threading.Thread(target=_pipeline_stage, name="KAT2AIPS-flag",
+                               args=(_iter_queue(loaded, stop), process, processed, stop))]
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+    try:
+        for chunk in _iter_queue(processed, stop):
+            yield chunk
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+    # end run_pipeline
+
+def get_time0(katdata):
+    """
+    Unix time of the start of the day of the first dump in katdata
+    """
+    tm = katdata.timestamps[0]
+    tx = time.gmtime(tm)
+    return tm - tx[3]*3600.0 - tx[4]*60.0 - tx[5]
+
+def get_scan_groups(katdata, meta, ngroups, timeav=1):
+    """
+    Split the scans to be converted into groups of consecutive scans with
+    roughly equal numbers of dumps.
 
-def MakeTemplate(inuv, outuv, katdata):
+    * katdata = input KAT dataset
+    * meta    = dict with data meta data
+    * ngroups = maximum number of groups
+    * timeav  = number of dumps averaged on conversion
+    Returns a list of lists of scan indices, in time order
+    """
+    scans = []
+    for scan, state, target in katdata.scans():
+        # Skip scans that would not be converted
+        if katdata.shape[0] < 2 * timeav or target.name[0:16] not in meta["targLookup"]:
+            continue
+        scans.append((scan, katdata.shape[0]))
+    ndumps = numpy.cumsum([s[1] for s in scans])
+    groups = []
+    for scan, cum in zip([s[0] for s in scans], ndumps):
+        igroup = min(ngroups - 1, int(ngroups * (cum - 1) // ndumps[-1]))
+        if igroup >= len(groups):
+            groups.append([])
+        groups[-1].append(scan)
+    return groups
+
+def ConvertKATDataParallel(outUV, katdata, meta, err, nworkers=2, scratch=None, **kwargs):
+    """
+    Convert KAT data to Obit UV with a pool of processes.
+
+    Groups of consecutive scans are converted by separate processes into
+    scratch FITS UV files cloned from outUV. These are then appended to
+    outUV in time order, giving the same data as ConvertKATData.
+    The processes are forked, so share the Obit and katdal state.
+
+     * outUV    = Obit UV object
+     * katdata  = input KAT dataset
+     * meta     = dict with data meta data
+     * err      = Python Obit Error/message stack
+     * nworkers = Number of processes
+     * scratch  = Directory for the scratch UV files, default cwd
+     * kwargs   = other arguments to ConvertKATData
+    """
+    ################################################################
+    start_time = time.time()
+    kwargs.setdefault('time0', get_time0(katdata))
+    groups = get_scan_groups(katdata, meta, nworkers, timeav=kwargs.get('timeav',1))
+    if len(groups) < 2:
+        ConvertKATData(outUV, katdata, meta, err, **kwargs)
+        return
+    # Share out the cores between the processes
+    if kwargs.get('flag_threads') is None:
+        kwargs['flag_threads'] = max(1, multiprocessing.cpu_count() // len(groups))
+    kwargs['load_threads'] = max(1, kwargs.get('load_threads', LOAD_THREADS) // len(groups))
+    if scratch is None:
+        scratch = os.getcwd()
+    msg = "Converting %d groups of scans in parallel" % len(groups)
+    OErr.PLog(err, OErr.Info, msg)
+    OErr.printErr(err)
+    print(msg)
+    # Make the scratch files before forking
+    workUVs = []
+    for igroup in range(len(groups)):
+        filename = os.path.join(scratch, "KAT2AIPS%d_%d.uvtab" % (os.getpid(), igroup))
+        workUV = UV.newPFUV("KAT2AIPS scratch", filename, 0, False, err)
+        UV.PClone(outUV, workUV, err)
+        if err.isErr:
+            OErr.printErrMsg(err, "Error creating scratch UV "+filename)
+        d = workUV.Desc.Dict
+        d['nvis'] = 0
+        workUV.Desc.Dict = d
+        workUV.UpdateDesc(err)
+        workUVs.append(workUV)
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_convert_scans, name="KAT2AIPS-%d" % igroup,
+                         args=(workUVs[igroup], katdata, meta, groups[igroup], kwargs))
+             for igroup in range(len(groups))]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    failed = [proc.name for proc in procs if proc.exitcode != 0]
+    if failed:
+        for workUV in workUVs:
+            workUV.Zap(err)
+        raise RuntimeError("Conversion failed in "+", ".join(failed))
+    convert_time = time.time() - start_time
+    # Merge in time order
+    visno = 1
+    d = outUV.Desc.Dict
+    nVisPIO = get_write_batch(meta["baselines"].shape[0], d['nrparm'] + d['ncorr'] * d['inaxes'][0],
+                              kwargs.get('write_batch', WRITE_BATCH),
+                              kwargs.get('write_maxmem', WRITE_MAXMEM)) * meta["baselines"].shape[0]
+    for workUV in workUVs:
+        visno = AppendUVData(workUV, outUV, visno, err, nVisPIO=nVisPIO)
+        if kwargs.get('flagtab') and workUV.GetHighVer("AIPS FG") > 0:
+            inFG = workUV.NewTable(Table.READONLY, "AIPS FG", 1, err)
+            outFG = outUV.NewTable(Table.READWRITE, "AIPS FG", 1, err)
+            Table.PConcat(inFG, outFG, err)
+        workUV.Zap(err)
+        if err.isErr:
+            OErr.printErrMsg(err, "Error merging scratch UV data")
+    msg = "Converted in %.1f s, merged %d visibilities in %.1f s" % \
+          (convert_time, visno - 1, time.time() - start_time - convert_time)
+    OErr.PLog(err, OErr.Info, msg)
+    OErr.printErr(err)
+    print(msg)
+    # end ConvertKATDataParallel
+
+def _convert_scans(workUV, katdata, meta, scans, kwargs):
+    """
+    Process body for ConvertKATDataParallel: convert scans into workUV
+    """
+    err = OErr.OErr()
+    ConvertKATData(workUV, katdata, meta, err, scans=scans, **kwargs)
+    OErr.printErr(err)
+    if err.isErr:
+        raise RuntimeError("Error converting scans %s" % scans)
+
+def AppendUVData(inUV, outUV, visno, err, nVisPIO=1000):
+    """
+    Append the visibilities of inUV to outUV a block at a time.
+
+    * inUV    = input Obit UV object, same record layout as outUV
+    * outUV   = output Obit UV object
+    * visno   = visibility number in outUV of the first record copied
+    * err     = Obit error/message stack
+    * nVisPIO = number of visibilities per read/write
+    Returns the visibility number following the last one written
+    """
+    ################################################################
+    return MakeIFs.CopyData(inUV, outUV, err, firstVis=visno, nVisPIO=nVisPIO)
+    # end AppendUVData
+
+def get_write_batch(nbase, lrec, write_batch, write_maxmem):
+    """
+    Work out the number of dumps to pack into each UV write.
+
+    * nbase        = number of baselines per dump
+    * lrec         = length of a visibility record in floats
+    * write_batch  = requested maximum number of dumps per write
+    * write_maxmem = upper limit in MB of the write buffer
+    Returns at least 1 dump per write
+    """
+    dump_bytes = nbase * lrec * numpy.dtype(numpy.float32).itemsize
+    max_dumps = int(write_maxmem * 1024. * 1024. // dump_bytes)
+    return max(1, min(int(write_batch), max_dumps))
+
+def set_num_vis_buff(outUV, numVisBuff):
+    """
+    Set the number of visibilities in the UV buffer for the next Write.
+
+    * outUV      = open Obit UV object
+    * numVisBuff = number of visibility records in the buffer
+    """
+    for desc in (outUV.Desc, outUV.IODesc):
+        d = desc.Dict
+        d['numVisBuff'] = numVisBuff
+        desc.Dict = d
+
+def MakeTemplate(inuv, outuv, katdata, nstokes=4, chanav=1):
     """
     Construct a template file with the correct channel range and write it to outuv.
+    nstokes = 2 gives a template for HH and VV only.
+    chanav  = number of channels that will be averaged on conversion.
     """
-    numchans = len(katdata.channel_freqs)
+    numchans = len(katdata.channel_freqs) // chanav
     nvispio = len(numpy.unique([(cp[0][:-1] + cp[1][:-1]).upper() for cp in katdata.corr_products]))
     uvfits = pyfits.open(inuv)
     #Resize the visibility table
     vistable = uvfits[1].columns
     vistable.del_col('VISIBILITIES')
-    newvis = pyfits.Column(name='VISIBILITIES',format='%dE'%(3*4*numchans),dim='(3,4,%d,1,1,1)'%(numchans,),array=numpy.zeros((nvispio,1,1,1,numchans,4,3,),dtype=numpy.float32))
+    newvis = pyfits.Column(name='VISIBILITIES',format='%dE'%(3*nstokes*numchans),dim='(3,%d,%d,1,1,1)'%(nstokes,numchans,),array=numpy.zeros((nvispio,1,1,1,numchans,nstokes,3,),dtype=numpy.float32))
     vistable.add_col(newvis)
     vishdu = pyfits.BinTableHDU.from_columns(vistable)
     for key in list(uvfits[1].header.keys()):
@@ -717,14 +1378,75 @@ def MakeTemplate(inuv, outuv, katdata):
     #Add nvispio rows
     newuvfits.writeto(outuv, overwrite=True)
 
-def flag_data(vs,fg,flagger):
+def flag_data(vs,fg,flagger,pool=None):
     """
     Flag the data using flagger.
+    If pool is not given a pool with a worker per core is used for this call.
     """
-    with concurrent.futures.ThreadPoolExecutor(multiprocessing.cpu_count()) as pool:
-        detected_flags = flagger.get_flags(vs, fg, pool)
+    if pool is None:
+        with concurrent.futures.ThreadPoolExecutor(multiprocessing.cpu_count()) as pool:
+            return flagger.get_flags(vs, fg, pool)
+    detected_flags = flagger.get_flags(vs, fg, pool)
     return detected_flags
 
+def get_uvw_table(katdata, meta, array_centre, baseline_vectors, b, err, scans=None, cache_dir=None):
+    """
+    Compute the UVW coordinates of all baselines for every dump to be
+    converted, once per target over all of its dumps.
+
+    * katdata          = input KAT dataset
+    * meta             = dict with data meta data
+    * array_centre     = katpoint Antenna at the array reference position
+    * baseline_vectors = ENU offsets of the antennas from array_centre
+    * b                = (nbase, 2) antenna indices of each baseline
+    * err              = Python Obit Error/message stack
+    * scans            = Scan indices to include, None = all
+    * cache_dir        = Directory to cache the UVW of each target in, None = no cache
+    Returns (timestamps, uvw) where uvw is a float32 array of UVW in metres
+    of shape (ndumps, nbase, 3) for the sorted timestamps
+    """
+    t0 = time.time()
+    targets = {}
+    for scan, state, target in katdata.scans():
+        if (scans is not None and scan not in scans) or target.name[0:16] not in meta["targLookup"]:
+            continue
+        targets.setdefault(target.description, (target, []))[1].append(katdata.timestamps[:])
+    if len(targets) == 0:
+        return None
+    times = numpy.sort(numpy.concatenate([tm for target, tms in targets.values() for tm in tms]))
+    uvw = numpy.empty((times.shape[0], b.shape[0], 3), dtype=numpy.float32)
+    ncached = 0
+    for target, tms in targets.values():
+        tm = numpy.concatenate(tms)
+        cache_file = None
+        if cache_dir is not None:
+            key = hashlib.sha1()
+            key.update(target.description.encode())
+            key.update(array_centre.description.encode())
+            key.update(numpy.ascontiguousarray(baseline_vectors, dtype=numpy.float64).tobytes())
+            key.update(numpy.ascontiguousarray(b).tobytes())
+            key.update(numpy.ascontiguousarray(tm, dtype=numpy.float64).tobytes())
+            cache_file = os.path.join(cache_dir, "uvw_%s.npy" % key.hexdigest())
+        if cache_file is not None and os.path.exists(cache_file):
+            uvw_target = numpy.load(cache_file)
+            ncached += 1
+        else:
+            uvw_target = get_uvw_coordinates(array_centre, baseline_vectors, tm, target, b).astype(numpy.float32)
+            if cache_file is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                # Write then rename so concurrent runs never see a partial file
+                tmp_file = "%s.%d.tmp.npy" % (cache_file[:-4], os.getpid())
+                numpy.save(tmp_file, uvw_target)
+                os.replace(tmp_file, cache_file)
+        uvw[numpy.searchsorted(times, tm)] = uvw_target
+    msg = "UVW for %d dumps of %d targets (%d from cache) in %.1f s" % \
+          (times.shape[0], len(targets), ncached, time.time() - t0)
+    OErr.PLog(err, OErr.Info, msg)
+    OErr.printErr(err)
+    print(msg)
+    return times, uvw
+
 def get_uvw_coordinates(array_centre, baseline_vectors, tm, target, b):
     # uvw calculation
     a1 = b[:,0]
@@ -736,41 +1458,90 @@ def get_uvw_coordinates(array_centre, baseline_vectors, tm, target, b):
                             - numpy.take(uvw_ant, a2, axis=1))
     return uvw_coordinates
 
-def get_random_parameters(dbiloc, bl, uvws, tm, suid):
+def get_aips_baselines(bl):
     """
-    Construct an array of shape (len(tm), len(bl),len(dbiloc)) containing the
-    AIPS random parameters as a function of baseline and timestamp.
-    Array returned has order: specified in dbiloc
+    AIPS baseline random parameter (256*ant1 + ant2) for each baseline in bl
     """
+    return 256.0*(bl[:, 0]) + (bl[:, 1])
 
-    rp = numpy.empty((len(tm), len(bl), dbiloc['nrparm'],), dtype=numpy.float32)
-
-    # Get baselines in aips format
-    aips_bl = 256.0*(bl[:, 0]) + (bl[:, 1])
+def write_random_parameters(rp, dbiloc, uvws, tm):
+    """
+    Write the time dependent AIPS random parameters (u, v, w and time)
+    into rp in place.
+    rp may be a strided view into a UV IO buffer of shape
+    (len(tm), nbl, nrparm), the baseline and source parameters are left alone.
+    """
     # uvw
     rp[..., dbiloc['ilocu']] = uvws[..., 0]
     rp[..., dbiloc['ilocv']] = uvws[..., 1]
     rp[..., dbiloc['ilocw']] = uvws[..., 2]
     # time
     rp[..., dbiloc['iloct']] = tm[:, numpy.newaxis]
+
+def get_random_parameters(dbiloc, bl, uvws, tm, suid):
+    """
+    Construct an array of shape (len(tm), len(bl),len(dbiloc)) containing the
+    AIPS random parameters as a function of baseline and timestamp.
+    Array returned has order: specified in dbiloc
+    """
+
+    rp = numpy.empty((len(tm), len(bl), dbiloc['nrparm'],), dtype=numpy.float32)
+    write_random_parameters(rp, dbiloc, uvws, tm)
     # baseline
-    rp[..., dbiloc['ilocb']] = aips_bl[numpy.newaxis, :]
+    rp[..., dbiloc['ilocb']] = get_aips_baselines(bl)[numpy.newaxis, :]
     # source
     rp[..., dbiloc['ilocsu']] = suid
 
     return rp
 
 
-# Number of times to try reading each chunk before giving up
-NUM_RETRIES = 3
-# Number of dumps to read at at time
-CHUNK_SIZE = 2
+def get_time_slices(dataset, t_min, t_max, chunk_size=None):
+    """
+    Split dumps t_min to t_max of dataset into slices to be read separately.
+
+    If chunk_size is not given and dataset.vis is backed by dask the slices
+    follow its time chunks, so that each slice fetches whole chunks from the
+    store. Otherwise slices are chunk_size (default CHUNK_SIZE) dumps long.
+    """
+    if chunk_size is None and isinstance(dataset.vis, DaskLazyIndexer):
+        bounds = numpy.cumsum((0,) + tuple(dataset.vis.dataset.chunks[0]))
+        bounds = [int(bd) for bd in bounds if t_min < bd < t_max]
+        return [slice(start, stop) for start, stop in zip([t_min] + bounds, bounds + [t_max])]
+    chunk_size = chunk_size or CHUNK_SIZE
+    return [slice(ts, min(ts+chunk_size, t_max)) for ts in range(t_min, t_max, chunk_size)]
+
+def load_chunk(dataset, in_ts, out_vis, out_weights, out_flags, err):
+    """
+    Read one time slice of vis, weights and flags into existing storage,
+    retrying with exponential backoff if the store is unavailable.
 
-def load(dataset, indices, vis, weights, flags, err):
+    Returns (success, read latency in seconds, number of tries)
+    """
+    t0 = time.time()
+    for i in range(NUM_RETRIES):
+        try:
+            if isinstance(dataset.vis, DaskLazyIndexer):
+                DaskLazyIndexer.get([dataset.vis, dataset.weights, dataset.flags], in_ts, out=[out_vis, out_weights, out_flags])
+            else:
+                out_vis[:] = dataset.vis[in_ts]
+                out_weights[:] = dataset.weights[in_ts]
+                out_flags[:] = dataset.flags[in_ts]
+            return True, time.time() - t0, i + 1
+        except StoreUnavailable:
+            msg = 'Timeout when reading dumps %d to %d. Try %d/%d....' % (in_ts.start + 1, in_ts.stop, i + 1, NUM_RETRIES)
+            OErr.PLog(err, OErr.Warn, msg);
+            OErr.printErr(err)
+            print(msg)
+            if i < NUM_RETRIES - 1:
+                time.sleep(RETRY_DELAY * 2**i)
+    return False, time.time() - t0, NUM_RETRIES
+
+def load(dataset, indices, vis, weights, flags, err, pool=None, chunk_size=None, stats=None):
     """Load data from lazy indexers into existing storage.
     This is optimised for the MVF v4 case where we can use dask directly
     to eliminate one copy, and also load vis, flags and weights in parallel.
     In older formats it causes an extra copy.
+    The time slices are fetched concurrently on pool.
     Parameters
     ----------
     dataset : :class:`katdal.DataSet`
@@ -779,83 +1550,103 @@ def load(dataset, indices, vis, weights, flags, err):
         Slice expression for subsetting the dataset
     vis, flags : array-like
         Outputs, which must have the correct shape and type
+    pool : :class:`concurrent.futures.Executor`, optional
+        Pool to read the time slices on, if None a pool of LOAD_THREADS
+        threads is used for this call
+    chunk_size : int, optional
+        Number of dumps per read, default follows the chunking of the data
+    stats : list, optional
+        Per-chunk (latency in seconds, number of tries) are appended to this
     """
-    
     t_min = indices[0].start
     t_max = indices[0].stop
-    in_time_slices = [slice(ts, min(ts+CHUNK_SIZE, t_max)) for ts in range(t_min, t_max, CHUNK_SIZE)]
+    in_time_slices = get_time_slices(dataset, t_min, t_max, chunk_size)
+    if pool is None:
+        with concurrent.futures.ThreadPoolExecutor(LOAD_THREADS) as pool:
+            return load(dataset, indices, vis, weights, flags, err, pool=pool, chunk_size=chunk_size, stats=stats)
+    futures = []
     for in_ts in in_time_slices:
         out_ts = slice(in_ts.start - t_min, in_ts.stop - t_min)
-        out_vis = vis[out_ts]
-        out_weights = weights[out_ts]
-        out_flags = flags[out_ts]
-        for i in range(NUM_RETRIES):
-            try:
-                if isinstance(dataset.vis, DaskLazyIndexer):
-                    DaskLazyIndexer.get([dataset.vis, dataset.weights, dataset.flags], in_ts, out=[out_vis, out_weights, out_flags])
-                else:
-                    out_vis[:] = dataset.vis[in_ts]
-                    out_weights[:] = dataset.weights[in_ts]
-                    out_flags[:] = dataset.flags[in_ts]
-                break
-            except StoreUnavailable:
-                msg = 'Timeout when reading dumps %d to %d. Try %d/%d....' % (out_ts.start + 1, out_ts.stop, i + 1, NUM_RETRIES)
-                OErr.PLog(err, OErr.Warn, msg);
-                OErr.printErr(err)
-                print(msg)
+        futures.append((out_ts, pool.submit(load_chunk, dataset, in_ts, vis[out_ts], weights[out_ts], flags[out_ts], err)))
+    for out_ts, future in futures:
+        success, latency, tries = future.result()
+        if stats is not None:
+            stats.append((latency, tries))
         # Flag the data and warn if we can't get it
-        if i == NUM_RETRIES - 1:
-            msg = 'Too many timeouts, flagging dumps %d to %d' % (out_ts.start + 1, out_ts.stop)
+        if not success:
+            msg = 'Too many timeouts, flagging dumps %d to %d' % (t_min + out_ts.start + 1, t_min + out_ts.stop)
             OErr.PLog(err, OErr.Warn, msg);
             OErr.printErr(err)
             print(msg)
             flags[out_ts] = True
 
+def log_read_stats(stats, total_time, err):
+    """
+    Log a summary of the per-chunk read latencies recorded by load.
+
+    * stats      = list of (latency in seconds, number of tries)
+    * total_time = wall time of the conversion in seconds
+    * err        = Python Obit Error/message stack
+    """
+    if len(stats) == 0:
+        return
+    latency = numpy.array([s[0] for s in stats])
+    retries = sum(s[1] - 1 for s in stats)
+    msg = "Read %d chunks: latency mean %.3f s, median %.3f s, max %.3f s, %d retries" % \
+          (len(latency), latency.mean(), numpy.median(latency), latency.max(), retries)
+    OErr.PLog(err, OErr.Info, msg)
+    msg2 = "Summed chunk read time %.1f s in %.1f s of conversion" % (latency.sum(), total_time)
+    OErr.PLog(err, OErr.Info, msg2)
+    OErr.printErr(err)
+    print(msg)
+    print(msg2)
+
 @numba.jit(nopython=True, parallel=True)
-def fill_buffer(in_vis, in_flags, in_weights, in_rparm, cp_index, bls_index, out_buffer, or_flags_pols=True):
+def fill_buffer(in_vis, in_flags, in_weights, n_rparm, cp_index, bls_index, out_buffer, or_flags_pols=True):
     """Reorganise baselines and axis order.
-    The inputs have dimensions (channel, pol-baseline), and the output 
-    is a 1d array buffer written to aips, random parameters are written 
-    before each visibility. Flags are applied by negating the weights.
+    The inputs have dimensions (time, channel, pol-baseline), and the output
+    is a 1d array buffer written to aips, space for n_rparm random parameters
+    is left before each visibility (they are written separately, see
+    write_random_parameters). Visibilities are ordered time-baseline in the
+    buffer. Flags are applied by negating the weights.
     cp_index is a 3D array which is indexed by
     ant1, ant2 and pol to get the input pol-baseline.
     Stolen from katdal, mvftoms
     """
     in_flags_u8 = in_flags.view(numpy.uint8)
+    n_time = in_vis.shape[0]
     n_bls = bls_index.shape[0]
-    n_chans = in_vis.shape[0]
+    n_chans = in_vis.shape[1]
     n_pols = cp_index.shape[2]
-    n_rparm = in_rparm.shape[1]
     vis_step = n_rparm + (n_chans * n_pols * 3)
     bstep = 128
     bblocks = (n_bls + bstep - 1) // bstep
-    for bblock in numba.prange(bblocks):
-        bstart = bblock * bstep
+    for tblock in numba.prange(n_time * bblocks):
+        t = tblock // bblocks
+        bstart = (tblock % bblocks) * bstep
         bstop = min(n_bls, bstart + bstep)
         for b in range(bstart, bstop):
             a1, a2 = bls_index[b]
-            thisrparm = in_rparm[b]
-            for r in range(n_rparm):
-                out_buffer[(b * vis_step) + r] = thisrparm[r]
+            vis_start = ((t * n_bls) + b) * vis_step
             for c in range(n_chans):
                 if or_flags_pols:
                     p_flag = False
                     # OR the flags over pols
                     for p in range(n_pols):
                         idx = cp_index[a1, a2, p]
-                        p_flag |= in_flags_u8[c, idx] > 0
+                        p_flag |= in_flags_u8[t, c, idx] > 0
                 for p in range(n_pols):
                     idx = cp_index[a1, a2, p]
-                    vis = in_vis[c, idx]
+                    vis = in_vis[t, c, idx]
                     if or_flags_pols:
                         flg = p_flag
                     else:
-                        flg = in_flags_u8[c, idx] > 0
+                        flg = in_flags_u8[t, c, idx] > 0
                     if flg:
                         weight = -32767.
                     else:
-                        weight = in_weights[c, idx]
-                    buff_idx = (b * vis_step) + n_rparm + (c * n_pols * 3) + (p * 3)
+                        weight = in_weights[t, c, idx]
+                    buff_idx = vis_start + n_rparm + (c * n_pols * 3) + (p * 3)
                     out_buffer[buff_idx] = vis.real
                     out_buffer[buff_idx + 1] = vis.imag
                     out_buffer[buff_idx + 2] = weight
@@ -867,14 +1658,6 @@ def get_baseline_mask(ants, corr_prods, limit):
     whether the basline length of the given correlation product is
     shorter than limit in meters
     """
-    baseline_mask = numpy.zeros(corr_prods.shape[0], dtype=numpy.bool)
-    antlookup = {}
-    for ant in ants:
-        antlookup[ant.name] = ant
-    for prod, baseline in enumerate(corr_prods):
-        bl_vector = antlookup[baseline[0][:4]].baseline_toward(antlookup[baseline[1][:4]])
-        bl_length = numpy.linalg.norm(bl_vector)
-        if bl_length < limit:
-            baseline_mask[prod] = True
-    return baseline_mask
+    antnums = [int(ant.name[1:]) + 1 for ant in ants]
+    return GetBaselineIndex(ants, corr_prods, antnums).prod_length < limit
 
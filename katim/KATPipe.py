@@ -1,5 +1,5 @@
 import sys, pydoc
-import OErr, OSystem, UV, AIPS, FITS, OTObit
+import OErr, OSystem, UV, AIPS, FITS
 import ObitTalkUtil
 from AIPS import AIPSDisk
 from FITS import FITSDisk
@@ -15,6 +15,10 @@ import subprocess
 from . import KATH5toAIPS
 import os
 from . import AIPSSetup
+from . import KATResources
+from . import KATProfile
+from . import KATExport
+from . import KATReport
 import shutil
 from .KATImExceptions import KATUnimageableError
 
@@ -60,11 +64,15 @@ def MKContPipeline(files, outputdir, **kwargs):
 
     ObitSys = AIPSSetup.AIPSSetup(err,configfile=kwargs.get('configFile'),scratchdir=kwargs.get('scratchdir'))
 
+    # Profile of the pipeline steps, next to the manifest
+    profile = KATProfile.InitProfile(outputdir, logFile=logFile)
+    EVLAAddOutFile('profile.json', 'project', 'Pipeline step profile')
+    EVLAAddOutFile('profile.csv', 'project', 'Pipeline step profile')
+
     # Get the set up AIPS environment.
     AIPS_ROOT    = os.environ['AIPS_ROOT']
     AIPS_VERSION = os.environ['AIPS_VERSION']
 
-    nThreads = 24
     user = OSystem.PGetAIPSuser()
     AIPS.userno = user
     disk = 1
@@ -101,10 +109,10 @@ def MKContPipeline(files, outputdir, **kwargs):
         flags=kwargs.get('flags')
         fa = flags.split(',')
         for fn,ff in enumerate(fa):
-	        ex_flags_file = h5py.File(ff)
-	        ex_flags = da.from_array(ex_flags_file['flags'], chunks=(1,342,katdata.shape[2]))
-	        #Sum the new flags 
-        	katdata.datasets[fn].source.data.flags = ex_flags
+                ex_flags_file = h5py.File(ff)
+                ex_flags = da.from_array(ex_flags_file['flags'], chunks=(1,342,katdata.shape[2]))
+                #Sum the new flags 
+                katdata.datasets[fn].source.data.flags = ex_flags
 
     #Are we MeerKAT or KAT-7
     telescope = katdata.ants[0].name[0]
@@ -122,18 +130,15 @@ def MKContPipeline(files, outputdir, **kwargs):
     MKATh5Select(katdata, parms, err, **kwargs)
 
     ####################### Import data into AIPS #####################################################
-    # Construct a template uvfits file from master template
-    mastertemplate=ObitTalkUtil.FITSDir.FITSdisks[fitsdisk]+'MKATTemplate.uvtab.gz'
-    outtemplate=nam+'.uvtemp'
-    KATH5toAIPS.MakeTemplate(mastertemplate,outtemplate,len(katdata.channel_freqs))
-    uv=OTObit.uvlod(outtemplate,0,nam,cls,disk,seq,err)
+    # Create the AIPS uv data with the geometry of katdata
+    uv = KATH5toAIPS.CreateKATUV(katdata, nam, cls, disk, seq, err, loadhalf=kwargs.get('loadhalf',False), \
+                                 chanav=kwargs.get('chanav',1))
 
-    obsdata = KATH5toAIPS.KAT2AIPS(katdata, uv, disk, fitsdisk, err, calInt=1.0, **kwargs)
-    MakeIFs.UVMakeIF(uv,8,err)
+    obsdata = KATProfile.Call(profile, KATH5toAIPS.KAT2AIPS, katdata, uv, disk, fitsdisk, err, calInt=1.0, **kwargs)
+    KATProfile.Call(profile, MakeIFs.UVMakeIF, uv,8,err)
 
     # Print the uv data header to screen.
     uv.Header(err)
-    os.remove(outtemplate)
     ############################# Set Project Processing parameters ###################################
     # Parameters derived from obsdata and katdata
     MKATGetObsParms(obsdata, katdata, parms, logFile)
@@ -152,6 +157,9 @@ def MKContPipeline(files, outputdir, **kwargs):
     # Load the outputs pickle jar
     EVLAFetchOutFiles()
 
+    # Thread budgets from the cores, memory and data size
+    resources = KATResources.ResourceBudget(obsdata, configfile=kwargs.get('configFile'), logFile=logFile)
+    nThreads = resources["nThreads"]
     OSystem.PAllowThreads(nThreads)   # Allow threads in Obit/oython
     retCode = 0
 
@@ -196,11 +204,11 @@ def MKContPipeline(files, outputdir, **kwargs):
     EVLAAddOutFile(os.path.basename(ParmsPicklefile), 'project', 'Processing parameters used' )
     loadClass = dataClass
 
-    retCode = KATCalAvg (uv, "PREAVG", parms["seq"], parms["CalAvgTime"], err, \
+    retCode = KATProfile.Call(profile, KATCalAvg, uv, "PREAVG", parms["seq"], parms["CalAvgTime"], err, \
                               flagVer=-1, doCalib=-1, gainUse=-1, doBand=-1, BPVer=-1, doPol=False, \
                               avgFreq=0, chAvg=1, BChan=1, EChan=0, doAuto=parms["doAuto"], Stokes=' ',\
                               BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
-                              nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                              nThreads=resources["Splat"], logfile=logFile, check=check, debug=debug)
     if retCode!=0:
         raise  RuntimeError("Error in CalAvg")
     uv.Zap(err)
@@ -220,7 +228,7 @@ def MKContPipeline(files, outputdir, **kwargs):
             if err.isErr:
                 OErr.printErrMsg(err, "Error creating AIPS data")
 
-        uv = KATHann(uv, EVLAAIPSName(project), dataClass, disk, parms["seq"], err, \
+        uv = KATProfile.Call(profile, KATHann, uv, EVLAAIPSName(project), dataClass, disk, parms["seq"], err, \
                       doDescm=parms["doDescm"], flagVer=0, logfile=logFile, check=check, debug=debug)
         #Halve channels after hanning.
         parms["selChan"]=int(parms["selChan"]/2)
@@ -256,7 +264,7 @@ def MKContPipeline(files, outputdir, **kwargs):
     if parms["doMednTD1"]:
         mess =  "Median window time editing, for RFI impulsive in time:"
         printMess(mess, logFile)
-        retCode = EVLAMedianFlag (uv, clist, err, noScrat=noScrat, nThreads=nThreads, \
+        retCode = KATProfile.Call(profile, EVLAMedianFlag, uv, clist, err, noScrat=noScrat, nThreads=resources["AutoFlag"], \
                                   avgTime=parms["mednAvgTime"], avgFreq=parms["mednAvgFreq"],  chAvg= parms["mednChAvg"], \
                                   timeWind=parms["mednTimeWind"],flagVer=2, flagTab=2,flagSig=parms["mednSigma"], \
                                   logfile=logFile, check=check, debug=False)
@@ -267,12 +275,12 @@ def MKContPipeline(files, outputdir, **kwargs):
     if parms["doFD1"]:
         mess =  "Median window frequency editing, for RFI impulsive in frequency:"
         printMess(mess, logFile)
-        retCode = EVLAAutoFlag (uv, clist, err, flagVer=2, flagTab=2, doCalib=-1, doBand=-1,   \
+        retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, clist, err, flagVer=2, flagTab=2, doCalib=-1, doBand=-1,   \
                                 timeAvg=parms["FD1TimeAvg"], \
                                 doFD=True, FDmaxAmp=1.0e20, FDmaxV=1.0e20, FDwidMW=parms["FD1widMW"],  \
                                 FDmaxRMS=[1.0e20,0.1], FDmaxRes=parms["FD1maxRes"],  \
                                 FDmaxResBL= parms["FD1maxRes"],  FDbaseSel=parms["FD1baseSel"],\
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
            raise  RuntimeError("Error in AutoFlag")
     
@@ -294,7 +302,7 @@ def MKContPipeline(files, outputdir, **kwargs):
         mess = "Find best reference antenna: run Calib on BP Cal(s) "
         printMess(mess, logFile)
         parms["refAnt"] = EVLAGetRefAnt(uv, parms["BPCals"], err, flagVer=0, \
-                                        solInt=parms["bpsolint1"], nThreads=nThreads, \
+                                        solInt=parms["bpsolint1"], nThreads=resources["Calib"], \
                                         logfile=logFile, check=check, debug=debug)
         if err.isErr:
                 raise  RuntimeError("Error finding reference antenna")
@@ -326,14 +334,14 @@ def MKContPipeline(files, outputdir, **kwargs):
     # delay calibration
     if parms["doDelayCal"] and parms["DCals"] and not check:
         plotFile = fileRoot+"_DelayCal.ps"
-        retCode = EVLADelayCal(uv, parms["DCals"], err,  \
+        retCode = KATProfile.Call(profile, EVLADelayCal, uv, parms["DCals"], err,  \
                                BChan=parms["delayBChan"], EChan=parms["delayEChan"], \
                                doCalib=2, flagVer=0, doBand=-1, \
                                solInt=parms["delaySolInt"], smoTime=parms["delaySmoo"],  \
                                refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], 
                                doZeroPhs=parms["delayZeroPhs"], \
                                doPlot=parms["doSNPlot"], plotFile=plotFile, \
-                               nThreads=nThreads, noScrat=noScrat, \
+                               nThreads=resources["Calib"], noScrat=noScrat, \
                                logfile=logFile, check=check, debug=debug)
         if retCode!=0:
             raise RuntimeError("Error in delay calibration")
@@ -347,16 +355,16 @@ def MKContPipeline(files, outputdir, **kwargs):
                                    check=check, debug=debug, logfile=logFile )
             if retCode!=0:
                 raise  RuntimeError("Error in Plotting spectrum")
-	print(parms["bpBChan1"],parms["bpEChan1"],parms["bpBChan2"],parms["bpEChan2"],parms["bpChWid2"])
+        print(parms["bpBChan1"],parms["bpEChan1"],parms["bpBChan2"],parms["bpEChan2"],parms["bpChWid2"])
     # Bandpass calibration
     if parms["doBPCal"] and parms["BPCals"]:
-        retCode = KATBPCal(uv, parms["BPCals"], err, noScrat=noScrat, solInt1=parms["bpsolint1"], \
+        retCode = KATProfile.Call(profile, KATBPCal, uv, parms["BPCals"], err, noScrat=noScrat, solInt1=parms["bpsolint1"], \
                             solInt2=parms["bpsolint2"], solMode=parms["bpsolMode"], \
                             BChan1=parms["bpBChan1"], EChan1=parms["bpEChan1"], \
                             BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
                             doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
                             UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
-                            nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                            nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
             raise RuntimeError("Error in Bandpass calibration")
 
@@ -372,14 +380,14 @@ def MKContPipeline(files, outputdir, **kwargs):
     # Amp & phase Calibrate
     if parms["doAmpPhaseCal"]:
         plotFile = fileRoot+"_APCal.ps"
-        retCode = KATCalAP (uv, [], parms["ACals"], err, PCals=parms["PCals"], 
+        retCode = KATProfile.Call(profile, KATCalAP, uv, [], parms["ACals"], err, PCals=parms["PCals"], 
                              doCalib=2, doBand=1, BPVer=1, flagVer=0, \
                              BChan=parms["ampBChan"], EChan=parms["ampEChan"], \
                              solInt=parms["solInt"], solSmo=parms["solSmo"], ampScalar=parms["ampScalar"], \
                              doAmpEdit=parms["doAmpEdit"], ampSigma=parms["ampSigma"], \
                              ampEditFG=parms["ampEditFG"], \
                              doPlot=parms["doSNPlot"], plotFile=plotFile,  refAnt=parms["refAnt"], \
-                             nThreads=nThreads, noScrat=noScrat, logfile=logFile, check=check, debug=debug)
+                             nThreads=resources["Calib"], noScrat=noScrat, logfile=logFile, check=check, debug=debug)
         #print parms["ACals"],parms["PCals"]
         if retCode!=0:
             raise RuntimeError("Error calibrating")
@@ -405,14 +413,14 @@ def MKContPipeline(files, outputdir, **kwargs):
         else:
             clist = []
 
-        retCode = EVLAAutoFlag (uv, clist, err, flagVer=0, flagTab =2, \
+        retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, clist, err, flagVer=0, flagTab =2, \
                                 doCalib=2, gainUse=0, doBand=1, BPVer=1,  \
                                 IClip=parms["IClip"], minAmp=parms["minAmp"], timeAvg=parms["timeAvg"], \
                                 doFD=parms["doAFFD"], FDmaxAmp=parms["FDmaxAmp"], FDmaxV=parms["FDmaxV"], \
                                 FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
                                 FDmaxRes=parms["FDmaxRes"],  FDmaxResBL=parms["FDmaxResBL"], \
                                 FDbaseSel=parms["FDbaseSel"], \
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
            raise  RuntimeError("Error in AutoFlag")
 
@@ -440,14 +448,14 @@ def MKContPipeline(files, outputdir, **kwargs):
         # Delay recalibration
         if parms["doDelayCal2"] and parms["DCals"] and not check:
             plotFile = fileRoot+"_DelayCal2.ps"
-            retCode = EVLADelayCal(uv, parms["DCals"], err, \
+            retCode = KATProfile.Call(profile, EVLADelayCal, uv, parms["DCals"], err, \
                                    BChan=parms["delayBChan"], EChan=parms["delayEChan"], \
                                    doCalib=2, flagVer=0, doBand=-1, \
                                    solInt=parms["delaySolInt"], smoTime=parms["delaySmoo"],  \
                                    refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], \
                                    doZeroPhs=parms["delayZeroPhs"], \
                                    doPlot=parms["doSNPlot"], plotFile=plotFile, \
-                                   nThreads=nThreads, noScrat=noScrat, \
+                                   nThreads=resources["Calib"], noScrat=noScrat, \
                                    logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in delay calibration")
@@ -463,13 +471,13 @@ def MKContPipeline(files, outputdir, **kwargs):
 
         # Bandpass calibration
         if parms["doBPCal2"] and parms["BPCals"]:
-            retCode = KATBPCal(uv, parms["BPCals"], err, noScrat=noScrat, solInt1=parms["bpsolint1"], \
+            retCode = KATProfile.Call(profile, KATBPCal, uv, parms["BPCals"], err, noScrat=noScrat, solInt1=parms["bpsolint1"], \
                             solInt2=parms["bpsolint2"], solMode=parms["bpsolMode"], \
                             BChan1=parms["bpBChan1"], EChan1=parms["bpEChan1"], \
                             BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
                             doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
                             UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
-                            nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                            nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in Bandpass calibration")
         
@@ -485,14 +493,14 @@ def MKContPipeline(files, outputdir, **kwargs):
         # Amp & phase Recalibrate
         if parms["doAmpPhaseCal2"]:
             plotFile = fileRoot+"_APCal2.ps"
-            retCode = KATCalAP (uv, [], parms["ACals"], err, PCals=parms["PCals"], \
+            retCode = KATProfile.Call(profile, KATCalAP, uv, [], parms["ACals"], err, PCals=parms["PCals"], \
                                  doCalib=2, doBand=2, BPVer=1, flagVer=0, \
                                  BChan=parms["ampBChan"], EChan=parms["ampEChan"], \
                                  solInt=parms["solInt"], solSmo=parms["solSmo"], ampScalar=parms["ampScalar"], \
                                  doAmpEdit=True, ampSigma=parms["ampSigma"], \
                                  ampEditFG=parms["ampEditFG"], \
                                  doPlot=parms["doSNPlot"], plotFile=plotFile, refAnt=parms["refAnt"], \
-                                 noScrat=noScrat, nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                 noScrat=noScrat, nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error calibrating")
 
@@ -500,25 +508,25 @@ def MKContPipeline(files, outputdir, **kwargs):
         if parms["doAutoFlag2"]:
             mess =  "Post recalibration editing:"
             printMess(mess, logFile)
-            retCode = EVLAAutoFlag (uv, [], err, flagVer=0, flagTab=2, \
+            retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, [], err, flagVer=0, flagTab=2, \
                                     doCalib=2, gainUse=0, doBand=1, BPVer=1,  \
                                     IClip=parms["IClip"], minAmp=parms["minAmp"], timeAvg=parms["timeAvg"], \
                                     doFD=parms["doAFFD"], FDmaxAmp=parms["FDmaxAmp"], FDmaxV=parms["FDmaxV"], \
                                     FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
                                     FDmaxRes=parms["FDmaxRes"],  FDmaxResBL= parms["FDmaxResBL"], \
                                     FDbaseSel=parms["FDbaseSel"], \
-                                    nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                    nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise  RuntimeError("Error in AutoFlag")
     # end recal
     # Calibrate and average data
     if parms["doCalAvg"]:
-        retCode = KATCalAvg (uv, avgClass, parms["seq"], parms["CalAvgTime"], err, \
+        retCode = KATProfile.Call(profile, KATCalAvg, uv, avgClass, parms["seq"], parms["CalAvgTime"], err, \
                               flagVer=2, doCalib=2, gainUse=0, doBand=1, BPVer=1, doPol=False, \
                               avgFreq=parms["avgFreq"], chAvg=parms["chAvg"], \
                               BChan=1, EChan=parms["selChan"] - 1, doAuto=parms["doAuto"], \
                               BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
-                              nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                              nThreads=resources["Splat"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
            raise  RuntimeError("Error in CalAvg")
 
@@ -529,16 +537,15 @@ def MKContPipeline(files, outputdir, **kwargs):
         if err.isErr:
             OErr.printErrMsg(err, "Error creating cal/avg AIPS data")
 
-    KATUVFITS(uv, 'preimage.uvfits', 0, err, exclude=["AIPS HI", "AIPS SL", "AIPS PL"], include=["AIPS AN", "AIPS FQ"], compress=parms["Compress"], logfile=logFile)
-    KATUVFITab(uv, 'preimage.uvtab', 0, err)
+    KATExport.ExportUV(uv, [("fittp", 'preimage.uvfits'), ("fitab", 'preimage.uvtab')], err, logfile=logFile)
     # XClip
     if parms["XClip"] and parms["XClip"]>0.0:
         mess =  "Cross Pol clipping:"
         printMess(mess, logFile)
-        retCode = EVLAAutoFlag (uv, [], err, flagVer=-1, flagTab=1, \
+        retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, [], err, flagVer=-1, flagTab=1, \
                                 doCalib=2, gainUse=0, doBand=-1, maxBad=1.0,  \
                                 XClip=parms["XClip"], timeAvg=1./60., \
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
             raise  RuntimeError("Error in AutoFlag")
     
@@ -555,7 +562,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                               # NOT HERE doBand=parms["rlDoBand"], BPVer=parms["rlBPVer"],  \
                               flagVer=parms["rlflagVer"], \
                               refAnt=parms["rlrefAnt"], doPol=False,  \
-                              nThreads=nThreads, noScrat=noScrat, logfile=logFile, \
+                              nThreads=resources["Calib"], noScrat=noScrat, logfile=logFile, \
                               check=check, debug=debug)
         if retCode!=0:
             raise RuntimeError("Error in R-L delay calibration")
@@ -569,7 +576,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                              fixPoln=parms["PCFixPoln"], pmodel=parms["PCpmodel"], avgIF=parms["PCAvgIF"], \
                              solInt=parms["PCSolInt"], refAnt=parms["PCRefAnt"], solType=parms["PCSolType"], \
                              ChInc=parms["PCChInc"], ChWid=parms["PCChWid"], \
-                             nThreads=nThreads, check=check, debug=debug, noScrat=noScrat, logfile=logFile)
+                             nThreads=resources["Calib"], check=check, debug=debug, noScrat=noScrat, logfile=logFile)
         if retCode!=0 and (not check):
            raise  RuntimeError("Error in polarization calibration: "+str(retCode))
         # end poln cal.
@@ -591,7 +598,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                             doBand=-1, BPVer=1, flagVer=parms["rlflagVer"], \
                             refAnt=parms["rlrefAnt"], doPol=parms["doPol"], PDVer=parms["PDVer"],  \
                             doPlot=parms["doSpecPlot"], plotFile=plotFile, \
-                            nThreads=nThreads, noScrat=noScrat, logfile=logFile, \
+                            nThreads=resources["Calib"], noScrat=noScrat, logfile=logFile, \
                             check=check, debug=debug)
         if retCode!=0:
             raise RuntimeError("Error in RL phase spectrum calibration")
@@ -600,10 +607,10 @@ def MKContPipeline(files, outputdir, **kwargs):
     if parms["VClip"] and parms["VClip"]>0.0:
         mess =  "VPol clipping:"
         printMess(mess, logFile)
-        retCode = EVLAAutoFlag (uv, [], err, flagVer=-1, flagTab=1, \
+        retCode = KATProfile.Call(profile, EVLAAutoFlag, uv, [], err, flagVer=-1, flagTab=1, \
                                 doCalib=2, gainUse=0, doBand=-1,  \
                                 VClip=parms["VClip"], timeAvg=parms["timeAvg"], \
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
             raise  RuntimeError("Error in AutoFlag VClip")
     
@@ -627,7 +634,7 @@ def MKContPipeline(files, outputdir, **kwargs):
         else:
             slist = targets
         slist=targets
-        KATImageTargets (uv, err, Sources=slist, seq=parms["seq"], sclass=outIClass, OutlierArea=parms["outlierArea"],\
+        KATProfile.Call(profile, KATImageTargets, uv, err, Sources=slist, seq=parms["seq"], sclass=outIClass, OutlierArea=parms["outlierArea"],\
                           doCalib=-1, doBand=-1,  flagVer=-1, doPol=parms["doPol"], PDVer=parms["PDVer"],  \
                           Stokes=parms["Stokes"], FOV=parms["FOV"], Robust=parms["Robust"], Niter=parms["Niter"], \
                           CleanRad=parms["CleanRad"], minFlux=parms["minFlux"], OutlierSize=parms["OutlierSize"], \
@@ -641,7 +648,8 @@ def MKContPipeline(files, outputdir, **kwargs):
                           doMB=parms["doMB"], norder=parms["MBnorder"], maxFBW=parms["MBmaxFBW"], \
                           PBCor=parms["PBCor"],antSize=parms["antSize"], autoCen=parms["autoCen"], \
                           nTaper=parms["nTaper"], Tapers=parms["Tapers"], sefd=sefd, \
-                          nThreads=nThreads, noScrat=noScrat, logfile=logFile, check=check, debug=False)
+                          maxConcurrent=parms["maxConcurrent"], \
+                          nThreads=min(nThreads, resources["MFImage"]*parms["maxConcurrent"]), noScrat=noScrat, logfile=logFile, check=check, debug=False)
         # End image
     
     # Get report on sources
@@ -651,7 +659,7 @@ def MKContPipeline(files, outputdir, **kwargs):
             slist = EVLAAllSource(uv,err,logfile=logFile,check=check,debug=debug)
         else:
             slist = parms["targets"]
-        Report = EVLAReportTargets(uv, err, Sources=slist, seq=parms["seq"], sclass=outIClass, \
+        Report = KATProfile.Call(profile, EVLAReportTargets, uv, err, Sources=slist, seq=parms["seq"], sclass=outIClass, \
                                        Stokes=parms["Stokes"], logfile=logFile, check=check, debug=debug)
         # Save to pickle jar
         ReportPicklefile = fileRoot+"_Report.pickle"   # Where results saved
@@ -670,6 +678,9 @@ def MKContPipeline(files, outputdir, **kwargs):
             # Save list of output files
             EVLASaveOutFiles(manifestfile)
             del uvt
+    # Reports are made in the background as soon as their inputs exist
+    reports = KATReport.InitReports(parms["nReportWorkers"], logFile)
+
     # Imaging results
     # If targets not specified, save all
     if len(parms["targets"])<=0:
@@ -688,15 +699,14 @@ def MKContPipeline(files, outputdir, **kwargs):
                     continue
                 x = Image.newPAImage("out", outname, oclass, disk, parms["seq"], True, err)
                 outfilefits = fileRoot+'_'+target+"."+oclass+".fits"
-                xf = KATImFITS(x, outfilefits, 0, err, logfile=logFile)
-                x = Image.newPAImage("out", outname, oclass, disk, parms["seq"], True, err)
                 outfile = fileRoot+'_'+target+"."+oclass+".fittab.fits"
-                xf = EVLAImFITS (x, outfile, 0, err, logfile=logFile)
+                KATExport.ExportImage(x, [("fittp", outfilefits), ("imtab", outfile)], err, logfile=logFile)
                 EVLAAddOutFile(outfile, target, 'Image of '+ target)
                 # Statistics
                 zz=imstat(x, err, logfile=logFile)
                 # Make a Jpeg image
-                FITS2jpeg.fits2jpeg(outfilefits,chans=1,contrast=0.05,cmap='jet',area=0.7)
+                KATReport.Submit(reports, "Jpeg "+target, FITS2jpeg.fits2jpeg, outfilefits, \
+                                 chans=1,contrast=0.05,cmap='jet',area=0.7)
                 EVLAAddOutFile(outfile.replace('.fits','.jpeg'), target, 'Jpeg image of '+ target)
     # end writing loop
     
@@ -708,10 +718,10 @@ def MKContPipeline(files, outputdir, **kwargs):
     if parms["doKntrPlots"]:
         mess = "INFO --> Contour plots (doKntrPlots)"
         printMess(mess, logFile)
-        EVLAKntrPlots( err, imName=parms["targets"], project=fileRoot,
-                       disk=disk, debug=debug )
-        # Save list of output files
-        EVLASaveOutFiles(manifestfile)
+        # Own error stack in the background
+        KATReport.Submit(reports, "Contour plots", EVLAKntrPlots, OErr.OErr(), \
+                         imName=parms["targets"], project=fileRoot, \
+                         disk=disk, logfile=logFile, debug=debug )
     elif debug:
         mess = "Not creating contour plots ( doKntrPlots = "+str(parms["doKntrPlots"])+ " )"
         printMess(mess, logFile)
@@ -726,11 +736,9 @@ def MKContPipeline(files, outputdir, **kwargs):
         if not check:
             uvname = project+"_Cal"
             uvc = UV.newPAUV(uvname, Aname, avgClass, disk, parms["seq"], True, err)
-        EVLADiagPlots( uvc, err, cleanUp=parms["doCleanup"], \
-                           project=fileRoot, \
-                           logfile=logFile, check=check, debug=debug )
-        # Save list of output files
-        EVLASaveOutFiles(manifestfile)
+        KATReport.Submit(reports, "Diagnostic plots", EVLADiagPlots, uvc, OErr.OErr(), \
+                         cleanUp=parms["doCleanup"], project=fileRoot, \
+                         logfile=logFile, check=check, debug=debug )
     elif debug:
         mess = "Not creating diagnostic plots ( doDiagPlots = "+str(parms["doDiagPlots"])+ " )"
         printMess(mess, logFile)
@@ -774,21 +782,29 @@ def MKContPipeline(files, outputdir, **kwargs):
          picklefile = fileRoot+".ProjReport.pickle"
          projMetadata = FetchObject(picklefile)
    
+    # The HTML and VOTable reports list the plots and images
+    KATReport.WaitReports(reports)
+
     # Write report
     if parms["doHTML"]:
         mess = "INFO --> Write HTML report (doHTML)"
         printMess(mess, logFile)
-        KATHTMLReport( projMetadata, srcMetadata, \
-                            outfile=fileRoot+"_report.html", \
-                            logFile=logFile )
+        KATReport.Submit(reports, "HTML", KATProfile.Call, profile, KATHTMLReport, \
+                         projMetadata, srcMetadata, \
+                         outfile=fileRoot+"_report.html", \
+                         logFile=logFile )
     
     # Write VOTable
     if parms["doVOTable"]:
         mess = "INFO --> Write VOTable (doVOTable)"
         printMess(mess, logFile)
         EVLAAddOutFile( 'VOTable.xml', 'project', 'VOTable report' ) 
-        EVLAWriteVOTable( projMetadata, srcMetadata, filename=fileRoot+'_VOTable.xml' )
+        KATReport.Submit(reports, "VOTable", EVLAWriteVOTable, projMetadata, srcMetadata, \
+                         filename=fileRoot+'_VOTable.xml' )
     
+    # Wait for all reports before the manifest is final
+    KATReport.CloseReports(reports)
+
     # Save list of output files
     EVLASaveOutFiles(manifestfile)
     
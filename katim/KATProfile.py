@@ -0,0 +1,195 @@
+""" Instrumentation of pipeline steps
+
+Each step called through Call is timed and its resource use recorded:
+wall and CPU time, peak resident memory during the step, bytes read and
+written and the change in size of the AIPS disks, and the step's return
+code. Obit and AIPS tasks run as child processes so their CPU time and
+I/O, which are accounted to the pipeline once a task finishes, are
+included. The resident memory of the pipeline and of its running tasks
+is sampled every RSS_INTERVAL seconds while a step runs.
+The records are rewritten after every step to a JSON and a CSV profile.
+"""
+#-----------------------------------------------------------------------
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#-----------------------------------------------------------------------
+import os, time, json, csv, resource, threading
+import AIPSDir
+from PipeUtil import printMess
+
+# Columns of the CSV profile
+PROFILE_FIELDS = ["step", "start", "wall", "cpu", "peakRSS", "taskPeakRSS",
+                  "readBytes", "writeBytes", "aipsBytes", "retCode", "error"]
+# Interval in seconds between samples of the resident memory
+RSS_INTERVAL = 0.5
+
+def InitProfile(outputdir, aipsDirs=None, logFile=None):
+    """
+    Start a profile of a pipeline run
+
+    * outputdir = directory for profile.json and profile.csv
+    * aipsDirs  = AIPS disk directories to monitor, default all
+    * logFile   = Log file for messages
+    Returns profile dict used by Call
+    """
+    ################################################################
+    if aipsDirs is None:
+        aipsDirs = [d for d in AIPSDir.AIPSdisks if d]
+    return {"jsonFile":os.path.join(outputdir, "profile.json"),
+            "csvFile":os.path.join(outputdir, "profile.csv"),
+            "aipsDirs":aipsDirs, "logFile":logFile, "records":[]}
+    # end InitProfile
+
+def Call(profile, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) recording its resource use in profile
+
+    An integer returned by func is recorded as the return code.
+    Exceptions are recorded then raised again.
+    * profile = dict from InitProfile, None just calls func
+    * func    = pipeline step to call
+    Returns the value returned by func
+    """
+    ################################################################
+    if profile is None:
+        return func(*args, **kwargs)
+    rec = {"step":func.__name__, "start":time.strftime("%Y-%m-%d %H:%M:%S"),
+           "retCode":None, "error":""}
+    before = _usage(profile)
+    sampler = _RSSSampler()
+    try:
+        ret = func(*args, **kwargs)
+    except Exception as exception:
+        rec["error"] = repr(exception)
+        raise
+    else:
+        if isinstance(ret, int) and not isinstance(ret, bool):
+            rec["retCode"] = ret
+        return ret
+    finally:
+        rec["peakRSS"], rec["taskPeakRSS"] = sampler.stop()
+        after = _usage(profile)
+        for key in ("wall", "cpu", "readBytes", "writeBytes", "aipsBytes"):
+            rec[key] = after[key] - before[key]
+        profile["records"].append(rec)
+        mess = "Profile %s: %.1f s wall, %.1f s CPU, %.0f MB written" % \
+            (rec["step"], rec["wall"], rec["cpu"], rec["writeBytes"] / 1024.**2)
+        printMess(mess, profile["logFile"])
+        WriteProfile(profile)
+    # end Call
+
+def WriteProfile(profile):
+    """
+    Write the records of profile to its JSON and CSV files
+
+    * profile = dict from InitProfile
+    """
+    ################################################################
+    with open(profile["jsonFile"], "w") as f:
+        json.dump(profile["records"], f, indent=1)
+    with open(profile["csvFile"], "w") as f:
+        writer = csv.DictWriter(f, PROFILE_FIELDS)
+        writer.writeheader()
+        writer.writerows(profile["records"])
+    # end WriteProfile
+
+def _usage(profile):
+    """ Cumulative resource use of this process and its finished tasks """
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    tasks = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {"wall":time.time(),
+             "cpu":me.ru_utime + me.ru_stime + tasks.ru_utime + tasks.ru_stime,
+             "readBytes":0, "writeBytes":0, "aipsBytes":0}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key == "read_bytes":
+                    usage["readBytes"] = int(value)
+                elif key == "write_bytes":
+                    usage["writeBytes"] = int(value)
+    except IOError:
+        pass
+    for d in profile["aipsDirs"]:
+        try:
+            usage["aipsBytes"] += sum(e.stat().st_size for e in os.scandir(d) if e.is_file())
+        except OSError:
+            pass
+    return usage
+    # end _usage
+
+class _RSSSampler:
+    """
+    Peak resident memory (MB) of this process and of its child tasks
+    sampled from /proc in a background thread until stop is called.
+    The ru_maxrss of this process is the peak over the whole run so is
+    only used when it rose during the step, the step then set that peak.
+    That of the tasks includes the memory of the pipeline when each was
+    started so is not used; a task shorter than RSS_INTERVAL may be missed.
+    """
+    def __init__(self):
+        self.peak = [0., 0.]
+        self.maxRSS = _maxRSS()
+        self.done = threading.Event()
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.done.wait(RSS_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        self.peak[0] = max(self.peak[0], _rss(os.getpid()))
+        self.peak[1] = max(self.peak[1], sum(_rss(pid) for pid in _children(os.getpid())))
+
+    def stop(self):
+        """ Stop sampling, returns peak RSS (MB) of the pipeline and its tasks """
+        self.done.set()
+        self.thread.join()
+        self.sample()
+        maxRSS = _maxRSS()
+        if maxRSS > self.maxRSS:
+            self.peak[0] = max(self.peak[0], maxRSS)
+        return self.peak[0], self.peak[1]
+    # end _RSSSampler
+
+def _maxRSS():
+    """ Peak resident memory (MB) of this process over the run """
+    # ru_maxrss is in kB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    # end _maxRSS
+
+def _rss(pid):
+    """ Current resident memory (MB) of process pid, 0 if unknown """
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024.**2
+    except (IOError, ValueError, IndexError):
+        return 0.
+    # end _rss
+
+def _children(pid):
+    """ Process ids of all descendants of process pid """
+    pids = []
+    try:
+        tids = os.listdir("/proc/%d/task" % pid)
+    except OSError:
+        return pids
+    for tid in tids:
+        try:
+            with open("/proc/%d/task/%s/children" % (pid, tid)) as f:
+                kids = [int(k) for k in f.read().split()]
+        except (IOError, ValueError):
+            continue
+        for kid in kids:
+            pids += [kid] + _children(kid)
+    return pids
+    # end _children
@@ -0,0 +1,131 @@
+""" Background generation of pipeline reports
+
+Report products (JPEG images, plots, metadata, HTML and VOTable reports)
+are made by a pool of worker threads, each job submitted as soon as the
+products it needs exist, so they are made while the pipeline carries on.
+WaitReports is the barrier before the reports that need all of them and
+before the manifest of output files is written.
+PostScript plots are rendered to JPEG by a single ghostscript call.
+"""
+#-----------------------------------------------------------------------
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#-----------------------------------------------------------------------
+import os, time, subprocess, concurrent.futures
+from PipeUtil import printMess
+
+# Ghostscript executable
+GS = "gs"
+
+def InitReports(nWorkers=2, logFile=None):
+    """
+    Start a pool of report workers
+
+    * nWorkers = number of report jobs run at once, <=0 => run each job
+                 when submitted
+    * logFile  = Log file for messages
+    Returns reports dict used by Submit and WaitReports
+    """
+    ################################################################
+    pool = None
+    if nWorkers > 0:
+        pool = concurrent.futures.ThreadPoolExecutor(nWorkers)
+    return {"pool":pool, "jobs":[], "logFile":logFile}
+    # end InitReports
+
+def Submit(reports, name, func, *args, **kwargs):
+    """
+    Run report job func(*args, **kwargs) in the background
+
+    * reports = dict from InitReports
+    * name    = job name for messages
+    * func    = function making the report
+    Returns the concurrent.futures.Future of the job
+    """
+    ################################################################
+    def _job():
+        start = time.time()
+        ret = func(*args, **kwargs)
+        mess = "Report %s done in %.1f s" % (name, time.time() - start)
+        printMess(mess, reports["logFile"])
+        return ret
+    if reports["pool"] is None:
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(_job())
+        except (Exception, SystemExit) as exception:
+            future.set_exception(exception)
+    else:
+        future = reports["pool"].submit(_job)
+    reports["jobs"].append((name, future))
+    return future
+    # end Submit
+
+def WaitReports(reports):
+    """
+    Wait for all submitted report jobs to finish
+
+    Failed jobs are logged, a failed report does not stop the pipeline.
+    * reports = dict from InitReports
+    Returns the number of jobs that failed
+    """
+    ################################################################
+    nFail = 0
+    for name, future in reports["jobs"]:
+        try:
+            future.result()
+        except (Exception, SystemExit) as exception:
+            nFail += 1
+            mess = "ERROR Report %s failed: %s" % (name, repr(exception))
+            printMess(mess, reports["logFile"])
+    reports["jobs"] = []
+    return nFail
+    # end WaitReports
+
+def CloseReports(reports):
+    """
+    Wait for the report jobs then stop the workers
+
+    * reports = dict from InitReports
+    Returns the number of jobs that failed
+    """
+    ################################################################
+    nFail = WaitReports(reports)
+    if reports["pool"] is not None:
+        reports["pool"].shutdown()
+    return nFail
+    # end CloseReports
+
+def PSToJPEG(psfile, jpg, density=96, logfile=None):
+    """
+    Render the first page of a PostScript plot to JPEG
+
+    * psfile    = input PostScript file
+    * jpg       = output JPEG file
+    * density   = resolution in dots per inch
+    * logfile   = logfile for messages
+    Returns True if jpg was written
+    """
+    ################################################################
+    cmd = [GS, "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=jpeg",
+           "-r%d" % density, "-dJPEGQ=90", "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4",
+           "-dFirstPage=1", "-dLastPage=1", "-sOutputFile="+jpg, psfile]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as exception:
+        mess = "Cannot run ghostscript: "+str(exception)
+        printMess(mess, logfile)
+        return False
+    if proc.returncode != 0:
+        mess = "ghostscript failed on "+psfile+": "+proc.stdout.decode(errors="replace")
+        printMess(mess, logfile)
+        return False
+    return os.path.exists(jpg)
+    # end PSToJPEG
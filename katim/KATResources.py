@@ -0,0 +1,195 @@
+""" Thread and memory budgets for the pipelines
+
+The cores, cgroup CPU quota and memory available to the process are
+detected at startup and turned into per task thread counts, scaled by the
+size of the visibility data described by the GetKATMeta metadata.
+Any of the budgets can be fixed in the [RESOURCES] section of .katimrc:
+
+    [RESOURCES]
+    nthreads         = 32     # Total threads, default from cores/quota/memory
+    memory           = 64000  # Memory (MB), default MemAvailable/cgroup limit
+    calib_threads    = 8      # Threads for Calib based tasks
+    autoflag_threads = 32     # Threads for AutoFlag/MednFlag
+    mfimage_threads  = 16     # Threads for Imager/MFImage
+    splat_threads    = 8      # Threads for Splat/averaging
+"""
+#-----------------------------------------------------------------------
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#-----------------------------------------------------------------------
+import os, math, configparser
+from PipeUtil import printMess
+
+# Memory (MB) wanted per thread, caps the total number of threads
+MEM_PER_THREAD = 512.
+# Per task (GB of visibilities per thread, max. threads or None)
+TASK_SCALING = {"Calib":    (0.5,  16),
+                "AutoFlag": (0.25, None),
+                "MFImage":  (1.0,  None),
+                "Splat":    (0.5,  8)}
+
+def DetectResources():
+    """
+    Detect the CPU and memory available to this process
+
+    Returns dict with entries
+    "cores"    = cores this process may run on
+    "cpuQuota" = cgroup CPU quota in cores, None if unlimited
+    "memory"   = available memory in MB, None if unknown
+    """
+    ################################################################
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    res = {"cores":cores, "cpuQuota":_cgroup_cpu_quota()}
+    memory = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    memory = int(line.split()[1]) / 1024.
+                    break
+    except IOError:
+        pass
+    limit = _cgroup_memory_limit()
+    if limit is not None and (memory is None or limit < memory):
+        memory = limit
+    res["memory"] = memory
+    return res
+    # end DetectResources
+
+def _cgroup_cpu_quota():
+    """ cgroup (v2 or v1) CPU quota in cores, None if unlimited """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return float(quota) / float(period)
+        return None
+    except (IOError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = float(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = float(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (IOError, ValueError):
+        pass
+    return None
+    # end _cgroup_cpu_quota
+
+def _cgroup_memory_limit():
+    """ cgroup (v2 or v1) memory limit less usage in MB, None if unlimited """
+    for limitFile, usageFile in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                 ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+                                  "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        try:
+            with open(limitFile) as f:
+                limit = f.read().strip()
+            if limit == "max":
+                return None
+            limit = float(limit)
+            # v1 reports a huge number for no limit
+            if limit >= 2.**60:
+                return None
+            usage = 0.
+            if os.path.exists(usageFile):
+                with open(usageFile) as f:
+                    usage = float(f.read())
+            return (limit - usage) / 1024.**2
+        except (IOError, ValueError):
+            continue
+    return None
+    # end _cgroup_memory_limit
+
+def ReadResourceConfig(configfile=None):
+    """
+    Read the [RESOURCES] section of the configuration file
+
+    * configfile = configuration file, default ~/.katimrc
+    Returns dict of the options given a value
+    """
+    ################################################################
+    if not configfile:
+        configfile = os.path.expanduser("~") + '/.katimrc'
+    config = configparser.ConfigParser(inline_comment_prefixes=('#',))
+    config.read(configfile)
+    if not config.has_section('RESOURCES'):
+        return {}
+    # Blank values keep the defaults
+    return dict((k, v) for k, v in config.items('RESOURCES') if v.strip())
+    # end ReadResourceConfig
+
+def DataSize(meta):
+    """
+    Size in GB of the visibility data described by GetKATMeta metadata
+
+    * meta = dict from KATH5toAIPS.GetKATMeta
+    """
+    ################################################################
+    ndumps = len(meta["katdata"].timestamps)
+    nvis = ndumps * len(meta["baselines"])
+    # Weighted complex (3 floats) per channel and Stokes
+    return nvis * meta["numchan"] * meta["nstokes"] * 12. / 1024.**3
+    # end DataSize
+
+def ResourceBudget(meta, configfile=None, logFile=None):
+    """
+    Work out the thread budgets of the pipeline tasks
+
+    The total is the number of cores, limited by any cgroup CPU quota and
+    to MEM_PER_THREAD MB of available memory per thread. Tasks are given
+    one thread per TASK_SCALING GB of visibility data up to the total.
+    Values in the [RESOURCES] section of the configuration file override
+    the detected and derived ones.
+
+    * meta       = dict from KATH5toAIPS.GetKATMeta
+    * configfile = configuration file, default ~/.katimrc
+    * logFile    = Log file for messages
+    Returns dict with "nThreads" (total), "memory" (MB) and the threads
+    for each task type in TASK_SCALING
+    """
+    ################################################################
+    res = DetectResources()
+    config = ReadResourceConfig(configfile)
+    nThreads = res["cores"]
+    if res["cpuQuota"] is not None:
+        nThreads = min(nThreads, int(math.ceil(res["cpuQuota"])))
+    memory = res["memory"]
+    if 'memory' in config:
+        memory = float(config['memory'])
+    if memory is not None:
+        nThreads = min(nThreads, int(memory // MEM_PER_THREAD))
+    if 'nthreads' in config:
+        nThreads = int(config['nthreads'])
+    nThreads = max(1, nThreads)
+    size = DataSize(meta)
+    budget = {"nThreads":nThreads, "memory":memory}
+    for task in TASK_SCALING:
+        perThread, maxThreads = TASK_SCALING[task]
+        threads = int(math.ceil(size / perThread))
+        if maxThreads:
+            threads = min(threads, maxThreads)
+        threads = min(max(1, threads), nThreads)
+        key = task.lower() + '_threads'
+        if key in config:
+            threads = int(config[key])
+        budget[task] = threads
+    mess = "Resources: %d cores, CPU quota %s, %s MB memory, %.1f GB of data" % \
+        (res["cores"], res["cpuQuota"], "unknown" if memory is None else "%.0f" % memory, size)
+    printMess(mess, logFile)
+    mess = "Threads: total %d, " % nThreads + \
+        ", ".join("%s %d" % (task, budget[task]) for task in TASK_SCALING)
+    printMess(mess, logFile)
+    return budget
+    # end ResourceBudget
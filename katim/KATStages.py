@@ -0,0 +1,326 @@
+""" Resumable pipeline stages
+
+A pipeline is run as a sequence of named stages. When a stage completes
+a marker with its declared outputs (AIPS catalogue entries, table versions
+and files) and the pipeline state is saved in a pickle, so a rerun can
+skip completed stages, resume from a given stage or run only some stages.
+A stage checks that the stages it needs have been completed, and one that
+writes calibration and flag tables undoes those written by an earlier
+attempt at it before it starts again.
+"""
+import os, time
+import AIPSDir, OErr, OSystem, UV, TableList
+from PipeUtil import FetchObject, SaveObject, printMess
+from . import KATTableUtil
+
+# Tables written by the calibration and editing stages
+STAGE_TABLES = ["AIPS CL", "AIPS SN", "AIPS BP", "AIPS FG"]
+
+def InitStages(names, markerFile, err, resumeFrom=None, only=None, logFile=None, check=False):
+    """
+    Initialise the stage bookkeeping of a pipeline run
+
+    * names      = stage names in the order they are run
+    * markerFile = pickle file holding the completion markers
+    * err        = Python Obit Error/message stack
+    * resumeFrom = Run this stage and all that follow it
+    * only       = List of the only stages to run
+    * logFile    = Log file for messages
+    * check      = Only checking script, don't record completed stages
+    Returns stages dict used by RunStage, StageDone and StageState
+    """
+    ################################################################
+    for name in ([resumeFrom] if resumeFrom else []) + list(only or []):
+        if name not in names:
+            raise RuntimeError("Unknown pipeline stage '%s', stages are: %s" % (name, ', '.join(names)))
+    markers = None
+    if os.path.exists(markerFile):
+        markers = FetchObject(markerFile)
+    if markers is None:
+        markers = {}
+    if only:
+        first = len(names)
+    elif resumeFrom:
+        first = names.index(resumeFrom)
+    else:
+        # Skip the stages completed in order whose outputs, as the
+        # outputs of the last of them hold the pipeline state, still exist
+        first = 0
+        while first < len(names) and names[first] in markers:
+            first += 1
+        while first > 0 and not CheckOutputs(markers[names[first-1]]["outputs"], err):
+            first -= 1
+        done = names[:first]
+        if done:
+            mess = "Completed stages from an earlier run: " + ", ".join(done)
+            printMess(mess, logFile)
+    stages = {"names":names, "markerFile":markerFile, "markers":markers,
+              "first":first, "only":only, "logFile":logFile,
+              "err":err, "check":check, "state":{}, "ran":set()}
+    return stages
+    # end InitStages
+
+def RunStage(stages, name, inputs=None):
+    """
+    Should stage name be run?
+
+    With only, run just the listed stages, otherwise the stages from the
+    one to resume from, which by default follows the stages completed by
+    earlier runs. The saved state of a skipped stage is loaded into
+    stages["state"].
+    Raises RuntimeError if the stage is to be run but one of inputs has
+    not been completed or its outputs no longer exist.
+    * stages = dict from InitStages
+    * name   = stage name
+    * inputs = names of the stages whose outputs stage name uses
+    """
+    ################################################################
+    names = stages["names"]
+    marker = stages["markers"].get(name)
+    if stages["only"]:
+        run = name in stages["only"]
+    else:
+        run = names.index(name) >= stages["first"]
+    if run:
+        for need in inputs or []:
+            if need in stages["ran"]:
+                continue
+            if need not in stages["markers"]:
+                raise RuntimeError("Pipeline stage %s needs stage %s, which has not been completed, "
+                                   "run it first" % (name, need))
+            if not CheckOutputs(stages["markers"][need]["outputs"], stages["err"]):
+                raise RuntimeError("Pipeline stage %s needs the outputs of stage %s, which no longer exist, "
+                                   "rerun it" % (name, need))
+        mess = "Running pipeline stage %s" % name
+        printMess(mess, stages["logFile"])
+        # Outputs of this and later stages are about to change
+        if stages["only"]:
+            invalid = [name]
+        else:
+            invalid = names[names.index(name):]
+        for later in invalid:
+            stages["markers"].pop(later, None)
+        # The tables later stages start from are about to change
+        for later in names[names.index(name)+1:]:
+            stages["markers"].get("_tables", {}).pop(later, None)
+        if not stages["check"]:
+            SaveObject(stages["markers"], stages["markerFile"], True)
+        stages["start"] = time.time()
+        return True
+    if marker is None:
+        mess = "Skipping pipeline stage %s which has not been completed" % name
+    else:
+        mess = "Skipping pipeline stage %s completed %s" % (name, marker["time"])
+        stages["state"].update(marker["state"])
+    printMess(mess, stages["logFile"])
+    return False
+    # end RunStage
+
+def StageDone(stages, name, state=None, outputs=None):
+    """
+    Record the completion of stage name
+
+    * stages  = dict from InitStages
+    * name    = stage name
+    * state   = dict of pipeline state needed by later stages
+    * outputs = list of outputs from AIPSOutput, TableOutput or FileOutput
+    """
+    ################################################################
+    if state:
+        stages["state"].update(state)
+    stages["ran"].add(name)
+    if stages["check"]:
+        return
+    stages["markers"][name] = {"time":time.strftime("%Y-%m-%d %H:%M:%S"),
+                               "state":dict(stages["state"]),
+                               "outputs":outputs or []}
+    SaveObject(stages["markers"], stages["markerFile"], True)
+    mess = "Pipeline stage %s done in %.1f s" % (name, time.time() - stages.get("start", time.time()))
+    printMess(mess, stages["logFile"])
+    # end StageDone
+
+def StageState(stages, key, default=None):
+    """
+    Get an item of pipeline state saved by a completed stage
+
+    * stages  = dict from InitStages
+    * key     = state item
+    * default = value if no stage saved key
+    """
+    ################################################################
+    return stages["state"].get(key, default)
+    # end StageState
+
+def RequiredState(stages, key, name):
+    """
+    Get an item of pipeline state that a completed stage must have saved
+
+    Raises RuntimeError if no stage saved key.
+    * stages = dict from InitStages
+    * key    = state item
+    * name   = stage that saves key, for the error message
+    """
+    ################################################################
+    if key not in stages["state"]:
+        raise RuntimeError("Pipeline stage %s has not been completed, run it first" % name)
+    return stages["state"][key]
+    # end RequiredState
+
+def ResetTables(stages, name, uv, err, tables=STAGE_TABLES):
+    """
+    Undo the tables of uv written by an earlier attempt at stage name
+
+    The first time stage name is run the highest version of each of tables
+    and the number of rows of each FG table are saved with the stage
+    markers. When the stage is run again, after it failed or to redo it,
+    later versions are deleted and rows since appended to the FG tables
+    are removed, so it starts again from the same calibration and flags.
+    Later stages are then no longer complete. Running an earlier stage
+    discards what was saved for the later ones.
+    * stages = dict from InitStages
+    * name   = stage name
+    * uv     = Obit AIPS UV object the stage writes tables to
+    * err    = Python Obit Error/message stack
+    * tables = table types to undo
+    """
+    ################################################################
+    if stages["check"]:
+        return
+    logFile = stages["logFile"]
+    # Open and close to sync with disk
+    uv.Open(UV.READONLY, err)
+    uv.Close(err)
+    OErr.printErrMsg(err, "Error opening UV data")
+    data = AIPSOutput(uv)
+    fgVers = [ver for ver, tabType in TableList.PGetList(uv.TableList, err) if tabType == "AIPS FG"]
+    OErr.printErrMsg(err, "Error reading table list")
+    records = stages["markers"].setdefault("_tables", {})
+    record = records.get(name)
+    if record is None or record["data"] != data:
+        highVer = dict((tabType, uv.GetHighVer(tabType)) for tabType in tables)
+        fgRows = {}
+        if "AIPS FG" in tables:
+            for ver in fgVers:
+                fgRows[ver] = KATTableUtil.TableRows(uv, "AIPS FG", ver, err)
+        records[name] = {"data":data, "highVer":highVer, "fgRows":fgRows}
+        SaveObject(stages["markers"], stages["markerFile"], True)
+        return
+    for tabType in tables:
+        ver = uv.GetHighVer(tabType)
+        while ver > record["highVer"][tabType]:
+            mess = "Delete %s table %d from an earlier attempt at stage %s" % (tabType, ver, name)
+            printMess(mess, logFile)
+            uv.ZapTable(tabType, ver, err)
+            ver = ver-1
+    OErr.printErrMsg(err, "Error deleting tables")
+    for ver, nrow in record["fgRows"].items():
+        if ver not in fgVers:
+            mess = "WARNING AIPS FG table %d deleted by an earlier attempt at stage %s cannot be restored" % \
+                (ver, name)
+            printMess(mess, logFile)
+            continue
+        nrem = KATTableUtil.TruncateTable(uv, "AIPS FG", ver, nrow, err)
+        if nrem > 0:
+            mess = "Removed %d flags from AIPS FG table %d written by an earlier attempt at stage %s" % \
+                (nrem, ver, name)
+            printMess(mess, logFile)
+    # Later stages used the tables just undone
+    names = stages["names"]
+    for later in names[names.index(name)+1:]:
+        stages["markers"].pop(later, None)
+    SaveObject(stages["markers"], stages["markerFile"], True)
+    # end ResetTables
+
+def AIPSOutput(uv):
+    """
+    Declare an AIPS catalogue entry as a stage output
+
+    * uv = Obit AIPS UV object, None gives None
+    """
+    ################################################################
+    if uv is None:
+        return None
+    return {"type":"AIPS", "name":uv.Aname, "class":uv.Aclass,
+            "disk":uv.Disk, "seq":uv.Aseq}
+    # end AIPSOutput
+
+def TableOutput(uv, tabType, ver=None):
+    """
+    Declare a table of an AIPS UV data set as a stage output
+
+    * uv      = Obit AIPS UV object
+    * tabType = Table type, e.g. "AIPS FG"
+    * ver     = Table version, default the highest
+    """
+    ################################################################
+    if ver is None:
+        ver = uv.GetHighVer(tabType)
+    out = AIPSOutput(uv)
+    out.update(type="table", table=tabType, ver=ver)
+    return out
+    # end TableOutput
+
+def FileOutput(path):
+    """
+    Declare a file as a stage output
+
+    * path = File name
+    """
+    ################################################################
+    return {"type":"file", "path":os.path.abspath(path)}
+    # end FileOutput
+
+def OpenAIPSOutput(output, err, required=True, name="data"):
+    """
+    Open the AIPS UV data set of an output from AIPSOutput
+
+    * output   = dict from AIPSOutput
+    * err      = Python Obit Error/message stack
+    * required = raise RuntimeError if there is no output, else return None;
+                 declared data that no longer exist always raise
+    * name     = description of the data for the error message
+    """
+    ################################################################
+    if output is None:
+        if required:
+            raise RuntimeError("No %s from an earlier pipeline stage, run the stage making it first" % name)
+        return None
+    if not CheckOutputs([output], err):
+        raise RuntimeError("%s %s.%s.%d on disk %d from an earlier pipeline stage no longer exists, "
+                           "rerun the stage making it" % (name, output["name"], output["class"],
+                                                          output["seq"], output["disk"]))
+    return UV.newPAUV("AIPS UV DATA", output["name"], output["class"],
+                      output["disk"], output["seq"], True, err)
+    # end OpenAIPSOutput
+
+def CheckOutputs(outputs, err):
+    """
+    Do the declared outputs of a stage still exist?
+
+    * outputs = list of outputs from AIPSOutput, TableOutput or FileOutput
+    * err     = Python Obit Error/message stack
+    """
+    ################################################################
+    user = OSystem.PGetAIPSuser()
+    for out in outputs:
+        if out is None:
+            continue
+        if out["type"] == "file":
+            if not os.path.exists(out["path"]):
+                return False
+            continue
+        cno = AIPSDir.PTestCNO(out["disk"], user, out["name"], out["class"], "UV", out["seq"], err)
+        if err.isErr:
+            OErr.PClear(err)
+            return False
+        if cno <= 0:
+            return False
+        if out["type"] == "table":
+            uv = UV.newPAUV("AIPS UV DATA", out["name"], out["class"], out["disk"], out["seq"], True, err)
+            if err.isErr:
+                OErr.PClear(err)
+                return False
+            if uv.GetHighVer(out["table"]) < out["ver"]:
+                return False
+    return True
+    # end CheckOutputs
@@ -0,0 +1,412 @@
+""" Columnar access to Obit tables
+
+Whole tables are read into a dict of numpy arrays, one per column, which
+can be manipulated with array operations and written back to a table.
+Obit tables are only accessible a row at a time so rows are still read
+and written one by one, but through a single open of the table.
+Tables read only for lookups can be served from a cache which holds each
+table version until its AIPS file is modified.
+"""
+#-----------------------------------------------------------------------
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of
+#  the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#-----------------------------------------------------------------------
+import os, threading
+import Table, OErr, OSystem, AIPSDir
+import numpy
+from .AIPSLite import ehex
+
+# Row entries which are not table columns
+ROW_INFO = ('NumFields', 'Table name', '_status')
+
+# Tables read by CachedColumns keyed by AIPS catalogue entry, type and version
+_cache = {}
+_cacheLock = threading.Lock()
+
+def ReadColumns (inUV, tabType, tabVer, err):
+    """
+    Read a whole table into columns
+
+    Numeric columns are (nrow, width) numpy arrays, string columns are
+    lists of nrow lists of strings.
+    Returns (cols, keys, rowInfo) where keys is a dict of the table
+    header keywords and rowInfo holds the non column row entries
+    needed to write rows, or (None, None, None) if there are no rows.
+    * inUV     = Obit UV object
+    * tabType  = table type, e.g. "AIPS AN"
+    * tabVer   = table version
+    * err      = Obit error/message stack
+    """
+    ################################################################
+    inTab = inUV.NewTable(Table.READONLY, tabType, tabVer, err)
+    inTab.Open(Table.READONLY, err)
+    OErr.printErrMsg(err, "Error opening "+tabType+" table")
+    keys = {}
+    for k in inTab.keys:
+        keys[k] = inTab.keys[k]
+    nrow = inTab.Desc.Dict['nrow']
+    rows = [inTab.ReadRow(irow, err) for irow in range(1, nrow+1)]
+    inTab.Close(err)
+    OErr.printErrMsg(err, "Error reading "+tabType+" table")
+    if nrow<1:
+        return None, None, None
+    rowInfo = {}
+    for k in ROW_INFO:
+        if k in rows[0]:
+            rowInfo[k] = rows[0][k]
+    cols = {}
+    for k in rows[0]:
+        if k in ROW_INFO:
+            continue
+        vals = [row[k] for row in rows]
+        if len(vals[0])>0 and isinstance(vals[0][0], str):
+            cols[k] = vals
+        else:
+            cols[k] = numpy.array(vals)
+    return cols, keys, rowInfo
+    # end ReadColumns
+
+def WriteColumns (outUV, tabType, tabVer, cols, keys, rowInfo, err, **kwargs):
+    """
+    Write columns to a new table, replacing any existing version
+
+    Each column is converted to Python lists once then the rows are
+    written through a single table open.
+    * outUV    = Obit UV object
+    * tabType  = table type, e.g. "AIPS AN"
+    * tabVer   = table version
+    * cols     = dict of columns as returned by ReadColumns
+    * keys     = dict of table header keywords to set
+    * rowInfo  = non column row entries as returned by ReadColumns
+    * err      = Obit error/message stack
+    * kwargs   = structural table parameters for NewTable, e.g. numIF
+    """
+    ################################################################
+    outUV.ZapTable(tabType, tabVer, err)
+    outTab = outUV.NewTable(Table.WRITEONLY, tabType, tabVer, err, **kwargs)
+    outTab.Open(Table.WRITEONLY, err)
+    OErr.printErrMsg(err, "Error opening "+tabType+" table")
+    for k in keys:
+        outTab.keys[k] = keys[k]
+    Table.PDirty(outTab)  # Force update
+    names = list(cols.keys())
+    vals  = [c.tolist() if isinstance(c, numpy.ndarray) else c for c in
+             [cols[k] for k in names]]
+    row = dict(rowInfo)
+    nrow = len(vals[0]) if vals else 0
+    for irow in range(nrow):
+        for k, v in zip(names, vals):
+            row[k] = v[irow]
+        outTab.WriteRow(irow+1, row, err)
+    outTab.Close(err)
+    OErr.printErrMsg(err, "Error writing "+tabType+" table")
+    # end WriteColumns
+
+def TileIF (col, nIF):
+    """
+    Repeat the per IF values of a single IF column for nIF IFs
+
+    * col      = (nrow, width) numpy array for one IF
+    * nIF      = number of IFs
+    Returns (nrow, width*nIF) numpy array
+    """
+    ################################################################
+    return numpy.tile(col, (1, nIF))
+    # end TileIF
+
+def UpdateRows (outUV, tabType, tabVer, cols, rowInfo, rows, err, **kwargs):
+    """
+    Rewrite selected rows of an existing table from columns
+
+    Only the listed rows are written, through a single table open.
+    * outUV    = Obit UV object
+    * tabType  = table type, e.g. "AIPS SN"
+    * tabVer   = table version
+    * cols     = dict of columns for all rows as returned by ReadColumns
+    * rowInfo  = non column row entries as returned by ReadColumns
+    * rows     = 0-rel indices of the rows to write
+    * err      = Obit error/message stack
+    * kwargs   = structural table parameters for NewTable, e.g. numIF
+    """
+    ################################################################
+    if len(rows)<1:
+        return
+    outTab = outUV.NewTable(Table.READWRITE, tabType, tabVer, err, **kwargs)
+    outTab.Open(Table.READWRITE, err)
+    OErr.printErrMsg(err, "Error opening "+tabType+" table")
+    names = list(cols.keys())
+    row = dict(rowInfo)
+    for irow in rows:
+        for k in names:
+            v = cols[k][irow]
+            row[k] = v.tolist() if isinstance(v, numpy.ndarray) else v
+        outTab.WriteRow(int(irow)+1, row, err)
+    outTab.Close(err)
+    OErr.printErrMsg(err, "Error writing "+tabType+" table")
+    # end UpdateRows
+
+def TableRows (inUV, tabType, tabVer, err):
+    """
+    Number of rows in a table
+
+    * inUV     = Obit UV object
+    * tabType  = table type, e.g. "AIPS FG"
+    * tabVer   = table version
+    * err      = Obit error/message stack
+    """
+    ################################################################
+    inTab = inUV.NewTable(Table.READONLY, tabType, tabVer, err)
+    inTab.Open(Table.READONLY, err)
+    OErr.printErrMsg(err, "Error opening "+tabType+" table")
+    nrow = inTab.Desc.Dict['nrow']
+    inTab.Close(err)
+    OErr.printErrMsg(err, "Error closing "+tabType+" table")
+    return nrow
+    # end TableRows
+
+def TruncateTable (outUV, tabType, tabVer, nrow, err, **kwargs):
+    """
+    Remove the rows after the first nrow of a table
+
+    The kept rows and the header keywords are rewritten to a new table
+    of the same version.
+    * outUV    = Obit UV object
+    * tabType  = table type, e.g. "AIPS FG"
+    * tabVer   = table version
+    * nrow     = number of rows to keep
+    * err      = Obit error/message stack
+    * kwargs   = structural table parameters for NewTable, e.g. numIF
+    Returns the number of rows removed
+    """
+    ################################################################
+    inTab = outUV.NewTable(Table.READONLY, tabType, tabVer, err, **kwargs)
+    inTab.Open(Table.READONLY, err)
+    OErr.printErrMsg(err, "Error opening "+tabType+" table")
+    oldrow = inTab.Desc.Dict['nrow']
+    keys = {}
+    for k in inTab.keys:
+        keys[k] = inTab.keys[k]
+    rows = [inTab.ReadRow(irow, err) for irow in range(1, min(nrow, oldrow)+1)]
+    inTab.Close(err)
+    OErr.printErrMsg(err, "Error reading "+tabType+" table")
+    if oldrow<=nrow:
+        return 0
+    outUV.ZapTable(tabType, tabVer, err)
+    outTab = outUV.NewTable(Table.WRITEONLY, tabType, tabVer, err, **kwargs)
+    outTab.Open(Table.WRITEONLY, err)
+    OErr.printErrMsg(err, "Error opening "+tabType+" table")
+    for k in keys:
+        outTab.keys[k] = keys[k]
+    Table.PDirty(outTab)  # Force update
+    for irow, row in enumerate(rows):
+        outTab.WriteRow(irow+1, row, err)
+    outTab.Close(err)
+    OErr.printErrMsg(err, "Error writing "+tabType+" table")
+    return oldrow - nrow
+    # end TruncateTable
+
+def MergeFlags (flags, tol=1.0e-6):
+    """
+    Merge flag entries which overlap or abut in time, then in IF
+
+    Entries are merged when all their other fields are the same.
+    * flags    = dict of (nflag, 2) arrays "ants", "times" (days), "ifs"
+                 and "chans" and (nflag,) array "pflags"
+    * tol      = gap in days still treated as abutting
+    Returns dict of the merged flags
+    """
+    ################################################################
+    nflag = flags["ants"].shape[0]
+    if nflag < 2:
+        return flags
+    out = dict((k, numpy.array(v)) for k, v in flags.items())
+    for axis, other in (("times", "ifs"), ("ifs", "times")):
+        # Sort by the fields to match, then the start of the range to merge
+        fields = [out["pflags"]] + [out[k][:, i] for k in ("ants", "chans", other) for i in (1, 0)]
+        order = numpy.lexsort([out[axis][:, 0]] + fields)
+        keys = numpy.stack(fields, axis=1)[order]
+        rng = out[axis][order]
+        # Gap allowed between merged ranges, IFs abut if consecutive
+        gap = tol if axis == "times" else 1
+        keep = [0]
+        for i in range(1, len(order)):
+            last = keep[-1]
+            if (keys[i] == keys[last]).all() and rng[i, 0] <= rng[last, 1] + gap:
+                rng[last, 1] = max(rng[last, 1], rng[i, 1])
+            else:
+                keep.append(i)
+        out = dict((k, v[order][keep]) for k, v in out.items())
+        out[axis] = rng[keep]
+    return out
+    # end MergeFlags
+
+def AppendFlags (outUV, flags, err, flagVer=1, reason='Flag'):
+    """
+    Append flag entries to an FG table in a single table open
+
+    Rows are written in time order after any already in the table.
+    * outUV    = Obit UV object
+    * flags    = dict of (nflag, 2) arrays "ants" (AIPS antenna numbers),
+                 "times" (start, end in days) and "chans" (1-rel, 0=all),
+                 optionally "ifs" (1-rel, default all) and (nflag,) array
+                 "pflags" (Stokes flag bits, default all)
+    * err      = Obit error/message stack
+    * flagVer  = FG table version
+    * reason   = Reason string for the flags
+    Returns the number of rows written
+    """
+    ################################################################
+    nflag = flags["ants"].shape[0]
+    if nflag == 0:
+        return 0
+    fgtab = outUV.NewTable(Table.READWRITE, "AIPS FG", flagVer, err)
+    fgtab.Open(Table.READWRITE, err)
+    OErr.printErrMsg(err, "Error opening FG table")
+    row = {'SOURCE': [0], 'SUBARRAY': [0], 'FREQ ID': [-1], 'ANTS': [0, 0], \
+           'TIME RANGE': [0.0, 0.0], 'IFS': [1, 1], 'CHANS': [0, 0], 'PFLAGS': [15], \
+           'REASON': [reason[:24].ljust(24)], 'NumFields': 10, 'Table name': 'AIPS FG', \
+           '_status': [0]}
+    irow = fgtab.Desc.Dict['nrow']
+    order = numpy.argsort(flags["times"][:, 0], kind='stable')
+    ants   = flags["ants"][order].tolist()
+    times  = flags["times"][order].tolist()
+    chans  = flags["chans"][order].tolist()
+    ifs    = flags["ifs"][order].tolist() if "ifs" in flags else None
+    pflags = flags["pflags"][order].tolist() if "pflags" in flags else None
+    for iflag in range(nflag):
+        irow += 1
+        row['ANTS']       = ants[iflag]
+        row['TIME RANGE'] = times[iflag]
+        row['CHANS']      = chans[iflag]
+        if ifs is not None:
+            row['IFS']    = ifs[iflag]
+        if pflags is not None:
+            row['PFLAGS'] = [pflags[iflag]]
+        fgtab.WriteRow(irow, row, err)
+    OErr.printErrMsg(err, "Error writing FG table")
+    fgtab.Close(err)
+    OErr.printErrMsg(err, "Error closing FG table")
+    return nflag
+    # end AppendFlags
+
+def CachedColumns (inData, tabType, tabVer, err):
+    """
+    Read a whole table into columns, sharing one read between callers
+
+    The columns are cached for the AIPS catalogue entry, table type and
+    version until the table file is modified; a new version written by a
+    task is a new cache entry. Tables not in AIPS files are not cached.
+    The columns are shared so must not be modified, use ReadColumns to
+    change a table.
+    Returns (cols, keys, rowInfo) as ReadColumns
+    * inData   = Obit UV or Image object
+    * tabType  = table type, e.g. "AIPS SU"
+    * tabVer   = table version, 0 => highest
+    * err      = Obit error/message stack
+    """
+    ################################################################
+    entry = _cacheEntry(inData, tabType, tabVer, err)
+    return entry["cols"], entry["keys"], entry["rowInfo"]
+    # end CachedColumns
+
+def SourceIndex (inUV, err, SUver=1):
+    """
+    Index of the rows of an SU table by source name
+
+    Returns dict of source name (trailing blanks removed) to 0-rel row
+    of the columns from CachedColumns(inUV, "AIPS SU", SUver, err)
+    * inUV     = Obit UV object
+    * err      = Obit error/message stack
+    * SUver    = SU table version
+    """
+    ################################################################
+    entry = _cacheEntry(inUV, "AIPS SU", SUver, err)
+    if "sourceIndex" not in entry["derived"]:
+        index = {}
+        if entry["cols"] is not None:
+            for irow, name in enumerate(entry["cols"]["SOURCE"]):
+                index.setdefault(name[0].rstrip(), irow)
+        entry["derived"]["sourceIndex"] = index
+    return entry["derived"]["sourceIndex"]
+    # end SourceIndex
+
+def NXSummary (inUV, err, NXver=1):
+    """
+    Number of visibilities and total time per source from an NX table
+
+    Returns dict of source ID to (number of visibilities, time in days)
+    * inUV     = Obit UV object
+    * err      = Obit error/message stack
+    * NXver    = NX table version
+    """
+    ################################################################
+    entry = _cacheEntry(inUV, "AIPS NX", NXver, err)
+    if "nxSummary" not in entry["derived"]:
+        summary = {}
+        cols = entry["cols"]
+        if cols is not None:
+            ids, inv = numpy.unique(cols["SOURCE ID"][:, 0], return_inverse=True)
+            nvis  = numpy.bincount(inv, cols["END VIS"][:, 0] - cols["START VIS"][:, 0] + 1)
+            tsum  = numpy.bincount(inv, cols["TIME INTERVAL"][:, 0])
+            for i, sid in enumerate(ids.tolist()):
+                summary[sid] = (int(nvis[i]), float(tsum[i]))
+        entry["derived"]["nxSummary"] = summary
+    return entry["derived"]["nxSummary"]
+    # end NXSummary
+
+def ClearCache ():
+    """
+    Drop all tables held by CachedColumns
+    """
+    ################################################################
+    with _cacheLock:
+        _cache.clear()
+    # end ClearCache
+
+def _cacheEntry (inData, tabType, tabVer, err):
+    """ Cache entry of a table, read if not cached or modified """
+    if tabVer <= 0:
+        tabVer = inData.GetHighVer(tabType)
+    path = _tableFile(inData, tabType, tabVer)
+    if path is None:
+        return _readEntry(inData, tabType, tabVer, err)
+    key = (inData.Disk, inData.Acno, OSystem.PGetAIPSuser(), tabType, tabVer)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _cacheLock:
+        entry = _cache.get(key)
+        if entry is None or entry["stamp"] != stamp:
+            entry = _readEntry(inData, tabType, tabVer, err)
+            entry["stamp"] = stamp
+            _cache[key] = entry
+    return entry
+    # end _cacheEntry
+
+def _readEntry (inData, tabType, tabVer, err):
+    """ Cache entry read from the table """
+    cols, keys, rowInfo = ReadColumns(inData, tabType, tabVer, err)
+    return {"cols":cols, "keys":keys, "rowInfo":rowInfo, "derived":{}}
+    # end _readEntry
+
+def _tableFile (inData, tabType, tabVer):
+    """ AIPS file of a table, None if not an existing AIPS table """
+    if getattr(inData, "FileType", None) != "AIPS" or getattr(inData, "Acno", 0) <= 0:
+        return None
+    disks = AIPSDir.AIPSdisks
+    if inData.Disk < 1 or inData.Disk > len(disks) or not disks[inData.Disk-1]:
+        return None
+    # AIPS file names are type, format, catalogue number, version and user
+    name = "%2sD%3s%3s.%3s;" % (tabType[-2:], ehex(inData.Acno, 3), ehex(tabVer, 3), \
+                                ehex(OSystem.PGetAIPSuser(), 3))
+    path = os.path.join(disks[inData.Disk-1], name)
+    if not os.path.isfile(path):
+        return None
+    return path
+    # end _tableFile
@@ -1,6 +1,5 @@
 import sys, pydoc
-import OErr, OSystem, UV, AIPS, FITS, OTObit
-import ObitTalkUtil
+import OErr, OSystem, UV, AIPS, FITS
 from AIPS import AIPSDisk
 from FITS import FITSDisk
 from PipeUtil import *
@@ -15,8 +14,9 @@ import subprocess
 from . import KATH5toAIPS
 import os
 from . import AIPSSetup
+from . import KATResources
+from . import KATExport
 import shutil
-import numpy as np
 from .KATImExceptions import KATUnimageableError
 
 #possible kwargs: scratchdir
@@ -71,12 +71,10 @@ def MKContPipeline(files, outputdir, **kwargs):
     AIPS_ROOT    = os.environ['AIPS_ROOT']
     AIPS_VERSION = os.environ['AIPS_VERSION']
 
-    nThreads = 72
     user = OSystem.PGetAIPSuser()
     AIPS.userno = user
     disk = 1
     fitsdisk = 0
-    nam = os.path.basename(os.path.splitext(files[0])[0])[0:10]
     cls = "Raw"
     seq = 1
 
@@ -141,16 +139,11 @@ def MKContPipeline(files, outputdir, **kwargs):
         # TODO: Check if the input data has been Hanned.
         doneHann = True
     else:
-        # Number of baselines gives batch size
-        nbl = len(np.unique([(cp[0][:-1] + cp[1][:-1]).upper() for cp in katdata.corr_products]))
-        # Construct a template uvfits file from master template
-        mastertemplate = ObitTalkUtil.FITSDir.FITSdisks[fitsdisk] + 'MKATTemplate.uvtab.gz'
-        outtemplate = nam + '.uvtemp'
-        KATH5toAIPS.MakeTemplate(mastertemplate,outtemplate,len(katdata.channel_freqs),nvispio=nbl)
-        uv = OTObit.uvlod(outtemplate, 0, EVLAAIPSName(project), cls, disk, seq, err)
+        # Create the AIPS uv data with the geometry of katdata
+        uv = KATH5toAIPS.CreateKATUV(katdata, EVLAAIPSName(project), cls, disk, seq, err, \
+                                     loadhalf=kwargs.get('loadhalf',False), chanav=kwargs.get('chanav',1))
         obsdata = KATH5toAIPS.KAT2AIPS(katdata, uv, disk, fitsdisk, err, calInt=katdata.dump_period, **kwargs)
         MakeIFs.UVMakeIF(uv,8,err)
-        os.remove(outtemplate)
     # Print the uv data header to screen.
     uv.Header(err)
     ############################# Set Project Processing parameters ###################################
@@ -163,6 +156,9 @@ def MKContPipeline(files, outputdir, **kwargs):
     # Load the outputs pickle jar
     EVLAFetchOutFiles()
 
+    # Thread budgets from the cores, memory and data size
+    resources = KATResources.ResourceBudget(obsdata, configfile=kwargs.get('configFile'), logFile=logFile)
+    nThreads = resources["nThreads"]
     OSystem.PAllowThreads(nThreads)   # Allow threads in Obit/oython
     retCode = 0
 
@@ -246,7 +242,7 @@ def MKContPipeline(files, outputdir, **kwargs):
     if parms["doMednTD1"]:
         mess =  "Median window time editing, for RFI impulsive in time:"
         printMess(mess, logFile)
-        retCode = EVLAMedianFlag (uv, clist, err, noScrat=noScrat, nThreads=nThreads, \
+        retCode = EVLAMedianFlag (uv, clist, err, noScrat=noScrat, nThreads=resources["AutoFlag"], \
                                   avgTime=parms["mednAvgTime"], avgFreq=parms["mednAvgFreq"],  chAvg= parms["mednChAvg"], \
                                   timeWind=parms["mednTimeWind"],flagVer=2, flagTab=2,flagSig=parms["mednSigma"], \
                                   logfile=logFile, check=check, debug=False)
@@ -262,7 +258,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                 doFD=True, FDmaxAmp=1.0e20, FDmaxV=1.0e20, FDwidMW=parms["FD1widMW"],  \
                                 FDmaxRMS=[1.0e20,0.1], FDmaxRes=parms["FD1maxRes"],  \
                                 FDmaxResBL= parms["FD1maxRes"],  FDbaseSel=parms["FD1baseSel"],\
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
            raise  RuntimeError("Error in AutoFlag")
     
@@ -284,7 +280,7 @@ def MKContPipeline(files, outputdir, **kwargs):
         mess = "Find best reference antenna: run Calib on BP Cal(s) "
         printMess(mess, logFile)
         parms["refAnt"] = EVLAGetRefAnt(uv, parms["BPCals"], err, flagVer=0, \
-                                        solInt=parms["bpsolint1"], nThreads=nThreads, \
+                                        solInt=parms["bpsolint1"], nThreads=resources["Calib"], \
                                         logfile=logFile, check=check, debug=debug)
         if err.isErr:
                 raise  RuntimeError("Error finding reference antenna")
@@ -323,7 +319,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], 
                                doZeroPhs=parms["delayZeroPhs"], \
                                doPlot=parms["doSNPlot"], plotFile=plotFile, \
-                               nThreads=nThreads, noScrat=noScrat, \
+                               nThreads=resources["Calib"], noScrat=noScrat, \
                                logfile=logFile, check=check, debug=debug)
         if retCode!=0:
             raise RuntimeError("Error in delay calibration")
@@ -337,7 +333,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                    check=check, debug=debug, logfile=logFile )
             if retCode!=0:
                 raise  RuntimeError("Error in Plotting spectrum")
-	print(parms["bpBChan1"],parms["bpEChan1"],parms["bpBChan2"],parms["bpEChan2"],parms["bpChWid2"])
+        print(parms["bpBChan1"],parms["bpEChan1"],parms["bpBChan2"],parms["bpEChan2"],parms["bpChWid2"])
     # Bandpass calibration
     if parms["doBPCal"] and parms["BPCals"]:
         retCode = KATBPCal(uv, parms["BPCals"], err, noScrat=noScrat, solInt1=parms["bpsolint1"], \
@@ -346,7 +342,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                             BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
                             doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
                             UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
-                            nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                            nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
             raise RuntimeError("Error in Bandpass calibration")
 
@@ -369,7 +365,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                              doAmpEdit=parms["doAmpEdit"], ampSigma=parms["ampSigma"], \
                              ampEditFG=parms["ampEditFG"], \
                              doPlot=parms["doSNPlot"], plotFile=plotFile,  refAnt=parms["refAnt"], \
-                             nThreads=nThreads, noScrat=noScrat, logfile=logFile, check=check, debug=debug)
+                             nThreads=resources["Calib"], noScrat=noScrat, logfile=logFile, check=check, debug=debug)
         #print parms["ACals"],parms["PCals"]
         if retCode!=0:
             raise RuntimeError("Error calibrating")
@@ -402,7 +398,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                 FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
                                 FDmaxRes=parms["FDmaxRes"],  FDmaxResBL=parms["FDmaxResBL"], \
                                 FDbaseSel=parms["FDbaseSel"], \
-                                nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
            raise  RuntimeError("Error in AutoFlag")
 
@@ -437,7 +433,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                    refAnts=[parms["refAnt"]], doTwo=parms["doTwo"], \
                                    doZeroPhs=parms["delayZeroPhs"], \
                                    doPlot=parms["doSNPlot"], plotFile=plotFile, \
-                                   nThreads=nThreads, noScrat=noScrat, \
+                                   nThreads=resources["Calib"], noScrat=noScrat, \
                                    logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in delay calibration")
@@ -459,7 +455,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                             BChan2=parms["bpBChan2"], EChan2=parms["bpEChan2"], ChWid2=parms["bpChWid2"], \
                             doCenter1=parms["bpDoCenter1"], refAnt=parms["refAnt"], \
                             UVRange=parms["bpUVRange"], doCalib=2, gainUse=0, flagVer=0, doPlot=False, \
-                            nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                            nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error in Bandpass calibration")
         
@@ -482,7 +478,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                  doAmpEdit=True, ampSigma=parms["ampSigma"], \
                                  ampEditFG=parms["ampEditFG"], \
                                  doPlot=parms["doSNPlot"], plotFile=plotFile, refAnt=parms["refAnt"], \
-                                 noScrat=noScrat, nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                 noScrat=noScrat, nThreads=resources["Calib"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise RuntimeError("Error calibrating")
 
@@ -498,7 +494,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                                     FDwidMW=parms["FDwidMW"], FDmaxRMS=parms["FDmaxRMS"], \
                                     FDmaxRes=parms["FDmaxRes"],  FDmaxResBL= parms["FDmaxResBL"], \
                                     FDbaseSel=parms["FDbaseSel"], \
-                                    nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                                    nThreads=resources["AutoFlag"], logfile=logFile, check=check, debug=debug)
             if retCode!=0:
                 raise  RuntimeError("Error in AutoFlag")
     # end recal
@@ -515,7 +511,7 @@ def MKContPipeline(files, outputdir, **kwargs):
                               avgFreq=parms["avgFreq"], chAvg=parms["chAvg"], Stokes=parms["avgStokes"], \
                               BChan=1, EChan=parms["selChan"] - 1, doAuto=parms["doAuto"], \
                               BIF=parms["CABIF"], EIF=parms["CAEIF"], Compress=parms["Compress"], \
-                              nThreads=nThreads, logfile=logFile, check=check, debug=debug)
+                              nThreads=resources["Splat"], logfile=logFile, check=check, debug=debug)
         if retCode!=0:
            raise  RuntimeError("Error in CalAvg")
     elif parms["doCalAvg"] == 'BL':
@@ -554,11 +550,10 @@ def MKContPipeline(files, outputdir, **kwargs):
 
     # KATUVFITS(uv, 'preimage.uvfits', 0, err, exclude=["AIPS HI", "AIPS SL", "AIPS PL"], 
     # include=["AIPS AN", "AIPS FQ"], compress=parms["Compress"], logfile=logFile)
-    KATUVFITab(uv, project+'.uvtab', 0, err)
-    #Gzip the data?
-    if kwargs.get('gzip'):
-        os.system('pigz -p %d %s'%(nThreads, project+'.uvtab'))
-        os.system('rm -f %s'%(project+'.uvtab'))
+    # Compress the data?
+    compress = 'zstd' if kwargs.get('zstd') else 'gzip' if kwargs.get('gzip') else None
+    KATExport.ExportUV(uv, [("fitab", project+'.uvtab')], err, compress=compress,
+                       nThreads=nThreads, logfile=logFile)
 
 class DataProductError(Exception):
     """ Exception for data product (output file) errors. """
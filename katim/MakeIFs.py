@@ -29,9 +29,12 @@
 #-----------------------------------------------------------------------
 import UV, Table, OErr
 import numpy      
-from numpy import numarray
+from . import KATTableUtil
 
-def UVAddIF (inUV, outUV, nIF, err):
+# Default upper limit (MB) on the size of the CopyData I/O buffer
+COPY_MAXMEM = 256.
+
+def UVAddIF (inUV, outUV, nIF, err, maxMem=COPY_MAXMEM):
     """ 
     Create outUV like inUV but divided into nIF IFs
     
@@ -42,6 +45,7 @@ def UVAddIF (inUV, outUV, nIF, err):
     * nIF         = number of desired output IFs
                     MUST be the same number of channels per IF
     * err         = Obit error/message stack
+    * maxMem      = upper limit (MB) on the size of the data copy buffer
     """
     ################################################################
     # Checks
@@ -72,14 +76,14 @@ def UVAddIF (inUV, outUV, nIF, err):
     # Convert SU Table
     UpdateSU (inUV, outUV, nIF, err)
     # Copy data
-    CopyData (inUV, outUV, err)
+    CopyData (inUV, outUV, err, maxMem=maxMem)
     # Update
     outUV.UpdateDesc(err)
     OErr.printErrMsg(err,"Error updating output")
     print("Any CL tables need to be regenerated")
     # end UVAddIF 
     
-def UVMakeIF (outUV, nIF, err, solInt=10.):
+def UVMakeIF (outUV, nIF, err, solInt=10., inPlace=True):
     """ 
     Change number of IFs from 1 to nIF
     
@@ -90,6 +94,8 @@ def UVMakeIF (outUV, nIF, err, solInt=10.):
                     MUST be the same number of channels per IF
     * err         = Obit error/message stack
     * solInt      = Solution interval for remade CL table.
+    * inPlace     = Rewrite version 1 of the FQ, AN and SU tables directly
+                    rather than through a version 2 copy
     """
     ################################################################
     # Checks
@@ -111,12 +117,22 @@ def UVMakeIF (outUV, nIF, err, solInt=10.):
 
     # Patch UV Descriptor
     DescMakeIF (outUV, nIF, err)
-    # Convert FQ Table
-    UpdateFQ2 (outUV, nIF, err)
-    # Convert AN Table
-    maxant = UpdateAN2 (outUV, nIF, err)
-    # Convert SU Table
-    UpdateSU2 (outUV, nIF, err)
+    if inPlace:
+        # Convert FQ Table
+        UpdateFQInPlace (outUV, nIF, err)
+        # Convert AN Table
+        maxant = UpdateANInPlace (outUV, nIF, err)
+        # Convert SU Table
+        UpdateSUInPlace (outUV, nIF, err)
+    else:
+        # Convert FQ Table
+        UpdateFQ2 (outUV, nIF, err)
+        # Convert AN Table
+        maxant = UpdateAN2 (outUV, nIF, err)
+        # Convert SU Table
+        UpdateSU2 (outUV, nIF, err)
+    # Convert FG Table
+    UpdateFG2 (outUV, nIF, err)
     # Regenerate CL table 1 - delete any old
     outUV.ZapTable("AIPS CL",-1,err)
     print('(Re) generate CL table')
@@ -189,19 +205,24 @@ def UpdateSU (inUV, outUV, nIF, err):
     OErr.printErrMsg(err,"Error converting SU Table")
     # end UpdateSU 
     
-def CopyData (inUV, outUV, err):
+def CopyData (inUV, outUV, err, firstVis=1, maxMem=COPY_MAXMEM, nVisPIO=None):
     """ 
     Copy the raw visibility records from inUV to outUV
     
+    Records are copied a block at a time through numpy views of the
+    I/O buffers.
     * inUV        = input Obit UV object
     * outUV       = output Obit UV object, defined but not instantiated
     * err         = Obit error/message stack
+    * firstVis    = visibility number in outUV of the first record copied
+    * maxMem      = upper limit (MB) on the size of the I/O buffer
+    * nVisPIO     = number of visibilities per read/write, overrides maxMem
+    Returns the visibility number following the last one written
     """
     ################################################################
     # Checks, sizes should be the same
     id = inUV.Desc.Dict
     od = outUV.Desc.Dict
-    odd = UV.PGetIODesc(outUV)
     if id['nrparm'] != od['nrparm']:
         raise RuntimeError("Input and output have different numbers of random parameters: " \
               +str(id['nrparm'])+" != "+str(od['nrparm']))
@@ -211,10 +232,15 @@ def CopyData (inUV, outUV, err):
 
     nvis = inUV.Desc.Dict['nvis']                     # Number of records
     lrec = id['nrparm'] + id['ncorr']*id["inaxes"][0]  # Size of record in floats
+    if nvis<1:
+        return firstVis
 
-    # Set data to read one vis per IO
-    inUV.List.set("nVisPIO", 1)
-    outUV.List.set("nVisPIO", 1)
+    # Set data to read a block of vis per IO
+    if nVisPIO is None:
+        nVisPIO = int(maxMem*1024.*1024./(4*lrec))
+    nVisPIO = max(1, min(nvis, nVisPIO))
+    inUV.List.set("nVisPIO", nVisPIO)
+    outUV.List.set("nVisPIO", nVisPIO)
     
     # Open files
     zz = inUV.Open(UV.READONLY, err)
@@ -222,31 +248,37 @@ def CopyData (inUV, outUV, err):
     if err.isErr:
         OErr.printErrMsg(err, "Error opening UV")
     # Get IO buffers as numpy arrays
-    shape = len(inUV.VisBuf) / 4
-    ibuffer =  numarray.array(sequence=inUV.VisBuf,
-                             type=numarray.Float32, shape=shape)
-    obuffer =  numarray.array(sequence=outUV.VisBuf,
-                             type=numarray.Float32, shape=shape)
-    od['numVisBuff'] = 1; # Gotta tell it to write 1 vis
-    outUV.Desc.Dict   = od
-    outUV.IODesc.Dict = od
+    ibuffer = numpy.frombuffer(inUV.VisBuf, dtype=numpy.float32)
+    obuffer = numpy.frombuffer(outUV.VisBuf, dtype=numpy.float32)
 
-    # Loop over data, copying 1 vis at a time
-    for ivis in range(1,nvis+1):
+    # Loop over data, copying a block at a time
+    visno = firstVis
+    lastVisBuff = None
+    for ivis in range(1,nvis+1,nVisPIO):
+        nread = min(nVisPIO, nvis-ivis+1)
         inUV.Read(err, firstVis=ivis)   # Read input
         if err.isErr:
             OErr.printErrMsg(err, "Error reading data")
-        # Copy record
-        obuffer[0:lrec] = ibuffer[0:lrec]
-        outUV.Desc.Dict = od
-        outUV.Write(err, firstVis=ivis)   # Write output
+        # Copy records
+        obuffer[0:nread*lrec] = ibuffer[0:nread*lrec]
+        if nread != lastVisBuff:
+            # Gotta tell it how many vis to write
+            for desc in (outUV.Desc, outUV.IODesc):
+                d = desc.Dict
+                d['numVisBuff'] = nread
+                desc.Dict = d
+            lastVisBuff = nread
+        outUV.Write(err, firstVis=visno)   # Write output
         if err.isErr:
             OErr.printErrMsg(err, "Error writing data")
+        visno += nread
         # end loop over data
     inUV.Close(err)
     outUV.Close(err)
     if err.isErr:
         OErr.printErrMsg(err, "Error closing data")
+    return visno
+    # end CopyData
  
 def DescAddIF (inUV, outUV, nIF, err):
     """ 
@@ -275,7 +307,7 @@ def DescAddIF (inUV, outUV, nIF, err):
         d['crota'][jlocif] = 0.0
         
     jlocf = d["jlocf"]
-    nchan = d["inaxes"][jlocf]/nIF
+    nchan = d["inaxes"][jlocf]//nIF
     d["inaxes"][jlocif] = nIF
     d["inaxes"][jlocf]  = nchan
     outUV.Desc.Dict = d
@@ -426,7 +458,7 @@ def DescMakeIF (outUV, nIF, err):
         d['crota'][jlocif] = 0.0
         
     jlocf = d["jlocf"]
-    nchan = d["inaxes"][jlocf]/nIF
+    nchan = d["inaxes"][jlocf]//nIF
     d["inaxes"][jlocif] = nIF
     d["inaxes"][jlocf]  = nchan
     outUV.Desc.Dict = d
@@ -635,3 +667,139 @@ def UpdateSU2 (outUV, nIF, err):
     OErr.printErrMsg(err,"Error converting SU Table")
     # end UpdateSU2
     
+    
+def UpdateFQInPlace (outUV, nIF, err):
+    """ 
+    Convert FQ table 1 in outUV to nIF IFs without a version 2 copy
+    
+    * outUV       = output Obit UV object, descriptor already converted
+    * nIF         = number of desired output IFs
+                    MUST be the same number of channels per IF
+    * err         = Obit error/message stack
+    """
+    ################################################################
+    cols, keys, rowInfo = KATTableUtil.ReadColumns(outUV, "AIPS FQ", 1, err)
+    # Input info
+    d = outUV.Desc.Dict
+    jlocf = d["jlocf"]
+    delfreq = d["cdelt"][jlocf]
+    freqpix = d["crpix"][jlocf]
+    nchan   = d["inaxes"][jlocf]
+    # IF offsets from reference frequency
+    iIF = numpy.arange(1, nIF+1)
+    cols['IF FREQ']         = numpy.tile((iIF-freqpix)*delfreq*nchan, (cols['IF FREQ'].shape[0], 1))
+    cols['CH WIDTH']        = KATTableUtil.TileIF(cols['CH WIDTH'], nIF)
+    cols['TOTAL BANDWIDTH'] = KATTableUtil.TileIF(cols['TOTAL BANDWIDTH'], nIF) / nIF
+    cols['SIDEBAND']        = KATTableUtil.TileIF(cols['SIDEBAND'], nIF)
+    cols['RXCODE']          = [[rxc[0]*nIF] for rxc in cols['RXCODE']]
+    keys.pop('NO_IF', None)  # Structural
+    KATTableUtil.WriteColumns(outUV, "AIPS FQ", 1, cols, keys, rowInfo, err, numIF=nIF)
+    # Update
+    outUV.UpdateDesc(err)
+    OErr.printErrMsg(err,"Error converting FQ Table")
+    # end UpdateFQInPlace
+    
+def UpdateANInPlace (outUV, nIF, err):
+    """ 
+    Convert AN table 1 in outUV to nIF IFs without a version 2 copy
+    
+    * outUV       = output Obit UV object
+    * nIF         = number of desired output IFs
+    * err         = Obit error/message stack
+    Returns the highest antenna number
+    """
+    ################################################################
+    cols, keys, rowInfo = KATTableUtil.ReadColumns(outUV, "AIPS AN", 1, err)
+    maxant = int(cols['NOSTA'].max())
+    numPCal = cols['POLCALA'].shape[1]
+    for col in ('BEAMFWHM', 'POLCALA', 'POLCALB'):
+        cols[col] = KATTableUtil.TileIF(cols[col], nIF)
+    KATTableUtil.WriteColumns(outUV, "AIPS AN", 1, cols, keys, rowInfo, err,
+                              numIF=nIF, numPCal=numPCal, numOrb=cols['ORBPARM'].shape[1])
+    # Update
+    outUV.UpdateDesc(err)
+    OErr.printErrMsg(err,"Error converting AN Table")
+    return maxant
+    # end UpdateANInPlace
+    
+def UpdateSUInPlace (outUV, nIF, err):
+    """ 
+    Convert SU table 1 in outUV to nIF IFs without a version 2 copy
+    
+    * outUV       = output Obit UV object
+    * nIF         = number of desired output IFs
+    * err         = Obit error/message stack
+    """
+    ################################################################
+    # Is there an SU table?
+    if outUV.GetHighVer("AIPS SU")<1:
+        return
+    cols, keys, rowInfo = KATTableUtil.ReadColumns(outUV, "AIPS SU", 1, err)
+    if cols is None:
+        return
+    for col in ('IFLUX', 'QFLUX', 'UFLUX', 'VFLUX', 'FREQOFF', 'LSRVEL', 'RESTFREQ'):
+        cols[col] = KATTableUtil.TileIF(cols[col], nIF)
+    KATTableUtil.WriteColumns(outUV, "AIPS SU", 1, cols, keys, rowInfo, err, numIF=nIF)
+    # Update
+    outUV.UpdateDesc(err)
+    OErr.printErrMsg(err,"Error converting SU Table")
+    # end UpdateSUInPlace
+    
+def UpdateFG2 (outUV, nIF, err):
+    """ 
+    Convert FG table 1 in outUV to nIF IFs
+
+    Channel ranges of the single input IF are split into a row for
+    each output IF they cover.
+    * outUV       = output Obit UV object, descriptor already converted
+    * nIF         = number of desired output IFs
+    * err         = Obit error/message stack
+    """
+    ################################################################
+    # Is there an FG table?
+    if outUV.GetHighVer("AIPS FG")<1:
+        return
+    d = outUV.Desc.Dict
+    nchan = d["inaxes"][d["jlocf"]]   # Channels per output IF
+    iFGTab = outUV.NewTable(Table.READONLY, "AIPS FG",1,err)
+    oFGTab = outUV.NewTable(Table.WRITEONLY, "AIPS FG",2,err)
+
+    iFGTab.Open(Table.READONLY, err)
+    oFGTab.Open(Table.WRITEONLY, err)
+    nrow = iFGTab.Desc.Dict['nrow']  # How many rows?
+    orow = 0
+    for irow in range(1,nrow+1):
+        row = iFGTab.ReadRow(irow,err)  # Read input row
+        bchan = row['CHANS'][0]
+        echan = row['CHANS'][1]
+        if bchan<=0 and echan<=0:
+            # All channels in all IFs
+            row['IFS'] = [1, nIF]
+            orow += 1
+            oFGTab.WriteRow(orow,row,err)
+            continue
+        if bchan<=0:
+            bchan = 1
+        if echan<=0:
+            echan = nchan*nIF
+        # Split over IFs
+        for iIF in range((bchan-1)//nchan, (echan-1)//nchan+1):
+            row['IFS']   = [iIF+1, iIF+1]
+            row['CHANS'] = [max(bchan-iIF*nchan, 1), min(echan-iIF*nchan, nchan)]
+            orow += 1
+            oFGTab.WriteRow(orow,row,err)
+        # end loop over rows
+    iFGTab.Close(err)
+    oFGTab.Close(err)
+    # zap FG old
+    outUV.ZapTable("AIPS FG",1,err)
+    # Copy
+    iFGTab = outUV.NewTable(Table.READONLY, "AIPS FG",2,err)
+    oFGTab = outUV.NewTable(Table.WRITEONLY, "AIPS FG",1,err)
+    Table.PCopy(iFGTab, oFGTab, err)
+    # zap FG old
+    outUV.ZapTable("AIPS FG",2,err)
+    # Update
+    outUV.UpdateDesc(err)
+    OErr.printErrMsg(err,"Error converting FG Table")
+    # end UpdateFG2
@@ -12,12 +12,15 @@ parser.add_option("--scratchdir", help="Specify the scratch directory.")
 parser.add_option("--targets", help="List of targets to load (You'll need calibrators in this list!!).")
 parser.add_option("--config", dest='configFile', help="Location of .katimrc configuration file.")
 parser.add_option("--timeav", default=1, type='int', help="Number of dumps to average when making uvfits file")
+parser.add_option("--chanav", default=1, type='int', help="Number of channels to average when making uvfits file")
 parser.add_option("--flag", action='store_true', default=False, help="Flag data on the fly during conversion")
 parser.add_option("--reuse", action='store_true', default=False, help="Reuse already loaded data from aipsdisk")
 parser.add_option("--zapraw", action='store_true', default=False, help="zap raw and intermediate uv files")
 parser.add_option("--aipsdisk", default='aipsdisk', help='Name of aipsdisk (in "scratchdir" - or cwd) to use - default is "aipsdisk"')
 parser.add_option("--halfstokes", default=False, action='store_true', help='Only write out HH,VV when saving uv data')
+parser.add_option("--loadhalf", default=False, action='store_true', help='Only load HH,VV from the MVF file (half the size of the raw AIPS data; cannot be used with --polcal)')
 parser.add_option("--gzip", default=False, action='store_true', help='Gzip the output UV data')
+parser.add_option("--zstd", default=False, action='store_true', help='Compress the output UV data with zstd (needs zstandard)')
 parser.add_option("--dropants", help='List of antennas to remove from pbservation.')
 parser.add_option("--blmask", type='float', default=1.e10, help='Baseline length cutoff for the static mask (default apply to all baselines)')
 parser.add_option("--refant", type='str', default=None, help='Reference antenna to use for calibration')
@@ -31,14 +34,29 @@ parser.add_option("--delaycal_mvf", default=None, type='str', help='Dataset to u
 									'been observed using calibrate_delays.py just before the start of the observation. '
 									'This option is only used when --polcal is selected.')
 
+parser.add_option("--write_batch", type='int', default=None, help='Maximum number of dumps to write to AIPS per I/O call during conversion (default 151)')
+parser.add_option("--write_maxmem", type='float', default=None, help='Maximum size in MB of the AIPS write buffer during conversion (default 2048)')
+parser.add_option("--serial", dest='pipeline', action='store_false', default=None, help='Read, flag and write the data one after another during conversion rather than overlapping them')
+parser.add_option("--load_threads", type='int', default=None, help='Number of chunks of data to read concurrently during conversion (default 8)')
+parser.add_option("--flag_threads", type='int', default=None, help='Number of flagger worker threads used with --flag (default number of cores)')
+parser.add_option("--flag_overlap", type='int', default=None, help='Number of dumps either side of each chunk to include when flagging it (default 20)')
+parser.add_option("--nworkers", type='int', default=None, help='Number of processes converting groups of scans in parallel (default 1)')
+parser.add_option("--uvw_cache", default=None, help='Directory to cache the UVW coordinates computed during conversion in, for reuse by later runs')
+parser.add_option("--flagtab", default=False, action='store_true', help='Write online flags to FG table 1 on load instead of negating the weights, so they can be undone')
+parser.add_option("--resume-from", dest='resume_from', default=None, help='Rerun the pipeline from this stage, one of: %s. By default a rerun skips the stages already completed' % ', '.join(KATCalibPipe.PIPELINE_STAGES))
+parser.add_option("--only", default=None, help='Comma separated list of the only pipeline stages to run')
+
 (options, katfilenames) = parser.parse_args()
 
 if len(katfilenames) == 0:
     parser.print_help()
     sys.exit()
 
+if options.only:
+    options.only = options.only.split(',')
+
 kwargs = {}
-for k in ['parmFile', 'scratchdir', 'targets', 'configFile', 'timeav', 'flag', 'reuse', 'zapraw', 'aipsdisk', 'halfstokes', 'gzip', 'dropants', 'blmask', 'refant', 'katdal_refant', 'polcal', 'XYtarg', 'delaycal_mvf']:
+for k in ['parmFile', 'scratchdir', 'targets', 'configFile', 'timeav', 'chanav', 'flag', 'reuse', 'zapraw', 'aipsdisk', 'halfstokes', 'loadhalf', 'gzip', 'zstd', 'dropants', 'blmask', 'refant', 'katdal_refant', 'polcal', 'XYtarg', 'delaycal_mvf', 'write_batch', 'write_maxmem', 'pipeline', 'load_threads', 'flag_threads', 'flag_overlap', 'nworkers', 'uvw_cache', 'flagtab', 'resume_from', 'only']:
 	if getattr(options,k) != None:
 		kwargs[k] =  getattr(options,k)
 try:
@@ -42,6 +42,7 @@ parser.add_option("--zapraw", action='store_true', default=False, help="zap raw
 parser.add_option("--aipsdisk", default='aipsdisk', help='Name of aipsdisk (in "scratchdir" - or cwd) to use - default is "aipsdisk"')
 parser.add_option("--halfstokes", default=False, action='store_true', help='Only write out HH,VV when saving uv data')
 parser.add_option("--gzip", default=False, action='store_true', help='Gzip the output UV data')
+parser.add_option("--zstd", default=False, action='store_true', help='Compress the output UV data with zstd (needs zstandard)')
 (options, katfilenames) = parser.parse_args()
 
 if len(katfilenames) == 0:
@@ -51,7 +52,7 @@ if len(katfilenames) == 0:
 file_refs = get_archive(katfilenames)
 
 kwargs = {}
-for k in ['parmFile', 'scratchdir', 'targets', 'configFile', 'timeav', 'flag', 'reuse', 'zapraw', 'aipsdisk', 'halfstokes', 'gzip']:
+for k in ['parmFile', 'scratchdir', 'targets', 'configFile', 'timeav', 'flag', 'reuse', 'zapraw', 'aipsdisk', 'halfstokes', 'gzip', 'zstd']:
 	if getattr(options,k) != None:
 		kwargs[k] =  getattr(options,k)
 try:
@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+
+"""
+Fill the shared AIPS file cache with the AIPS libraries, the FILAIP
+MEMORY/TEMPLATE directories and every AIPS task used by the pipelines,
+so that pipeline runs using the cache start without network access.
+Set aips_cache (or $AIPS_CACHE) in .katimrc to use the cache.
+"""
+
+import argparse
+import os
+import tempfile
+from katim import AIPSLite
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('cache', help='Cache directory to fill')
+    parser.add_argument('--version', default=AIPSLite.default_version,
+                        help='AIPS version (default %(default)s)')
+    parser.add_argument('--mirror', default=os.environ.get('AIPS_MIRROR'),
+                        help='Local directory with the layout of the AIPS server '
+                             'to copy from instead of rsync')
+    parser.add_argument('--tasks', default=','.join(AIPSLite.pipeline_tasks),
+                        help='Comma separated AIPS tasks to fetch (default %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='Fetch the files again even if they are cached')
+    args = parser.parse_args()
+
+    AIPSLite.set_cache(os.path.abspath(args.cache), args.mirror)
+    # AIPS tree to fetch into, only the cache is kept
+    with tempfile.TemporaryDirectory() as basedir:
+        AIPSLite.prefetch(basedir=basedir, version=args.version,
+                          tasks=args.tasks.upper().split(','), force=args.force)
+    print('AIPS %s files cached in %s' % (args.version, args.cache))
+
+
+if __name__ == '__main__':
+    main()
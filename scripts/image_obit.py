@@ -19,6 +19,7 @@ parser.add_option("--targets", default=None, help="List of targets to image")
 parser.add_option("--refant",type='int',default=0,help="Ref ant to use")
 parser.add_option("--blavg",action="store_true",help="BL dep. avg. and Stokes I?")
 parser.add_option("--scratch",help="Location of aips disk to create")
+parser.add_option("--max-concurrent",type='int',default=1,dest="maxConcurrent",help="Max. number of targets to image at once")
 (options, args) = parser.parse_args()
 
 filebase=os.path.basename(os.path.splitext(args[0])[0])
@@ -117,7 +118,7 @@ KATImageTargets (uv, err, Sources=targets, seq=1, sclass="IClean", OutlierArea=p
                           doMB=True, norder=parms["MBnorder"], maxFBW=parms["MBmaxFBW"], \
                           PBCor=parms["PBCor"],antSize=parms["antSize"], autoCen=parms["autoCen"], \
                           nTaper=parms["nTaper"], Tapers=parms["Tapers"], sefd=1500, \
-                          nThreads=72, noScrat=[], logfile="IMAGE.log", check=False, debug=False)
+                          maxConcurrent=options.maxConcurrent, nThreads=72, noScrat=[], logfile="IMAGE.log", check=False, debug=False)
 
 x = Image.newPAImage("out", targets, "IClean", disk, 1, True, err)
 xf = KATImFITS(x,targets+".fits", 0 , err, logfile="IMAGE.log")
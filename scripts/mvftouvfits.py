@@ -1,16 +1,14 @@
 #! /usr/bin/env python
 import os
 import shutil
-import numpy as np
 import katdal
-import OErr, OTObit, ObitTalkUtil, OSystem
+import OErr, ObitTalkUtil, OSystem
 import AIPS
 from katim import AIPSSetup
 from katim import KATH5toAIPS
 from katim import KATCal
 # Option parser
 from optparse import OptionParser
-from astropy.io import fits as pyfits
 
 import warnings
 warnings.simplefilter('ignore')
@@ -56,15 +54,9 @@ if options.channel_range:
     katdata.select(channels=chan_range)
 
 katdata.select(scans='track')
-numchans = len(katdata.channel_freqs)
-nbl = len(np.unique([(cp[0][:-1] + cp[1][:-1]).upper() for cp in katdata.corr_products]))
 
-#Condition the uvfits template
-templatefile=ObitTalkUtil.FITSDir.FITSdisks[fitsdisk]+'MKATTemplate.uvtab.gz'
-
-KATH5toAIPS.MakeTemplate(templatefile,filebase+'.uvfits',numchans,nvispio=nbl)
-
-uv=OTObit.uvlod(filebase+'.uvfits',0,nam,cls,disk,seq,err)
+#Create the empty AIPS uv data
+uv=KATH5toAIPS.CreateKATUV(katdata,nam,cls,disk,seq,err)
 
 obsdata = KATH5toAIPS.KAT2AIPS(katdata, uv, disk, fitsdisk, err, calInt=1.0, stop_w=False, doflags=options.write_flags)
 
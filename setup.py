@@ -14,7 +14,8 @@ setup (
 	    "scripts/image_obit.py",
         "scripts/KATCalPipe.py",
 	    "scripts/KATZenPipe.py",
-        "scripts/get_delaycal.py"
+        "scripts/get_delaycal.py",
+        "scripts/aips_prefetch.py"
     ],
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -36,5 +37,7 @@ setup (
         "katpoint",
         "matplotlib",
         "numba",
-        "numpy"]
+        "numpy"],
+    extras_require={
+        "zstd": ["zstandard"]}
 )